@@ -1,5 +1,5 @@
 from . import config
-from .services.update_token_holders_service import on_token_transfer
+from .services.update_token_holders_service import on_token_transfers, on_token_transfers_reverted
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,8 +16,11 @@ def get_registry():
                 "contract_address": token_contract['address'],
                 "environment": environment,
                 "abi_path": token_contract['abi'],
-                "callbacks": {
-                    "Transfer": on_token_transfer
+                "batch_callbacks": {
+                    "Transfer": on_token_transfers
+                },
+                "revert_callbacks": {
+                    "Transfer": on_token_transfers_reverted
                 }
             }
         )
@@ -0,0 +1,33 @@
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_balances(apps, schema_editor):
+    TokenBalance = apps.get_model('index_v1', 'TokenBalance')
+    duplicates = (
+        TokenBalance.objects
+        .values('contract_id', 'account')
+        .annotate(count=Count('id'), first_id=Min('id'), total=Sum('balance'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        TokenBalance.objects.filter(id=duplicate['first_id']).update(balance=duplicate['total'])
+        TokenBalance.objects.filter(
+            contract_id=duplicate['contract_id'],
+            account=duplicate['account'],
+        ).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('index_v1', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_balances, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='tokenbalance',
+            unique_together={('contract', 'account')},
+        ),
+    ]
@@ -1,6 +1,11 @@
+from collections import defaultdict
+
+from django.db import connection
+from django.utils import timezone
+
 from common import models
 from quark.models import *
-from .config import ADDRESS_0, INDEX_NAME
+from .config import INDEX_NAME
 
 
 class TokenBalance(models.ActiveModel):
@@ -8,42 +13,50 @@ class TokenBalance(models.ActiveModel):
     account = models.CharField(max_length=500)
     balance = models.DecimalField(max_digits=30, decimal_places=0, default=0)
 
-    @classmethod
-    def update_ledger(cls, contract, _from, _to, amount):
-        _from_balance, _ = cls.objects.get_or_create(
-            contract=contract,
-            account=_from
-        )
-        _to_balance, _ = cls.objects.get_or_create(
-            contract=contract,
-            account=_to
-        )
+    # Rows per upsert statement, 5 parameters each
+    UPSERT_BATCH_SIZE = 10000
 
-        if _from_balance != ADDRESS_0:
-            _from_balance.balance -= amount
-            _from_balance.save()
-        if _to_balance != ADDRESS_0:
-            _to_balance.balance += amount
-            _to_balance.save()
-    balance = models.DecimalField(max_digits=30, decimal_places=0, default=0)
+    class Meta:
+        unique_together = [
+            ['contract', 'account'],
+        ]
 
     @classmethod
     def update_ledger(cls, contract, _from, _to, amount):
-        _from_balance, _ = cls.objects.get_or_create(
-            contract=contract,
-            account=_from
-        )
-        _to_balance, _ = cls.objects.get_or_create(
-            contract=contract,
-            account=_to
+        deltas = defaultdict(int)
+        deltas[_from] -= amount
+        deltas[_to] += amount
+        cls.apply_deltas(contract, deltas)
+
+    @classmethod
+    def apply_deltas(cls, contract, deltas):
+        """Add the net balance changes of a contract, {account: delta}, with one upsert.
+
+        The zero address is kept like any other account, its balance is minus
+        the minted supply.
+        """
+        now = timezone.now()
+        # Always lock the rows in the same order, so concurrent writers don't deadlock
+        rows = sorted(
+            (account, delta) for account, delta in deltas.items() if delta
         )
+        table = cls._meta.db_table
 
-        if _from_balance != ADDRESS_0:
-            _from_balance.balance -= amount
-            _from_balance.save()
-        if _to_balance != ADDRESS_0:
-            _to_balance.balance += amount
-            _to_balance.save()
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), cls.UPSERT_BATCH_SIZE):
+                batch = rows[i: i + cls.UPSERT_BATCH_SIZE]
+                params = []
+                for account, delta in batch:
+                    params.extend([contract.id, account, delta, now, now])
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (contract_id, account, balance, created_at, updated_at, is_active)
+                    VALUES {", ".join(["(%s, %s, %s, %s, %s, true)"] * len(batch))}
+                    ON CONFLICT (contract_id, account) DO UPDATE
+                    SET balance = {table}.balance + EXCLUDED.balance, updated_at = EXCLUDED.updated_at
+                    """,
+                    params,
+                )
 
 
 class TransactionLog(models.Model):
@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 from ..models import TokenBalance
 import logging
 logger = logging.getLogger(__name__)
@@ -12,3 +14,26 @@ def on_token_transfer(event, contract_instance):
         amount=event['args']['value']
     )
     return event
+
+
+def on_token_transfers(events, contract_instance):
+    """Fold the transfers of a chunk into one balance change per account."""
+    logger.debug(f"Running on_token_transfers for {len(events)} transfers")
+    deltas = defaultdict(int)
+    for event in events:
+        deltas[event['args']['from']] -= event['args']['value']
+        deltas[event['args']['to']] += event['args']['value']
+
+    TokenBalance.apply_deltas(contract_instance.contract_db_object, deltas)
+    return events
+
+
+def on_token_transfers_reverted(events, contract_instance):
+    """Take back the transfers of the blocks a chain reorganisation dropped."""
+    logger.debug(f"Reverting {len(events)} transfers")
+    deltas = defaultdict(int)
+    for event in events:
+        deltas[event['args']['from']] += int(event['args']['value'])
+        deltas[event['args']['to']] -= int(event['args']['value'])
+
+    TokenBalance.apply_deltas(contract_instance.contract_db_object, deltas)
@@ -71,6 +71,10 @@ CHAIN = {
         ],
         "chain_type": ChainType.mainnet,
         "max_chunk_scan_size": 3000,
+        # How deep a reorg can go, the hashes of that many of the last scanned blocks are checked on every scan
+        "confirmation_blocks": 15,
+        # HTTP requests per provider shared by all our processes, the dataseeds allow 10K per 5 minutes per IP
+        "rate_limit": {"requests_per_second": 25, "burst": 50},
     },
     Environment.testnet: {
         "min_block_number": 11981429,
@@ -91,6 +95,8 @@ CHAIN = {
         ],
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 500000,
+        "confirmation_blocks": 15,
+        "rate_limit": {"requests_per_second": 25, "burst": 50},
     },
     Environment.polygon_testnet: {
         "min_block_number": 23846272,
@@ -108,6 +114,7 @@ CHAIN = {
         ],
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 128,
     },
     Environment.polygon_mainnet: {
         "min_block_number": 5013591,
@@ -130,6 +137,12 @@ CHAIN = {
         ],
         "chain_type": ChainType.mainnet,
         "max_chunk_scan_size": 10000,
+        "confirmation_blocks": 128,
+        # How many eth_getLogs block ranges are fetched at the same time
+        "max_parallel_requests": 4,
+        # Keep-alive connections per provider, shared by the scanner, reads and writes
+        "http_pool_size": 10,
+        "rate_limit": {"requests_per_second": 20, "burst": 40},
     },
     Environment.avalanche_mainnet: {
         "min_block_number": 7388829,
@@ -144,6 +157,8 @@ CHAIN = {
         "backup_providers": [],
         "chain_type": ChainType.mainnet,
         "max_chunk_scan_size": 1000000,
+        "confirmation_blocks": 1,
+        "rate_limit": {"requests_per_second": 20, "burst": 40},
     },
     Environment.fantom_testnet: {
         "min_block_number": 6997914,
@@ -159,6 +174,7 @@ CHAIN = {
         "backup_providers": [],
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 5,
     },
     Environment.arbitrum_testnet: {
         "min_block_number": 9089497,
@@ -174,6 +190,7 @@ CHAIN = {
         "backup_providers": [],
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 5,
     },
     Environment.avalanche_testnet: {
         "min_block_number": 5052156,
@@ -189,6 +206,7 @@ CHAIN = {
         "gas_price": 27.5,
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 1,
     },
     Environment.ropsten: {
         "min_block_number": 11909003,
@@ -204,6 +222,7 @@ CHAIN = {
         "gas_price": 27.5,
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 12,
     },
     Environment.aurora_test: {
         "min_block_number": 81065420,
@@ -219,11 +238,12 @@ CHAIN = {
         "gas_price": 0,
         "chain_type": ChainType.testnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 5,
     },
     Environment.aurora_mainnet: {
         "min_block_number": 81065420,
         "default_asset": AssetsKey.ETH,
-        "provider": " https://mainnet.aurora.dev/13gvrutJ1W53h8tAmcjtY7xjDLGzSwZ5FnLKHYF9aone",
+        "provider": "https://mainnet.aurora.dev/13gvrutJ1W53h8tAmcjtY7xjDLGzSwZ5FnLKHYF9aone",
         "explorer_api": "explorer.mainnet.aurora.dev",
         "explorer": "explorer.mainnet.aurora.dev/",
         "explorer_key": "",
@@ -234,5 +254,14 @@ CHAIN = {
         "gas_price": 0,
         "chain_type": ChainType.mainnet,
         "max_chunk_scan_size": 100000,
+        "confirmation_blocks": 5,
     },
 }
+
+# Blocks behind the head after which a chain without a `confirmation_blocks` entry is considered final
+DEFAULT_CONFIRMATION_BLOCKS = 12
+
+
+def get_confirmation_blocks(environment) -> int:
+    """How deep a block has to be before it can't be reorganised anymore."""
+    return CHAIN[environment].get("confirmation_blocks", DEFAULT_CONFIRMATION_BLOCKS)
@@ -3,9 +3,20 @@ import importlib
 from django.conf import settings
 from .services import web3_service
 from web3 import Web3
-from quark.services.multicall_read_service import Multicall
+from quark.services.multicall_read_service import (
+    MulticallCacheStats,
+    MulticallDecodedResult,
+    get_multicall,
+)
 from pipe import select, where
-from .services.read_service import save_result_in_cache
+from .services.read_service import (
+    ReadCall,
+    get_result_from_cache,
+    read_many,
+    save_result_in_cache,
+)
+from .services.abi_service import get_abi
+from .services.sampling_service import sample as sample_function
 from collections import defaultdict
 
 import logging
@@ -20,7 +31,14 @@ def get_checksum_address(address):
 
 
 def register(
-    index, contract_address, environment, abi_path, callbacks={}, events_to_scan=[]
+    index,
+    contract_address,
+    environment,
+    abi_path,
+    callbacks={},
+    batch_callbacks={},
+    revert_callbacks={},
+    events_to_scan=[],
 ):
     contract_address = contract_address.lower()
 
@@ -29,13 +47,17 @@ def register(
         contract_address=contract_address,
         environment=environment,
         abi_path=abi_path,
+        events_to_scan=events_to_scan,
     )
 
     if callbacks:
         contract_instance.add_callbacks(callbacks)
 
-    if events_to_scan:
-        contract_instance.events_to_scan = events_to_scan
+    if batch_callbacks:
+        contract_instance.add_batch_callbacks(batch_callbacks)
+
+    if revert_callbacks:
+        contract_instance.add_revert_callbacks(revert_callbacks)
 
     ContractRegistryMap[index][environment][contract_address] = contract_instance
 
@@ -54,16 +76,30 @@ def get(index, contract_address, environment, abi_path=None):
     return ContractRegistryMap[index][environment][contract_address]
 
 
-def get_contract_instance(index, contract_address, environment, abi_path, callbacks={}):
+def get_contract_instance(
+    index,
+    contract_address,
+    environment,
+    abi_path,
+    callbacks={},
+    batch_callbacks={},
+    revert_callbacks={},
+    events_to_scan=[],
+):
     contract_instance = web3_service.Contract(
         index=index,
         contract_address=get_checksum_address(contract_address),
         environment=environment,
         abi_path=abi_path,
+        events_to_scan=events_to_scan,
     )
 
     if callbacks:
         contract_instance.add_callbacks(callbacks)
+    if batch_callbacks:
+        contract_instance.add_batch_callbacks(batch_callbacks)
+    if revert_callbacks:
+        contract_instance.add_revert_callbacks(revert_callbacks)
     return contract_instance
 
 
@@ -90,35 +126,137 @@ def register_all_contracts():
             register(index=app_name, **contract_details)
 
 
-def multicall(contract_functions, environment):
-    m = Multicall(environment=environment)
-    return m.aggregate(
-        contract_functions
-    )
-
+def batch_read(calls, environment, default_block="latest"):
+    """Read many contract functions with one JSON-RPC batch, through the read cache.
 
-def cached_multicall(calls, environment):
-    results = multicall(
+    eg. calls = [(contract_address, abi_path, function_name, *args), ...], same as `cached_multicall`
+    """
+    return read_many(
+        environment,
         list(
             calls
             | select(
-                lambda x: get(
-                    contract_address=x[0], abi_path=x[1], environment=environment
-                ).f(x[2], *x[3:])
+                lambda x: ReadCall(
+                    contract_address=x[0],
+                    abi=get_abi(x[0], environment, x[1]),
+                    function_name=x[2],
+                    args=tuple(x[3:]),
+                    default_block=default_block,
+                )
             )
-        ),
-        environment=environment,
+        )
+    )
+
+
+def sample(
+    contract_address,
+    abi_path,
+    function_name,
+    args,
+    environment,
+    start_block,
+    end_block,
+    step=1,
+):
+    """A view function every `step` blocks of a range, eg. the daily `totalSupply()` of a token.
+
+    eg. sample(token_address, "ERC20.json", "balanceOf", (holder,), "mainnet", 20000000, 25000000, step=28800)
+
+    :return: `sampling_service.Samples`, columns of block numbers, timestamps and values
+    """
+    return sample_function(
+        environment,
+        contract_address,
+        get_abi(contract_address, environment, abi_path),
+        function_name,
+        tuple(args),
+        start_block,
+        end_block,
+        step=step,
+    )
+
+
+def multicall(contract_functions, environment, require_success=True, block_identifier="latest"):
+    """
+    :param require_success: False returns a `MulticallDecodedResult` per function
+        instead of raising when one of them reverts
+    :param block_identifier: Block to read at, a block number or a tag
+    """
+    m = get_multicall(environment)
+    if require_success:
+        return m.aggregate(
+            contract_functions,
+            block_identifier=block_identifier,
+        )
+    return m.try_aggregate(
+        contract_functions,
+        block_identifier=block_identifier,
     )
 
-    for index, result in enumerate(results):
-        contract_address = calls[index][0]
-        abi_path = calls[index][1]
-        save_result_in_cache(
-            result,
-            contract_address,
-            environment,
-            abi_path,
-            calls[index][2],
-            *calls[index][3:],
+
+def cached_multicall(calls, environment, require_success=True, block_identifier="latest", with_stats=False):
+    """Multicall through the read cache, only the calls that are not cached are sent.
+
+    :param calls: List of (contract_address, abi_path, function_name, *args)
+    :param require_success: False returns a `MulticallDecodedResult` per call,
+        only the successful ones are cached
+    :param block_identifier: Block to read at, the results at a finalized block number are cached for good
+    :param with_stats: Also return the `MulticallCacheStats` of the calls
+    :return: The results in the order of `calls`, tuple(results, stats) with `with_stats`
+    """
+    results = [None] * len(calls)
+    stats = MulticallCacheStats()
+    # The same call repeated in `calls` is only sent once, the arguments can be lists
+    misses = defaultdict(list)
+    for index, call in enumerate(calls):
+        found, result = get_result_from_cache(
+            call[0], environment, call[1], call[2], *call[3:], default_block=block_identifier
         )
+        if found:
+            stats.hits += 1
+            results[index] = result if require_success else MulticallDecodedResult(
+                success=True, return_data_decoded=result
+            )
+        else:
+            stats.misses += 1
+            misses[repr(tuple(call))].append(index)
+
+    logger.info(f"Cached multicall: {stats.hits} hits, {stats.misses} misses")
+
+    if misses:
+        missed_calls = list(misses.values() | select(lambda indexes: calls[indexes[0]]))
+        missed_results = multicall(
+            list(
+                missed_calls
+                | select(
+                    lambda x: get(
+                        None, contract_address=x[0], abi_path=x[1], environment=environment
+                    ).f(x[2], *x[3:])
+                )
+            ),
+            environment=environment,
+            require_success=require_success,
+            block_identifier=block_identifier,
+        )
+
+        for indexes, call, result in zip(misses.values(), missed_calls, missed_results):
+            for index in indexes:
+                results[index] = result
+
+            if not require_success:
+                if not result.success:
+                    continue
+                result = result.return_data_decoded
+            save_result_in_cache(
+                result,
+                call[0],
+                environment,
+                call[1],
+                call[2],
+                *call[3:],
+                default_block=block_identifier,
+            )
+
+    if with_stats:
+        return results, stats
     return results
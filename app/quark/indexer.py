@@ -1,15 +1,25 @@
 from .config import Environment
 import importlib
 import logging
+import threading
+from contextlib import ExitStack, contextmanager
+import redis
+from django.conf import settings
+from redis.exceptions import LockError
 from . import contract
 from . import models
-from pipe import select, where
+from pipe import select, where, dedup
 from .services.event_scanner import update_events
-from .services import web3_service
-from web3 import Web3
+from .services.async_event_scanner import run_update_events_async
 
 logger = logging.getLogger(__name__)
 
+# The scan lock expires this long after its holder stopped refreshing it, eg. a killed worker
+SCAN_LOCK_TIMEOUT = 120
+
+# How often the running scan refreshes its lock
+SCAN_LOCK_REFRESH_SECONDS = SCAN_LOCK_TIMEOUT / 4
+
 # Add all the `index` apps you want to actively index  
 INDEXERS_TO_SCAN = [
     "index_v1",
@@ -28,35 +38,17 @@ def get_base_logs(tag):
     return get_index_by_tag(tag).models.TransactionLog
 
 
-def get_checksum_address(address):
-    return Web3.toChecksumAddress(address)
-
-
-def get_contract_instance(index, contract_address, environment, abi_path, callbacks={}):
-    contract_instance = web3_service.Contract(
-        index=index,
-        contract_address=get_checksum_address(contract_address),
-        environment=environment,
-        abi_path=abi_path,
-    )
-
-    if callbacks:
-        contract_instance.add_callbacks(callbacks)
-    return contract_instance
-
-
-def run_indexer(environment):
+def run_indexer(environment, loader="bulk"):
 
     contract.register_all_contracts()
 
     # Get all the index apps
     for index in INDEXERS_TO_SCAN:
-        _run(index, environment)
+        _run(index, environment, loader)
 
 
-def _run(index, environment):
-    logger.info(f"Runing indexer for environment: {environment}")
-
+def get_contracts_in_index(index, environment):
+    registry = []
     try:
         all_contracts = importlib.import_module(f"{index}.contract_registry").get_registry()
         registry = list(
@@ -69,16 +61,114 @@ def _run(index, environment):
     except Exception as e:
         logger.exception(e)
 
-    contracts_in_index = list(
+    return list(
         registry
         | select(
-            lambda contract_details: get_contract_instance(
+            lambda contract_details: contract.get_contract_instance(
                 index=index, **contract_details
             )
         )
     )
+
+
+def get_indexed_environments(index):
+    """All the environments the index has contracts on."""
+    try:
+        registry = importlib.import_module(f"{index}.contract_registry").get_registry()
+    except Exception as e:
+        logger.exception(e)
+        return []
+
+    return list(
+        registry
+        | select(lambda contract_details: contract_details["environment"])
+        | dedup
+    )
+
+
+def _get_scan_lock_key(index, environment):
+    # Celery hands the environment over as its value, the async runner as the enum member
+    return f"{index}-{Environment(environment).value}-scan_lock"
+
+
+_redis = None
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+    return _redis
+
+
+def _refresh_scan_lock(lock, stopped: threading.Event):
+    """Keep the lock alive until the scan is over, a dead worker stops refreshing it."""
+    while not stopped.wait(SCAN_LOCK_REFRESH_SECONDS):
+        try:
+            lock.reacquire()
+        except LockError as e:
+            logger.warning(f"Lost the scan lock {lock.name}: {e}")
+            return
+
+
+@contextmanager
+def scan_lock(index, environment):
+    """Hold the scan lock of an (index, environment) pair, refreshed in the background.
+
+    Every pair has its own lock in Redis, shared by the workers of every host and by
+    the async runner, so a pair is never scanned twice at the same time.
+
+    :return: Context manager yielding False when the pair is already being scanned
+    """
+    lock = _get_redis().lock(_get_scan_lock_key(index, environment), timeout=SCAN_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info(f"{index} on {environment} is already being scanned, skipping")
+        yield False
+        return
+
+    stopped = threading.Event()
+    threading.Thread(target=_refresh_scan_lock, args=(lock, stopped), daemon=True).start()
+    try:
+        yield True
+    finally:
+        stopped.set()
+        try:
+            lock.release()
+        except LockError as e:
+            logger.warning(f"Scan lock {lock.name} expired before the scan was over: {e}")
+
+
+def run_index(index, environment, loader="bulk"):
+    """Scan one environment of an index, a slow chain only holds up the next run of that same pair."""
+    with scan_lock(index, environment) as locked:
+        if locked:
+            _run(index, environment, loader)
+
+
+def _run(index, environment, loader="bulk"):
+    logger.info(f"Runing indexer for environment: {environment}")
+
+    contracts_in_index = get_contracts_in_index(index, environment)
     if contracts_in_index:
-        update_events(contracts_in_index, index)
+        update_events(contracts_in_index, index, loader=loader)
+
+
+def run_indexer_async(environments=None):
+    """Scan every (index, environment) pair concurrently on one event loop."""
+
+    contract.register_all_contracts()
+
+    environments = environments or list(Environment)
+    with ExitStack() as locks:
+        contract_groups = []
+        for index in INDEXERS_TO_SCAN:
+            for environment in environments:
+                contracts_in_index = get_contracts_in_index(index, environment)
+                # The pairs the Celery tasks are scanning are left to them
+                if contracts_in_index and locks.enter_context(scan_lock(index, environment)):
+                    contract_groups.append((contracts_in_index, index))
+
+        run_update_events_async(contract_groups)
 
 
 def clear(index):
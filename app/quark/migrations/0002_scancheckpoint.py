@@ -0,0 +1,26 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quark', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.CharField(max_length=255)),
+                ('last_scanned_block', models.IntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('contract', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='quark.contract')),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='quark.environment')),
+            ],
+            options={
+                'unique_together': {('index', 'environment', 'contract')},
+            },
+        ),
+    ]
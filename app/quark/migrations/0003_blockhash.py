@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quark', '0002_scancheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.CharField(max_length=255)),
+                ('block_number', models.IntegerField()),
+                ('hash', models.CharField(max_length=255)),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='quark.environment')),
+            ],
+            options={
+                'unique_together': {('index', 'environment', 'block_number')},
+            },
+        ),
+    ]
@@ -54,3 +54,26 @@ class EventName(models.Model):
             models.Index(fields=['event_name', ]),
         ]
         unique_together = [['event_name']]
+
+
+class ScanCheckpoint(models.Model):
+    """The last block an index has scanned for a contract, saved in the same transaction as the chunk's events."""
+    index = models.CharField(max_length=255)
+    environment = models.ForeignKey(Environment, on_delete=models.CASCADE)
+    contract = models.ForeignKey(Contract, on_delete=models.CASCADE)
+    last_scanned_block = models.IntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['index', 'environment', 'contract']]
+
+
+class BlockHash(models.Model):
+    """Hashes of the last `confirmation_blocks` blocks an index scanned, to find the forks."""
+    index = models.CharField(max_length=255)
+    environment = models.ForeignKey(Environment, on_delete=models.CASCADE)
+    block_number = models.IntegerField()
+    hash = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = [['index', 'environment', 'block_number']]
@@ -0,0 +1,533 @@
+"""An asyncio flavour of the event scanner.
+
+All the JSON-RPC traffic (`eth_getLogs`, block timestamps, retries) runs on a single
+event loop over an `aiohttp` session, so one worker process can keep dozens of requests
+in-flight across chains without a thread per request.
+
+It plugs into the same `EventScannerState` contract as `EventScanner`. The state calls and
+the reorg checks hit the db and the provider synchronously, they run through `sync_to_async`
+so they don't hold up the requests in-flight on the loop.
+"""
+import asyncio
+import datetime
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Iterable, List, Tuple
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from hexbytes import HexBytes
+from pipe import select, where
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from .event_scanner import (
+    DBState,
+    EventScanner,
+    EventScannerState,
+    log_table,
+)
+from .block_service import BLOCK_BATCH_SIZE
+from .chunk_size_service import estimate_payload_bytes, is_response_too_large
+from .rate_limit_service import acquire_async
+from .reorg_service import check_block_hashes, get_hash_window_start
+from .rpc_service import JSONRPCError
+
+logger = logging.getLogger(__name__)
+
+# Seconds we wait on a single JSON-RPC call
+REQUEST_TIMEOUT = 60
+
+
+class AsyncJSONRPC:
+    """Minimal JSON-RPC client over a shared `aiohttp` session, within the rate limit of the provider."""
+
+    _ids = itertools.count()
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        provider: str,
+        max_in_flight_requests: int = 10,
+        environment: str = None,
+    ):
+        self.session = session
+        self.provider = provider.strip()
+        self.semaphore = asyncio.Semaphore(max_in_flight_requests)
+        self.environment = environment
+
+    async def call(self, method: str, params: list):
+        payload = {
+            "jsonrpc": "2.0",
+            "id": next(self._ids),
+            "method": method,
+            "params": params,
+        }
+        async with self.semaphore:
+            await acquire_async(self.environment, self.provider)
+            async with self.session.post(self.provider, json=payload) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+
+        if "error" in data:
+            raise JSONRPCError(data["error"])
+        return data["result"]
+
+    async def batch_call(self, calls: List[Tuple[str, list]]) -> list:
+        """Async twin of `rpc_service.batch_call`, failed calls have a `JSONRPCError` in their place."""
+        if not calls:
+            return []
+
+        payload = [
+            {"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params}
+            for method, params in calls
+        ]
+        async with self.semaphore:
+            await acquire_async(self.environment, self.provider)
+            async with self.session.post(self.provider, json=payload) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+
+        if isinstance(data, dict):
+            raise JSONRPCError(data.get("error", data))
+
+        responses = {item.get("id"): item for item in data}
+        results = []
+        for request in payload:
+            item = responses.get(request["id"])
+            if item is None:
+                results.append(JSONRPCError(f"No response for {request['method']}"))
+            elif "error" in item:
+                results.append(JSONRPCError(item["error"]))
+            else:
+                results.append(item["result"])
+        return results
+
+
+def _format_log(log: dict) -> AttributeDict:
+    """Convert a raw `eth_getLogs` entry to the shape Web3 hands out."""
+    return AttributeDict({
+        **log,
+        "address": Web3.toChecksumAddress(log["address"]),
+        "topics": list(log["topics"] | select(HexBytes)),
+        "data": log["data"],
+        "blockHash": HexBytes(log["blockHash"]),
+        "blockNumber": int(log["blockNumber"], 16),
+        "transactionHash": HexBytes(log["transactionHash"]),
+        "transactionIndex": int(log["transactionIndex"], 16),
+        "logIndex": int(log["logIndex"], 16) if log.get("logIndex") is not None else None,
+    })
+
+
+class AsyncEventScanner(EventScanner):
+    """`EventScanner` whose network calls are coroutines.
+
+    The topic set, the decoding and the hand-over to the state are shared with `EventScanner`,
+    only the `*_async` methods below talk to the JSON-RPC server.
+    """
+
+    def __init__(self, rpc: AsyncJSONRPC, state: EventScannerState, contracts, **kwargs):
+        # The web3 instance is only used for its ABI codec
+        super().__init__(contracts[0].web3, state, contracts, **kwargs)
+        self.rpc = rpc
+
+    async def get_block_timestamp_async(self, block_num) -> datetime.datetime:
+        """Get Ethereum block timestamp"""
+        block_info = await self.rpc.call("eth_getBlockByNumber", [hex(block_num), False])
+        if not block_info:
+            # Block was not mined yet,
+            # minor chain reorganisation?
+            return None
+        return datetime.datetime.utcfromtimestamp(int(block_info["timestamp"], 16))
+
+    async def get_block_timestamps_async(self, block_numbers) -> dict:
+        """Get the timestamps of all the distinct blocks of a chunk.
+
+        Blocks already in the block timestamp store are not fetched again,
+        the rest are fetched in concurrent JSON-RPC batches and added to the store.
+        """
+        known = self.block_timestamp_store.get_timestamps(set(block_numbers))
+        fetched = await self._fetch_block_timestamps_async(
+            sorted(set(block_numbers) - set(known))
+        )
+        self.block_timestamp_store.set_timestamps(fetched)
+        return {**known, **fetched}
+
+    async def _fetch_block_timestamps_async(self, block_numbers) -> dict:
+        if not block_numbers:
+            return {}
+
+        batch_size = self.chain.get("block_batch_size", BLOCK_BATCH_SIZE)
+        batches = [
+            block_numbers[i: i + batch_size]
+            for i in range(0, len(block_numbers), batch_size)
+        ]
+
+        try:
+            results = await asyncio.gather(
+                *(
+                    batches
+                    | select(
+                        lambda batch: self.rpc.batch_call(
+                            [("eth_getBlockByNumber", [hex(block_number), False]) for block_number in batch]
+                        )
+                    )
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Batched block lookup failed with {e}, fetching blocks one by one")
+            timestamps = await asyncio.gather(
+                *(block_numbers | select(self.get_block_timestamp_async))
+            )
+            return dict(zip(block_numbers, timestamps))
+
+        block_timestamps = {}
+        for batch, headers in zip(batches, results):
+            for block_number, header in zip(batch, headers):
+                if isinstance(header, Exception):
+                    header = await self.rpc.call("eth_getBlockByNumber", [hex(block_number), False])
+                block_timestamps[block_number] = (
+                    datetime.datetime.utcfromtimestamp(int(header["timestamp"], 16))
+                    if header else None
+                )
+        return block_timestamps
+
+    async def get_block_hashes_async(self, start_block, end_block) -> dict:
+        """Async twin of `get_block_hashes`."""
+        if self.hash_window_start is None or end_block < self.hash_window_start:
+            return {}
+
+        block_numbers = list(range(max(start_block, self.hash_window_start), end_block + 1))
+        batch_size = self.chain.get("block_batch_size", BLOCK_BATCH_SIZE)
+        batches = [
+            block_numbers[i: i + batch_size]
+            for i in range(0, len(block_numbers), batch_size)
+        ]
+        results = await asyncio.gather(
+            *(
+                batches
+                | select(
+                    lambda batch: self.rpc.batch_call(
+                        [("eth_getBlockByNumber", [hex(block_number), False]) for block_number in batch]
+                    )
+                )
+            )
+        )
+
+        block_hashes = {}
+        for batch, headers in zip(batches, results):
+            for block_number, header in zip(batch, headers):
+                if isinstance(header, Exception):
+                    raise header
+                if header:
+                    block_hashes[block_number] = header["hash"]
+        return block_hashes
+
+    async def get_suggested_scan_end_block_async(self):
+        """Get the last mined block on Ethereum chain we are following."""
+        return int(await self.rpc.call("eth_blockNumber", []), 16)
+
+    async def _get_logs(self, topics, from_block: int, to_block: int, response: dict) -> list:
+        if not topics:
+            raise ValueError("No topics to query, eth_getLogs would return every event of the contracts")
+
+        event_filter_params = {
+            "topics": [topics],
+            "address": list(
+                self.contract_mapping.values()
+                | select(lambda contract: contract.contract_address)
+            ),
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+        }
+
+        logs = await self.rpc.call("eth_getLogs", [event_filter_params])
+        response["payload_bytes"] += estimate_payload_bytes(logs)
+
+        return list(
+            logs
+            | select(_format_log)
+            | select(self.log_decoder.decode)
+        )
+
+    async def _get_logs_for_topics(self, topics, from_block: int, to_block: int, response: dict) -> list:
+        """Same as `_fetch_events_for_topics`, split the topics only when the response is too large."""
+        try:
+            return await self._get_logs(topics, from_block, to_block, response)
+        except Exception as e:
+            if len(topics) < 2 or not is_response_too_large(e):
+                raise
+
+        middle = len(topics) // 2
+        first_half, second_half = await asyncio.gather(
+            self._get_logs_for_topics(topics[:middle], from_block, to_block, response),
+            self._get_logs_for_topics(topics[middle:], from_block, to_block, response),
+        )
+        return sorted(
+            [*first_half, *second_half],
+            key=lambda evt: (evt["blockNumber"], evt["logIndex"])
+        )
+
+    async def _retry_get_logs(self, topics, start_block, end_block) -> Tuple[int, list]:
+        """Async twin of `_retry_web3_call`, throttles down the block range on every retry."""
+        for i in range(self.max_request_retries):
+            try:
+                response = {"payload_bytes": 0}
+                start = time.time()
+                events = await self._get_logs_for_topics(topics, start_block, end_block, response)
+                self.chunk_size_controller.on_success(
+                    block_range=end_block - start_block,
+                    log_count=len(events),
+                    payload_bytes=response["payload_bytes"],
+                    latency=time.time() - start
+                )
+                return end_block, events
+            except Exception as e:
+                if i < self.max_request_retries - 1:
+                    logger.warning(
+                        "Retrying events for block range %d - %d (%d) failed with %s, retrying in %s seconds",
+                        start_block,
+                        end_block,
+                        end_block - start_block,
+                        e,
+                        self.request_retry_seconds)
+                    end_block = start_block + self.chunk_size_controller.on_failure(
+                        end_block - start_block, e
+                    )
+                    await asyncio.sleep(self.request_retry_seconds)
+                    continue
+                else:
+                    logger.warning("Out of retries")
+                    raise
+
+    async def fetch_chunk_async(self, start_block, end_block) -> Tuple[int, list, dict]:
+        """Fetch the events and block timestamps between two block numbers.
+
+        :return: tuple(actual end block number, events, block timestamps)
+        :raises: ChainReorganisedError when the chain changed while the chunk was fetched
+        """
+
+        events = []
+        hashes_before = await self.get_block_hashes_async(start_block, end_block)
+
+        for topics in self.get_topic_groups():
+            end_block, topic_events = await self._retry_get_logs(
+                topics, start_block, end_block
+            )
+            events += topic_events
+
+        events = list(
+            events
+            | where(lambda evt: evt["blockNumber"] <= end_block)
+        )
+
+        block_hashes = await self.get_block_hashes_async(start_block, end_block)
+        check_block_hashes(hashes_before, block_hashes, events)
+        with self.block_hashes_lock:
+            self.block_hashes.update(block_hashes)
+
+        block_timestamps = await self.get_block_timestamps_async(
+            [*(events | select(lambda evt: evt["blockNumber"])), end_block]
+        )
+
+        return end_block, events, block_timestamps
+
+    async def scan_iter_async(self, start_block, end_block):
+        """Perform the scan on the event loop, yielding a summary of every committed chunk.
+
+        With `max_parallel_requests` > 1 that many chunks are in-flight at the same time,
+        the state still sees them one at a time and in block order.
+        Nothing is kept around between chunks, so memory use stays flat.
+
+        :return: Async iterator of {start_block, end_block, end_block_timestamp, events, fetch_duration, process_duration}
+        """
+
+        assert start_block <= end_block
+        self.hash_window_start = get_hash_window_start(self.contracts[0].environment, end_block)
+        self.block_hashes = {}
+
+        start = time.time()
+
+        async for chunk_start, actual_end_block, events, block_timestamps in self._iter_chunks_async(
+            start_block, end_block
+        ):
+            fetch_duration = time.time() - start
+            await sync_to_async(self.state.start_chunk)(chunk_start, actual_end_block - chunk_start)
+
+            logger.info(
+                f"{'-' * 80}\n"
+                f"Processing events for blocks: {chunk_start}-{actual_end_block} "
+                f"on {self.contracts[0].environment}"
+            )
+
+            process_start = time.time()
+            end_block_timestamp, new_entries = await sync_to_async(self._process_chunk)(
+                chunk_start,
+                actual_end_block,
+                events,
+                block_timestamps
+            )
+
+            yield {
+                "start_block": chunk_start,
+                "end_block": actual_end_block,
+                "end_block_timestamp": end_block_timestamp,
+                "events": len(new_entries),
+                "fetch_duration": fetch_duration,
+                "process_duration": time.time() - process_start,
+            }
+            start = time.time()
+
+    def _process_chunk(self, start_block, end_block, events, block_timestamps):
+        """Hand a chunk over to the state and commit it, off the event loop."""
+        _, end_block_timestamp, new_entries = self.process_chunk(end_block, events, block_timestamps)
+        self.record_block_hashes(start_block, end_block)
+        self.state.end_chunk(end_block)
+        return end_block_timestamp, new_entries
+
+    async def _iter_chunks_async(self, start_block, end_block):
+        if self.max_parallel_requests == 1:
+            # Serial scan, the chunk size adapts to what we find
+            current_block = start_block
+            while current_block <= end_block:
+                estimated_end_block = min(
+                    current_block + self.chunk_size_controller.chunk_size, end_block
+                )
+                actual_end_block, events, block_timestamps = await self.fetch_chunk_async(
+                    current_block, estimated_end_block
+                )
+                yield current_block, actual_end_block, events, block_timestamps
+                current_block = actual_end_block + 1
+            return
+
+        def _ranges():
+            current_block = start_block
+            while current_block <= end_block:
+                chunk_end = min(current_block + self.chunk_size_controller.chunk_size, end_block)
+                yield current_block, chunk_end
+                current_block = chunk_end + 1
+
+        ranges = _ranges()
+        pending = deque()
+
+        def submit_next():
+            block_range = next(ranges, None)
+            if block_range:
+                pending.append(
+                    (block_range, asyncio.ensure_future(self.fetch_chunk_async(*block_range)))
+                )
+
+        for _ in range(self.max_parallel_requests):
+            submit_next()
+
+        try:
+            while pending:
+                (chunk_start, chunk_end), task = pending.popleft()
+                actual_end_block, events, block_timestamps = await task
+                submit_next()
+                yield chunk_start, actual_end_block, events, block_timestamps
+
+                # The node made us throttle down, finish the range before moving on
+                while actual_end_block < chunk_end:
+                    chunk_start = actual_end_block + 1
+                    actual_end_block, events, block_timestamps = await self.fetch_chunk_async(
+                        chunk_start, chunk_end
+                    )
+                    yield chunk_start, actual_end_block, events, block_timestamps
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+
+async def update_events_async(contracts, index, session: aiohttp.ClientSession, loader="bulk"):
+    """`update_events` on the event loop, for the contracts of one environment of an index."""
+    chain = contracts[0].chain
+    logger.info(
+        f"Starting the async event scan for {len(contracts)} contracts on {contracts[0].environment}"
+    )
+
+    rpc = AsyncJSONRPC(
+        session,
+        chain["provider"],
+        max_in_flight_requests=chain.get("max_in_flight_requests", 10),
+        environment=contracts[0].environment,
+    )
+
+    # Restore/create our persistent state
+    state = DBState(contracts, index, loader=loader)
+
+    scanner = AsyncEventScanner(
+        rpc=rpc,
+        state=state,
+        contracts=contracts,
+        max_chunk_scan_size=chain["max_chunk_scan_size"],
+        batch_topics=chain.get("batch_topics", True),
+        max_parallel_requests=chain.get("max_parallel_requests", 1)
+    )
+
+    # Roll back the events of the blocks a reorganisation dropped since the last scan
+    await sync_to_async(scanner.delete_potentially_forked_block_data)()
+
+    start_block = max(await sync_to_async(state.get_last_scanned_block)() + 1, 0)
+    end_block = await scanner.get_suggested_scan_end_block_async()
+
+    if start_block > end_block:
+        logger.info(f"Already scanned up to block {end_block} on {contracts[0].environment}")
+        return 0
+
+    logger.info(
+        f"Scanning events for blocks: {start_block}-{end_block} on {contracts[0].environment}"
+    )
+
+    start = time.time()
+    total_events = total_chunks_scanned = 0
+    async for summary in scanner.scan_iter_async(start_block, end_block):
+        total_events += summary["events"]
+        total_chunks_scanned += 1
+
+    await sync_to_async(state.save)()
+    duration = time.time() - start
+    logger.info(
+        f"Scanned total {total_events} events on {contracts[0].environment}, in {duration} seconds, "
+        f"total {total_chunks_scanned} chunk scans performed"
+    )
+    return total_events
+
+
+def run_update_events_async(contract_groups: Iterable[Tuple[List, str]]):
+    """Scan several `(contracts, index)` groups concurrently on one event loop.
+
+    A failing group is logged and does not stop the others.
+    """
+    contract_groups = list(contract_groups | where(lambda group: group[0]))
+
+    async def _run():
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            return await asyncio.gather(
+                *(
+                    contract_groups
+                    | select(lambda group: update_events_async(group[0], group[1], session))
+                ),
+                return_exceptions=True
+            )
+
+    results = asyncio.run(_run())
+
+    summary = []
+    for (contracts, index), result in zip(contract_groups, results):
+        if isinstance(result, Exception):
+            logger.error(
+                f"Async scan of {index} on {contracts[0].environment} failed: {result}",
+                exc_info=result
+            )
+        summary.append({
+            "index": index,
+            "environment": contracts[0].environment,
+            "result": "failed" if isinstance(result, Exception) else f"{result} events",
+        })
+
+    log_table(summary, ["index", "environment", "result"])
+    return results
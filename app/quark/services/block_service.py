@@ -0,0 +1,68 @@
+"""Block header lookups in bulk."""
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from .rpc_service import batch_call
+
+logger = logging.getLogger(__name__)
+
+# How many headers we ask for in one JSON-RPC batch
+BLOCK_BATCH_SIZE = 100
+
+# How many batches are in-flight at the same time
+MAX_PARALLEL_BATCHES = 4
+
+
+def get_block_headers(
+    provider: str,
+    block_numbers: Iterable[int],
+    batch_size: int = BLOCK_BATCH_SIZE,
+    max_workers: int = MAX_PARALLEL_BATCHES,
+) -> Dict[int, Optional[dict]]:
+    """Fetch the headers of many blocks, without their transactions.
+
+    The block numbers are split into JSON-RPC batches of `batch_size`,
+    with `max_workers` batches in-flight at the same time.
+
+    :return: Block number to raw header, None for blocks that are not mined yet
+    :raises: The error of the first failed call
+    """
+    block_numbers = sorted(set(block_numbers))
+    batches = [
+        block_numbers[i: i + batch_size]
+        for i in range(0, len(block_numbers), batch_size)
+    ]
+
+    def _fetch(batch):
+        return batch_call(
+            provider,
+            [("eth_getBlockByNumber", [hex(block_number), False]) for block_number in batch]
+        )
+
+    headers = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+        for batch, results in zip(batches, executor.map(_fetch, batches)):
+            for block_number, header in zip(batch, results):
+                if isinstance(header, Exception):
+                    raise header
+                headers[block_number] = header
+    return headers
+
+
+def get_block_timestamps(
+    provider: str,
+    block_numbers: Iterable[int],
+    batch_size: int = BLOCK_BATCH_SIZE,
+    max_workers: int = MAX_PARALLEL_BATCHES,
+) -> Dict[int, Optional[datetime.datetime]]:
+    """UTC time each block was mined at, None for blocks that are not mined yet."""
+    headers = get_block_headers(provider, block_numbers, batch_size, max_workers)
+    return {
+        block_number: (
+            datetime.datetime.utcfromtimestamp(int(header["timestamp"], 16))
+            if header else None
+        )
+        for block_number, header in headers.items()
+    }
@@ -0,0 +1,185 @@
+"""Persistent block number -> timestamp index, one file per environment.
+
+The file is a flat array of uint32 unix timestamps indexed by block number, 0 meaning
+the block is not known yet. It is memory-mapped, so every worker process on the host
+shares the same pages, and the file stays sparse on disk for the blocks we never looked up.
+
+The scanner fills it on demand. Timestamps only ever grow with the block number,
+so a timestamp can be turned back into a block with a binary search over the known blocks.
+"""
+import datetime
+import fcntl
+import logging
+import os
+import threading
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.environ.get("BLOCK_TIMESTAMP_DIR", os.path.join("tmp", "block_timestamps"))
+
+# The file grows in steps of this many blocks
+GROWTH_BLOCKS = 1000000
+
+# How many entries we look at at once when looking for the nearest known block
+SEARCH_WINDOW = 1000000
+
+ITEM_SIZE = np.dtype(np.uint32).itemsize
+
+
+class BlockTimestampStore:
+    def __init__(self, environment: str, directory: str = STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.environment = environment
+        self.path = os.path.join(directory, f"{environment}.u32")
+        self._lock = threading.Lock()
+        self._array = None
+
+        if not os.path.exists(self.path):
+            self._grow(GROWTH_BLOCKS)
+        self._open()
+
+    def _open(self):
+        size = os.path.getsize(self.path) // ITEM_SIZE
+        self._array = np.memmap(self.path, dtype=np.uint32, mode="r+", shape=(size,))
+
+    def _grow(self, blocks: int):
+        """Extend the file to hold `blocks` entries, never shrinks it."""
+        with open(self.path, "a+b") as f:
+            # Other processes might be growing the same file
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.path.getsize(self.path) < blocks * ITEM_SIZE:
+                    f.truncate(blocks * ITEM_SIZE)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _ensure_capacity(self, block_number: int):
+        if block_number < len(self._array):
+            return
+        with self._lock:
+            if block_number >= os.path.getsize(self.path) // ITEM_SIZE:
+                self._grow(((block_number // GROWTH_BLOCKS) + 1) * GROWTH_BLOCKS)
+            self._open()
+
+    def _refresh(self):
+        """Pick up the blocks another process grew the file with."""
+        if os.path.getsize(self.path) // ITEM_SIZE > len(self._array):
+            with self._lock:
+                self._open()
+
+    def get(self, block_number: int) -> Optional[int]:
+        """Unix timestamp of the block, None if we don't know it yet."""
+        if block_number >= len(self._array):
+            self._refresh()
+            if block_number >= len(self._array):
+                return None
+        return int(self._array[block_number]) or None
+
+    def get_timestamps(self, block_numbers: Iterable[int]) -> Dict[int, datetime.datetime]:
+        """UTC time of all the known blocks among `block_numbers`."""
+        timestamps = {}
+        for block_number in block_numbers:
+            timestamp = self.get(block_number)
+            if timestamp:
+                timestamps[block_number] = datetime.datetime.utcfromtimestamp(timestamp)
+        return timestamps
+
+    def set_timestamps(self, block_timestamps: Dict[int, Optional[datetime.datetime]]):
+        """Store the UTC time of the blocks, blocks without a timestamp are skipped."""
+        block_timestamps = {
+            block_number: timestamp
+            for block_number, timestamp in block_timestamps.items()
+            if timestamp
+        }
+        if not block_timestamps:
+            return
+
+        self._ensure_capacity(max(block_timestamps))
+        for block_number, timestamp in block_timestamps.items():
+            self._array[block_number] = int(
+                timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+            )
+
+    def forget(self, since_block: int):
+        """Drop the timestamps from `since_block` on, eg. the blocks of a fork."""
+        if since_block < len(self._array):
+            self._array[since_block:] = 0
+
+    def _next_known(self, start: int, end: int) -> Optional[int]:
+        """First known block in [start, end)."""
+        for window_start in range(start, end, SEARCH_WINDOW):
+            window = self._array[window_start: min(window_start + SEARCH_WINDOW, end)]
+            known = np.flatnonzero(window)
+            if len(known):
+                return window_start + int(known[0])
+        return None
+
+    def _previous_known(self, start: int, end: int) -> Optional[int]:
+        """Last known block in [start, end)."""
+        for window_end in range(end, start, -SEARCH_WINDOW):
+            window_start = max(window_end - SEARCH_WINDOW, start)
+            known = np.flatnonzero(self._array[window_start: window_end])
+            if len(known):
+                return window_start + int(known[-1])
+        return None
+
+    def block_at_or_after(self, when: datetime.datetime) -> Optional[int]:
+        """First known block mined at or after `when`."""
+        self._refresh()
+        timestamp = int(when.replace(tzinfo=when.tzinfo or datetime.timezone.utc).timestamp())
+
+        result = None
+        low, high = 0, len(self._array)
+        while low < high:
+            middle = (low + high) // 2
+            probe = self._next_known(middle, high)
+            if probe is None:
+                high = middle
+            elif self._array[probe] >= timestamp:
+                result = probe
+                high = middle
+            else:
+                low = probe + 1
+        return result
+
+    def block_at_or_before(self, when: datetime.datetime) -> Optional[int]:
+        """Last known block mined at or before `when`."""
+        self._refresh()
+        timestamp = int(when.replace(tzinfo=when.tzinfo or datetime.timezone.utc).timestamp())
+
+        result = None
+        low, high = 0, len(self._array)
+        while low < high:
+            middle = (low + high) // 2
+            probe = self._previous_known(low, middle + 1)
+            if probe is None:
+                low = middle + 1
+            elif self._array[probe] <= timestamp:
+                result = probe
+                low = middle + 1
+            else:
+                high = probe
+        return result
+
+    def get_block_range(self, start: datetime.datetime, end: datetime.datetime):
+        """Known blocks mined between two dates, eg. to filter the events between them.
+
+        :return: tuple(first block, last block), None for a side with no known block
+        """
+        return self.block_at_or_after(start), self.block_at_or_before(end)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_block_timestamp_store(environment: str) -> BlockTimestampStore:
+    """The store of the environment, opened once per process."""
+    if environment not in _stores:
+        with _stores_lock:
+            if environment not in _stores:
+                _stores[environment] = BlockTimestampStore(environment)
+    return _stores[environment]
@@ -0,0 +1,239 @@
+"""Adaptive `eth_getLogs` block range sizing.
+
+Additive increase / multiplicative decrease, driven by what the node sends back:
+the number of logs, the size of the payload and the latency of every response,
+plus the errors nodes use to say a response would be too big.
+
+The learned block range is remembered per provider URL, so the next run starts
+at a size the provider is known to serve instead of probing again from `max_chunk_scan_size`.
+"""
+import logging
+import threading
+import diskcache as dc
+from pipe import select
+from requests.exceptions import Timeout
+
+from .rate_limit_service import is_rate_limited
+
+logger = logging.getLogger(__name__)
+cache = dc.Cache('tmp')
+
+# How long a learned block range is trusted before we probe from the top again
+LEARNED_CHUNK_SIZE_EXPIRE = 60 * 60 * 24
+
+# Good responses in a row at the ceiling after which the ceiling is raised by `additive_increase`
+CEILING_PROBE_AFTER = 100
+
+# Rough size of the JSON fields of a log entry besides its data and topics
+LOG_ENTRY_OVERHEAD_BYTES = 400
+
+# Error messages JSON-RPC nodes send back when a eth_getLogs response would be too big
+RESPONSE_TOO_LARGE_ERRORS = [
+    "query returned more than",
+    "response size exceeded",
+    "response size should not greater than",
+    "log response size exceeded",
+    "too many results",
+    "query timeout exceeded",
+    "logs matched by query exceeds limit",
+]
+
+# Error messages JSON-RPC nodes send back when the block range itself is over their limit
+BLOCK_RANGE_TOO_LARGE_ERRORS = [
+    "exceed maximum block range",
+    "block range is too wide",
+    "block range too large",
+    "range too large",
+    "is limited to a 10,000 range",
+]
+
+
+def _error_matches(error, known_errors) -> bool:
+    message = str(error).lower()
+    return any(
+        known_errors
+        | select(lambda known_error: known_error in message)
+    )
+
+
+def is_response_too_large(error) -> bool:
+    """Did the node reject the `eth_getLogs` call because of the response size."""
+    return _error_matches(error, RESPONSE_TOO_LARGE_ERRORS)
+
+
+def is_block_range_too_large(error) -> bool:
+    """Did the node reject the `eth_getLogs` call because of the block range."""
+    return _error_matches(error, BLOCK_RANGE_TOO_LARGE_ERRORS)
+
+
+def is_size_related_error(error) -> bool:
+    """Did the node say the response or the block range was too large.
+
+    A `Timeout` isn't enough on its own, see `ChunkSizeController.on_failure`.
+    """
+    return is_response_too_large(error) or is_block_range_too_large(error)
+
+
+def estimate_payload_bytes(logs) -> int:
+    """Approximate size of the `eth_getLogs` response the logs came in."""
+    def _log_bytes(log):
+        data = log["data"]
+        data_bytes = len(data) // 2 if isinstance(data, str) else len(data)
+        return data_bytes + 32 * len(log["topics"]) + LOG_ENTRY_OVERHEAD_BYTES
+
+    return sum(logs | select(_log_bytes))
+
+
+def _get_learned_chunk_size_key(provider):
+    return f"{provider}-next_chunk_size"
+
+
+def _get_learned_ceiling_key(provider):
+    return f"{provider}-chunk_size_ceiling"
+
+
+class ChunkSizeController:
+    """Decides how many blocks the next `eth_getLogs` call asks for.
+
+    * Every response under the targets grows the range by `additive_increase` blocks,
+      up to the ceiling learned for the provider.
+
+    * A response over any of the targets shrinks the range by `decrease_factor`.
+
+    * A failed call shrinks the range by `decrease_factor` too, and when the node said
+      the response or the range was too large, the ceiling is lowered to that range.
+      Go Ethereum doesn't say what is an acceptable response size, it just times out,
+      so a timeout lowers the ceiling only when the range timed out before.
+
+    The ceiling is saved only when it is lowered and forgotten `LEARNED_CHUNK_SIZE_EXPIRE` later.
+    While scanning it is raised again by `additive_increase` after `CEILING_PROBE_AFTER`
+    good responses in a row at the ceiling, so a provider that got better is probed again.
+
+    The chunks of a parallel scan are fetched from worker threads, they all feed the same controller.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        max_chunk_size: int,
+        min_chunk_size: int = 10,
+        additive_increase: int = None,
+        decrease_factor: float = 0.5,
+        max_logs_per_request: int = 10000,
+        max_payload_bytes: int = 10 * 1024 * 1024,
+        max_latency: float = 10.0,
+    ):
+        """
+        :param provider: JSON-RPC provider URL the learned range belongs to
+        :param max_chunk_size: The chain's `max_chunk_scan_size`, we never ask for more
+        :param min_chunk_size: We never ask for less, unless a retry needs to
+        :param additive_increase: Blocks added after a good response, 10% of `max_chunk_size` by default
+        :param decrease_factor: Multiplier applied after a bad response or a failure
+        :param max_logs_per_request: Target number of logs per response
+        :param max_payload_bytes: Target size of a response
+        :param max_latency: Target seconds per response
+        """
+        self.provider = provider
+        self.max_chunk_size = max_chunk_size
+        self.min_chunk_size = min(min_chunk_size, max_chunk_size)
+        self.additive_increase = additive_increase or max(1, max_chunk_size // 10)
+        self.decrease_factor = decrease_factor
+        self.max_logs_per_request = max_logs_per_request
+        self.max_payload_bytes = max_payload_bytes
+        self.max_latency = max_latency
+
+        self.ceiling = self._clamp(cache.get(_get_learned_ceiling_key(provider), max_chunk_size))
+        self.chunk_size = self._clamp(
+            min(cache.get(_get_learned_chunk_size_key(provider), self.ceiling), self.ceiling)
+        )
+        # Good responses in a row at the ceiling
+        self.good_at_ceiling = 0
+        # Smallest range that timed out since the last good response at that range
+        self.timed_out_range = None
+        self._lock = threading.Lock()
+
+    def _clamp(self, chunk_size) -> int:
+        return int(min(self.max_chunk_size, max(self.min_chunk_size, chunk_size)))
+
+    def _save(self):
+        cache.set(
+            _get_learned_chunk_size_key(self.provider),
+            self.chunk_size,
+            expire=LEARNED_CHUNK_SIZE_EXPIRE
+        )
+
+    def _lower_ceiling(self, chunk_size):
+        ceiling = self._clamp(chunk_size)
+        if ceiling >= self.ceiling:
+            return
+        logger.info(f"{self.provider} can't serve {self.ceiling} blocks, lowering the ceiling to {ceiling}")
+        self.ceiling = ceiling
+        self.good_at_ceiling = 0
+        key = _get_learned_ceiling_key(self.provider)
+        # Other processes might have lowered it further in the meantime.
+        # The expiry only starts over when the provider fails again
+        with cache.transact():
+            cache.set(key, min(self.ceiling, cache.get(key, self.ceiling)), expire=LEARNED_CHUNK_SIZE_EXPIRE)
+
+    def on_success(self, block_range: int, log_count: int, payload_bytes: int, latency: float):
+        """Feed a good response back, returns the range of the next call."""
+        with self._lock:
+            return self._on_success(block_range, log_count, payload_bytes, latency)
+
+    def _on_success(self, block_range: int, log_count: int, payload_bytes: int, latency: float):
+        over_target = (
+            log_count > self.max_logs_per_request
+            or payload_bytes > self.max_payload_bytes
+            or latency > self.max_latency
+        )
+
+        if self.timed_out_range is not None and block_range >= self.timed_out_range:
+            self.timed_out_range = None
+
+        if over_target:
+            self.good_at_ceiling = 0
+            self.chunk_size = self._clamp(block_range * self.decrease_factor)
+        else:
+            if block_range >= self.ceiling and self.ceiling < self.max_chunk_size:
+                self.good_at_ceiling += 1
+                if self.good_at_ceiling >= CEILING_PROBE_AFTER:
+                    self.good_at_ceiling = 0
+                    self.ceiling = self._clamp(self.ceiling + self.additive_increase)
+                    logger.info(f"Probing {self.provider} with a ceiling of {self.ceiling} blocks")
+            self.chunk_size = self._clamp(
+                min(self.ceiling, self.chunk_size + self.additive_increase)
+            )
+
+        logger.debug(
+            f"{block_range} blocks: {log_count} logs, {payload_bytes} bytes in {round(latency, 2)}s, "
+            f"next chunk size {self.chunk_size}"
+        )
+        self._save()
+        return self.chunk_size
+
+    def on_failure(self, block_range: int, error) -> int:
+        """Feed a failed call back, returns the range to retry with."""
+        with self._lock:
+            return self._on_failure(block_range, error)
+
+    def _on_failure(self, block_range: int, error) -> int:
+        if is_rate_limited(error) and not is_size_related_error(error):
+            # Nothing to do with the range, the retry waits for the rate limiter
+            logger.info(f"{self.provider} is throttling us, keeping the range at {block_range} blocks")
+            return block_range
+
+        retry_range = int(block_range * self.decrease_factor)
+        self.good_at_ceiling = 0
+
+        if is_size_related_error(error):
+            # Remember that the provider can't serve this range
+            self._lower_ceiling(retry_range)
+        elif isinstance(error, Timeout):
+            if self.timed_out_range is not None and block_range >= self.timed_out_range:
+                self._lower_ceiling(retry_range)
+            else:
+                self.timed_out_range = block_range
+
+        self.chunk_size = min(self.chunk_size, self._clamp(retry_range))
+        self._save()
+        return retry_range
@@ -0,0 +1,186 @@
+"""Log decoders compiled once per event ABI.
+
+`web3._utils.events.get_event_data` works out the input types, the indexed/non-indexed split,
+the argument names and the eth_abi decoders again for every log it decodes. Here all of that
+is done once per event when the scanner starts, decoding a log is then one dict lookup on
+(address, topic0) and two eth_abi tuple decodes.
+"""
+import logging
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+from eth_abi.decoding import ContextFramesBytesIO, TupleDecoder
+from eth_hash.auto import keccak
+from eth_utils import event_abi_to_log_topic, to_bytes
+from pipe import select, where
+from web3._utils.abi import (
+    exclude_indexed_event_inputs,
+    get_abi_input_names,
+    get_indexed_event_inputs,
+    map_abi_data,
+    normalize_event_input_types,
+)
+from web3._utils.events import get_event_abi_types_for_decoding
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.datastructures import AttributeDict
+from web3.exceptions import InvalidEventABI, LogTopicError
+
+logger = logging.getLogger(__name__)
+
+# The same accounts show up in most of the logs of a token
+CHECKSUM_CACHE_SIZE = 100000
+
+ADDRESS_PADDING = bytes(12)
+
+
+def _to_bytes(value) -> bytes:
+    return to_bytes(hexstr=value) if isinstance(value, str) else bytes(value)
+
+
+@lru_cache(maxsize=CHECKSUM_CACHE_SIZE)
+def _to_checksum_address(address: bytes) -> str:
+    """EIP-55 checksum of a 20 bytes address, without the input checks of `eth_utils`."""
+    hex_address = address.hex()
+    hashed_address = keccak(hex_address.encode()).hex()
+    return "0x" + "".join(
+        character.upper() if int(hashed, 16) > 7 else character
+        for character, hashed in zip(hex_address, hashed_address)
+    )
+
+
+def _get_normalizer(type_str) -> Optional[Callable]:
+    """What `BASE_RETURN_NORMALIZERS` does to a value of that type, None when it leaves it as is."""
+    if "address" not in type_str:
+        return None
+    if type_str == "address":
+        return lambda value: _to_checksum_address(bytes.fromhex(value[2:]))
+    return lambda value: map_abi_data(BASE_RETURN_NORMALIZERS, [type_str], [value])[0]
+
+
+def _decode_address_word(word: bytes):
+    if word[:12] != ADDRESS_PADDING:
+        return None
+    return _to_checksum_address(word[12:])
+
+
+# Types that take exactly one 32 bytes word, decoded without going through eth_abi.
+# A decoder returns None when the word is not valid for it, eth_abi then decodes it and raises.
+WORD_DECODERS = {
+    "address": _decode_address_word,
+    "uint256": lambda word: int.from_bytes(word, "big"),
+    "int256": lambda word: int.from_bytes(word, "big", signed=True),
+    "bytes32": bytes,
+}
+
+
+class _ArgumentsDecoder:
+    """Decodes a run of ABI encoded values into (name, value) pairs."""
+
+    def __init__(self, codec, names: List[str], types: List[str]):
+        self.names = names
+        self.types = types
+        self.decoder = TupleDecoder(
+            decoders=tuple(types | select(codec._registry.get_decoder))
+        )
+        self.normalizers = list(
+            enumerate(types | select(_get_normalizer))
+            | where(lambda item: item[1] is not None)
+        )
+        # Most events, eg. Transfer and Approval, only have one word types
+        self.word_decoders = None
+        if all(types | select(lambda type_str: type_str in WORD_DECODERS)):
+            self.word_decoders = list(types | select(WORD_DECODERS.get))
+
+    def _decode_words(self, data: bytes) -> Optional[list]:
+        if len(data) != 32 * len(self.word_decoders):
+            return None
+        values = []
+        for position, word_decoder in enumerate(self.word_decoders):
+            value = word_decoder(data[32 * position: 32 * (position + 1)])
+            if value is None:
+                return None
+            values.append(value)
+        return values
+
+    def __call__(self, data: bytes) -> List[Tuple[str, object]]:
+        if self.word_decoders is not None:
+            values = self._decode_words(data)
+            if values is not None:
+                return list(zip(self.names, values))
+
+        values = list(self.decoder(ContextFramesBytesIO(data)))
+        for position, normalizer in self.normalizers:
+            values[position] = normalizer(values[position])
+        return list(zip(self.names, values))
+
+
+class EventDecoder:
+    """Decodes the logs of one event into the same records `get_event_data` makes."""
+
+    def __init__(self, codec, event_abi: dict):
+        self.event_name = event_abi["name"]
+        self.topic = event_abi_to_log_topic(event_abi)
+
+        topics_abi = get_indexed_event_inputs(event_abi)
+        data_abi = exclude_indexed_event_inputs(event_abi)
+        self.topics_decoder = _ArgumentsDecoder(
+            codec,
+            get_abi_input_names({"inputs": topics_abi}),
+            list(get_event_abi_types_for_decoding(normalize_event_input_types(topics_abi))),
+        )
+        self.data_decoder = _ArgumentsDecoder(
+            codec,
+            get_abi_input_names({"inputs": data_abi}),
+            list(get_event_abi_types_for_decoding(normalize_event_input_types(data_abi))),
+        )
+
+        duplicate_names = set(self.topics_decoder.names).intersection(self.data_decoder.names)
+        if duplicate_names:
+            raise InvalidEventABI(
+                "The following argument names are duplicated "
+                f"between event inputs: '{', '.join(duplicate_names)}'"
+            )
+
+    def __call__(self, log) -> AttributeDict:
+        topics = log["topics"][1:]
+        if len(topics) != len(self.topics_decoder.types):
+            raise LogTopicError(
+                f"Expected {len(self.topics_decoder.types)} log topics.  Got {len(topics)}"
+            )
+
+        # Indexed values are always 32 bytes, so the topics decode as one static tuple
+        args = self.topics_decoder(b"".join(topics | select(_to_bytes)))
+        args.extend(self.data_decoder(_to_bytes(log["data"])))
+
+        return AttributeDict({
+            "args": AttributeDict(dict(args)),
+            "event": self.event_name,
+            "logIndex": log["logIndex"],
+            "transactionIndex": log["transactionIndex"],
+            "transactionHash": log["transactionHash"],
+            "address": log["address"],
+            "blockHash": log["blockHash"],
+            "blockNumber": log["blockNumber"],
+        })
+
+
+class LogDecoder:
+    """The event decoders of a set of contracts, keyed by (address, topic0)."""
+
+    def __init__(self, codec, contracts):
+        self.decoders: Dict[Tuple[str, bytes], EventDecoder] = {}
+        for contract in contracts:
+            event_decoders = list(
+                contract.event_table.by_topic.values()
+                | select(lambda abi: EventDecoder(codec, abi))
+            )
+            for event_decoder in event_decoders:
+                # The nodes send checksummed addresses back, some send them lowercased
+                for address in {contract.contract_address, contract.contract_address.lower()}:
+                    self.decoders[(address, event_decoder.topic)] = event_decoder
+
+    def decode(self, log) -> AttributeDict:
+        topic0 = log["topics"][0]
+        if isinstance(topic0, str):
+            topic0 = to_bytes(hexstr=topic0)
+        return self.decoders[(log["address"], topic0)](log)
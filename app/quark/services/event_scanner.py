@@ -2,9 +2,8 @@ import sys
 import json
 import importlib
 from web3 import Web3
-from web3.providers.rpc import HTTPProvider
-from web3.middleware import geth_poa_middleware
 from pipe import select, chain, dedup, sort, where, concat
+from django.db import transaction
 from django.db.models import Max
 from texttable import Texttable
 # We use tqdm library to render a nice progress bar in the console
@@ -13,7 +12,10 @@ from tqdm import tqdm
 import pandas as pd
 import logging
 import datetime
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
 from typing import Tuple, Optional, Callable, List, Iterable
 
@@ -23,6 +25,20 @@ from web3.datastructures import AttributeDict
 from web3.exceptions import BlockNotFound
 from eth_abi.codec import ABICodec
 from ..config import CHAIN
+from ..models import Block, ScanCheckpoint, Txn
+from .block_service import BLOCK_BATCH_SIZE, get_block_headers, get_block_timestamps
+from .block_timestamp_service import get_block_timestamp_store
+from .loader_service import get_loader
+from .chunk_size_service import ChunkSizeController, estimate_payload_bytes, is_response_too_large
+from .decoder_service import LogDecoder
+from .provider_service import get_web3
+from .reorg_service import (
+    check_block_hashes,
+    find_fork_block,
+    forget_block_hashes,
+    get_hash_window_start,
+    record_block_hashes,
+)
 
 # Currently this method is not exposed over official web3 API,
 # but we need it to construct eth_getLogs parameters
@@ -59,7 +75,12 @@ def log_table(data, columns):
     table.add_rows(rows)
     logger.info(f"\n{table.draw()}")
 
-def update_events(contracts, index):
+def update_events(contracts, index, loader="bulk"):
+    """Scan the events of the contracts of one environment of an index.
+
+    :param loader: How the events are written to the db, "bulk" for the incremental runs,
+        "copy" for full reindexes, "orm" for the old event by event path
+    """
     logger.info("Starting the event scan for following contracts...")
 
     log_table(
@@ -76,18 +97,13 @@ def update_events(contracts, index):
         ['contract_address', 'environment', 'abi_path']
     )
 
-    provider = HTTPProvider(contracts[0].chain['provider'])
-
-    # Remove the default JSON-RPC retry middleware
+    # Without the default JSON-RPC retry middleware
     # as it correctly cannot handle eth_getLogs block range
     # throttle down.
-    provider.middlewares.clear()
-
-    web3 = Web3(provider)
-    web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    web3 = get_web3(contracts[0].environment, retry=False)
 
     # Restore/create our persistent state
-    state = DBState(contracts, index)
+    state = DBState(contracts, index, loader=loader)
 
     # chain_id: int, web3: Web3, abi: dict, state: EventScannerState, events: List, filters: {}, max_chunk_scan_size: int=10000
     scanner = EventScanner(
@@ -96,37 +112,44 @@ def update_events(contracts, index):
         contracts=contracts,
         # How many maximum blocks at the time we request from JSON-RPC
         # and we are unlikely to exceed the response size limit of the JSON-RPC server
-        max_chunk_scan_size=contracts[0].chain["max_chunk_scan_size"]
+        max_chunk_scan_size=contracts[0].chain["max_chunk_scan_size"],
+        # Ask for all the topics of a chunk in a single eth_getLogs call
+        batch_topics=contracts[0].chain.get("batch_topics", True),
+        # How many `eth_getLogs` block ranges we keep in-flight at the same time
+        max_parallel_requests=contracts[0].chain.get("max_parallel_requests", 1)
     )
 
-    # # Assume we might have scanned the blocks all the way to the last Ethereum block
-    # # that mined a few seconds before the previous scan run ended.
-    # # Because there might have been a minor Etherueum chain reorganisations
-    # # since the last scan ended, we need to discard
-    # # the last few blocks from the previous scan results.
-    # chain_reorg_safety_blocks = 10
-    # scanner.delete_potentially_forked_block_data(state.get_last_scanned_block() - chain_reorg_safety_blocks)
-
-    # # Scan from [last block scanned] - [latest ethereum block]
-    # # Note that our chain reorg safety blocks cannot go negative
-    # start_block = max(state.get_last_scanned_block() - chain_reorg_safety_blocks, 0)
+    # There might have been a chain reorganisation since the last scan ended,
+    # roll back the events of the blocks that are not on the chain anymore
+    scanner.delete_potentially_forked_block_data()
 
-    start_block = max(state.get_last_scanned_block(), 0)
+    start_block = max(state.get_last_scanned_block() + 1, 0)
     end_block = scanner.get_suggested_scan_end_block()
     blocks_to_scan = end_block - start_block
 
+    if start_block > end_block:
+        logger.info(f"Already scanned up to block {end_block}")
+        return
+
     logger.info(f"Scanning events for blocks: {start_block}-{end_block}")
 
     # Render a progress bar in the console
     start = time.time()
 
-    # Run the scan
-    result, total_chunks_scanned = scanner.scan(start_block, end_block)
+    # Run the scan, one chunk at a time
+    total_events = total_chunks_scanned = 0
+    for summary in scanner.scan_iter(start_block, end_block):
+        total_events += summary["events"]
+        total_chunks_scanned += 1
 
     state.save()
     duration = time.time() - start
     logger.info(
-        f"Scanned total {len(result)} events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed"
+        f"Scanned total {total_events} events, in {duration} seconds, total {total_chunks_scanned} chunk scans performed"
+    )
+    logger.info(
+        f"Loaded {state.loader.rows_loaded} events with the {loader} loader "
+        f"in {round(state.loader.load_duration, 2)} seconds ({state.loader.rows_per_second} rows/s)"
     )
 
 
@@ -196,7 +219,8 @@ class EventScanner:
     """
 
     def __init__(self, web3: Web3, state: EventScannerState, contracts,
-                 max_chunk_scan_size: int = 5000, max_request_retries: int = 30, request_retry_seconds: float = 3.0):
+                 max_chunk_scan_size: int = 5000, max_request_retries: int = 30, request_retry_seconds: float = 3.0,
+                 batch_topics: bool = True, max_parallel_requests: int = 1):
         """
         :param contract: Contract
         :param events: List of web3 Event we scan
@@ -204,6 +228,8 @@ class EventScanner:
         :param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
         :param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
         :param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+        :param batch_topics: Fetch all the topics of a chunk in one `eth_getLogs` call instead of one call per topic
+        :param max_parallel_requests: How many chunks we fetch at the same time, 1 scans the chunks one after another
         """
 
         self.logger = logger
@@ -219,18 +245,15 @@ class EventScanner:
             )
         )
 
-        def get_filters(_contract):
-            return list(
-                _contract.get_all_event_names()
-                | select(lambda event_name: _contract.get_topic(event_name))
-            )
-
+        # Only the events each contract selected for scanning
         self.topics = list(
             contracts
-            | select(get_filters)
+            | select(lambda _contract: _contract.event_table.selected_topics)
             | chain
             | dedup
         )
+        if not self.topics:
+            logger.warning(f"No events selected for {list(self.contract_mapping)}, nothing to scan")
 
         # self.filters={
         #     "address": list(
@@ -240,17 +263,31 @@ class EventScanner:
         # }
 
         # Our JSON-RPC throttling parameters
-        self.min_scan_chunk_size = 1000  # 12 s/block = 120 seconds period
         self.max_scan_chunk_size = max_chunk_scan_size
         self.max_request_retries = max_request_retries
         self.request_retry_seconds = request_retry_seconds
+        self.batch_topics = batch_topics
+        self.max_parallel_requests = max(1, max_parallel_requests)
+
+        self.provider = getattr(self.web3.provider, "endpoint_uri", self.chain["provider"])
+
+        # Block timestamps we already know, shared with the other workers
+        self.block_timestamp_store = get_block_timestamp_store(self.contracts[0].environment)
 
-        # Factor how fast we increase the chunk size if results are found
-        # # (slow down scan after starting to get hits)
-        self.chunk_size_decrease = 0.5
+        # Compile the event decoders of all the contracts once
+        self.log_decoder = LogDecoder(web3.codec, contracts)
 
-        # Factor how was we increase chunk size if no results found
-        self.chunk_size_increase = 2.0
+        # Learns how many blocks the provider serves per `eth_getLogs`
+        self.chunk_size_controller = ChunkSizeController(
+            provider=self.provider,
+            max_chunk_size=max_chunk_scan_size
+        )
+
+        # First block of the running scan whose hash is kept to find the forks, and the hashes
+        # fetched with the chunks, until their chunk is handed over to the state
+        self.hash_window_start = None
+        self.block_hashes = {}
+        self.block_hashes_lock = threading.Lock()
 
     @property
     def address(self):
@@ -267,20 +304,43 @@ class EventScanner:
         last_time = block_info["timestamp"]
         return datetime.datetime.utcfromtimestamp(last_time)
 
+    def get_block_timestamps(self, block_numbers) -> dict:
+        """Get the timestamps of all the distinct blocks of a chunk.
+
+        Blocks already in the environment's block timestamp store are not fetched again.
+        The rest of the headers are fetched in parallel JSON-RPC batches, without transaction bodies,
+        and added to the store. Falls back to one `eth_getBlock` per block if the node doesn't take batches.
+        """
+        block_timestamps = self.block_timestamp_store.get_timestamps(set(block_numbers))
+        missing_block_numbers = list(
+            set(block_numbers)
+            | where(lambda block_number: block_number not in block_timestamps)
+        )
+        if not missing_block_numbers:
+            return block_timestamps
+
+        try:
+            fetched = get_block_timestamps(
+                self.provider,
+                missing_block_numbers,
+                batch_size=self.chain.get("block_batch_size", BLOCK_BATCH_SIZE)
+            )
+        except Exception as e:
+            logger.warning(f"Batched block lookup failed with {e}, fetching blocks one by one")
+            fetched = {}
+            for block_number in missing_block_numbers:
+                fetched[block_number] = self.get_block_timestamp(block_number)
+
+        self.block_timestamp_store.set_timestamps(fetched)
+        block_timestamps.update(fetched)
+        return block_timestamps
+
     def get_suggested_scan_start_block(self):
         """Get where we should start to scan for new token events.
 
-        If there are no prior scans, start from block 1.
-        Otherwise, start from the last end block minus ten blocks.
-        We rescan the last ten scanned blocks in the case there were forks to avoid
-        misaccounting due to minor single block works (happens once in a hour in Ethereum).
-        These heurestics could be made more robust, but this is for the sake of simple reference implementation.
+        The block after the last one the state has committed.
         """
-
-        end_block = self.get_last_scanned_block()
-        if end_block:
-            return max(end_block, self.chain['min_block_number'])
-        return 1
+        return self.get_last_scanned_block() + 1
 
     def get_suggested_scan_end_block(self):
         """Get the last mined block on Ethereum chain we are following."""
@@ -293,173 +353,335 @@ class EventScanner:
     def get_last_scanned_block(self) -> int:
         return self.state.get_last_scanned_block()
 
-    # def delete_potentially_forked_block_data(self, after_block: int):
-    #     """Purge old data in the case of blockchain reorganisation."""
-    #     self.state.delete_data(after_block)
+    def delete_potentially_forked_block_data(self):
+        """Purge the data of the blocks a blockchain reorganisation dropped.
 
-    def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
-        """Read and process events between to block numbers.
+        :return: The first block of the fork, None without a fork
+        """
+        fork_block = find_fork_block(self.state.index, self.state.environment, self.provider)
+        if fork_block is not None:
+            logger.warning(
+                f"Chain reorganisation on {self.state.environment} from block {fork_block}"
+            )
+            self.state.delete_data(fork_block)
+            self.block_timestamp_store.forget(fork_block)
+        return fork_block
+
+    def get_block_hashes(self, start_block, end_block) -> dict:
+        """Hashes of the blocks between two block numbers that are in the hash window of the scan."""
+        if self.hash_window_start is None or end_block < self.hash_window_start:
+            return {}
+
+        headers = get_block_headers(
+            self.provider,
+            range(max(start_block, self.hash_window_start), end_block + 1),
+            batch_size=self.chain.get("block_batch_size", BLOCK_BATCH_SIZE)
+        )
+        return {
+            block_number: header["hash"]
+            for block_number, header in headers.items()
+            if header
+        }
+
+    def pop_block_hashes(self, start_block, end_block) -> dict:
+        """The hashes fetched with a chunk, to be recorded along with it."""
+        with self.block_hashes_lock:
+            block_numbers = list(
+                self.block_hashes
+                | where(lambda block_number: start_block <= block_number <= end_block)
+            )
+            return {block_number: self.block_hashes.pop(block_number) for block_number in block_numbers}
+
+    def record_block_hashes(self, start_block, end_block):
+        """Keep the hashes of a chunk before it is committed, so a fork of its blocks is found by the next scan."""
+        record_block_hashes(self.state.index, self.state.environment, self.pop_block_hashes(start_block, end_block))
+
+    def get_topic_groups(self) -> List[list]:
+        """Topics of every `eth_getLogs` call of a chunk.
+
+        Either one OR-list of every topic or a single topic per request,
+        no call at all without topics as an empty topic0 list matches every log of the contracts.
+        """
+        if not self.topics:
+            return []
+        if self.batch_topics:
+            return [self.topics]
+        return list(self.topics | select(lambda topic: [topic]))
+
+    def fetch_chunk(self, start_block, end_block) -> Tuple[int, list, dict]:
+        """Fetch the events and block timestamps between two block numbers.
+
+        Only talks to the JSON-RPC server and never touches the state,
+        so it can be run from a worker thread.
 
         Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
 
-        :return: tuple(actual end block number, when this block was mined, processed events)
+        :return: tuple(actual end block number, events, block timestamps)
+        :raises: ChainReorganisedError when the chain changed while the chunk was fetched
         """
 
-        block_timestamps = {}
-        get_block_timestamp = self.get_block_timestamp
+        events = []
+        hashes_before = self.get_block_hashes(start_block, end_block)
 
-        # Cache block timestamps to reduce some RPC overhead
-        # Real solution might include smarter models around block
-        def get_block_when(block_num):
-            if block_num not in block_timestamps:
-                block_timestamps[block_num] = get_block_timestamp(block_num)
-            return block_timestamps[block_num]
+        for topics in self.get_topic_groups():
+            # logger.info(f"Scanning topics {topics}")
+            response = {}
 
-        all_processed = []
+            def _on_response(logs):
+                response["payload_bytes"] += estimate_payload_bytes(logs)
 
-        for topic in self.topics:
-            # logger.info(f"Scanning topic {topic}")
             # Callable that takes care of the underlying web3 call
             def _fetch_events(_start_block, _end_block):
-                return _fetch_events_for_all_contracts(
+                response.update(payload_bytes=0, start=time.time())
+                topic_events = _fetch_events_for_topics(
                     self.web3,
-                    topic,
+                    topics,
                     self.contract_mapping,
                     from_block=_start_block,
-                    to_block=_end_block
+                    to_block=_end_block,
+                    on_response=_on_response,
+                    log_decoder=self.log_decoder
                 )
+                response["latency"] = time.time() - response["start"]
+                return topic_events
 
             # Do `n` retries on `eth_getLogs`,
             # throttle down block range if needed
-            end_block, events = _retry_web3_call(
+            end_block, topic_events = _retry_web3_call(
                 _fetch_events,
                 start_block=start_block,
                 end_block=end_block,
                 retries=self.max_request_retries,
-                delay=self.request_retry_seconds
+                delay=self.request_retry_seconds,
+                on_failure=self.chunk_size_controller.on_failure
             )
+            events += topic_events
 
-            for evt in events:
-                # Integer of the log index position in the block, null when its pending
-                idx = evt["logIndex"]
+            self.chunk_size_controller.on_success(
+                block_range=end_block - start_block,
+                log_count=len(topic_events),
+                payload_bytes=response["payload_bytes"],
+                latency=response["latency"]
+            )
 
-                # We cannot avoid minor chain reorganisations, but
-                # at least we must avoid blocks that are not mined yet
-                assert idx is not None, "Somehow tried to scan a pending block"
+        # An earlier topic group might have been fetched over a wider range
+        # than the one we ended up with
+        events = list(
+            events
+            | where(lambda evt: evt["blockNumber"] <= end_block)
+        )
 
-                block_number = evt["blockNumber"]
+        block_hashes = self.get_block_hashes(start_block, end_block)
+        check_block_hashes(hashes_before, block_hashes, events)
+        with self.block_hashes_lock:
+            self.block_hashes.update(block_hashes)
 
-                # Get UTC time when this event happened (block mined timestamp)
-                # from our in-memory cache
-                block_when = get_block_when(block_number)
+        block_timestamps = self.get_block_timestamps(
+            [*(events | select(lambda evt: evt["blockNumber"])), end_block]
+        )
 
-                processed = self.state.process_event(block_when, evt)
-                all_processed.append(processed)
+        return end_block, events, block_timestamps
 
-        end_block_timestamp = get_block_when(end_block)
-        return end_block, end_block_timestamp, all_processed
+    def process_chunk(self, end_block, events, block_timestamps) -> Tuple[int, datetime.datetime, list]:
+        """Hand the fetched events of a chunk over to the state, in the chain order.
 
-    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
-        """Try to figure out optimal chunk size
+        :return: tuple(actual end block number, when this block was mined, processed events)
+        """
 
-        Our scanner might need to scan the whole blockchain for all events
+        all_processed = []
 
-        * We want to minimize API calls over empty blocks
+        for evt in events:
+            # Integer of the log index position in the block, null when its pending
+            idx = evt["logIndex"]
 
-        * We want to make sure that one scan chunk does not try to process too many entries once, as we try to control commit buffer size and potentially asynchronous busy loop
+            # We cannot avoid minor chain reorganisations, but
+            # at least we must avoid blocks that are not mined yet
+            assert idx is not None, "Somehow tried to scan a pending block"
 
-        * Do not overload node serving JSON-RPC API by asking data for too many events at a time
+            # Get UTC time when this event happened (block mined timestamp)
+            # from our in-memory cache
+            block_when = block_timestamps[evt["blockNumber"]]
 
-        Currently Ethereum JSON-API does not have an API to tell when a first event occurred in a blockchain
-        and our heuristics try to accelerate block fetching (chunk size) until we see the first event.
+            processed = self.state.process_event(block_when, evt)
+            all_processed.append(processed)
 
-        These heurestics exponentially increase the scan chunk size depending on if we are seeing events or not.
-        When any transfers are encountered, we are back to scanning only a few blocks at a time.
-        It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
-        """
+        return end_block, block_timestamps[end_block], all_processed
 
-        if event_found_count > 0:
-            # When we encounter first events, reset the chunk size window
-            current_chuck_size *= self.chunk_size_increase
-        else:
-            current_chuck_size *= self.chunk_size_increase
+    def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
+        """Read and process events between to block numbers.
 
-        current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-        current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-        return int(current_chuck_size)
+        Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
 
-    def scan(self, start_block, end_block, progress_callback=Optional[Callable]) -> Tuple[
-            list, int]:
-        """Perform a token balances scan.
+        :return: tuple(actual end block number, when this block was mined, processed events)
+        """
+        return self.process_chunk(*self.fetch_chunk(start_block, end_block))
 
-        Assumes all balances in the database are valid before start_block (no forks sneaked in).
+    def fetch_chunks_in_parallel(self, start_block, end_block) -> Iterable[Tuple[int, int, list, dict]]:
+        """Fetch the chunks of a block range with `max_parallel_requests` in-flight `eth_getLogs` calls.
 
-        :param start_block: The first block included in the scan
+        The chunks are yielded strictly in block order, whatever order the requests finish in.
+        If the node made us throttle down the range of a chunk, the rest of that range
+        is fetched before moving on to the next chunk.
 
-        :param end_block: The last block included in the scan
+        :return: Iterator of (start block, actual end block, events, block timestamps)
+        """
 
-        :param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
+        def _ranges():
+            current_block = start_block
+            while current_block <= end_block:
+                # Whatever the controller learned from the chunks fetched so far
+                chunk_end = min(current_block + self.chunk_size_controller.chunk_size, end_block)
+                yield current_block, chunk_end
+                current_block = chunk_end + 1
+
+        ranges = _ranges()
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel_requests) as executor:
+
+            def submit_next():
+                block_range = next(ranges, None)
+                if block_range:
+                    pending.append(
+                        (block_range, executor.submit(self.fetch_chunk, *block_range))
+                    )
+
+            for _ in range(self.max_parallel_requests):
+                submit_next()
+
+            try:
+                while pending:
+                    (chunk_start, chunk_end), future = pending.popleft()
+                    actual_end_block, events, block_timestamps = future.result()
+                    submit_next()
+                    yield chunk_start, actual_end_block, events, block_timestamps
+
+                    while actual_end_block < chunk_end:
+                        chunk_start = actual_end_block + 1
+                        actual_end_block, events, block_timestamps = self.fetch_chunk(
+                            chunk_start, chunk_end
+                        )
+                        yield chunk_start, actual_end_block, events, block_timestamps
+            finally:
+                # Don't wait on requests nobody is going to process
+                for _, future in pending:
+                    future.cancel()
+
+    def fetch_chunks_serially(self, start_block, end_block) -> Iterable[Tuple[int, int, list, dict]]:
+        """Fetch the chunks of a block range one after another.
+
+        The size of every chunk is whatever the chunk size controller learned from the previous ones.
+
+        :return: Iterator of (start block, actual end block, events, block timestamps)
+        """
+        current_block = start_block
 
-        :param progress_callback: If this is an UI application, update the progress of the scan
+        while current_block <= end_block:
+            estimated_end_block = min(
+                current_block + self.chunk_size_controller.chunk_size, end_block
+            )
+            actual_end_block, events, block_timestamps = self.fetch_chunk(
+                current_block,
+                estimated_end_block
+            )
+            yield current_block, actual_end_block, events, block_timestamps
 
-        :return: [All processed events, number of chunks used]
-        """
+            # Set where the next chunk starts
+            current_block = actual_end_block + 1
 
+    def _scan_chunks(self, start_block, end_block) -> Iterable[Tuple[dict, list]]:
         assert start_block <= end_block
+        self.hash_window_start = get_hash_window_start(self.contracts[0].environment, end_block)
+        self.block_hashes = {}
 
-        current_block = start_block
-
-        # Scan in chunks, commit between
-        chunk_size = self.max_scan_chunk_size
-        last_scan_duration = last_logs_found = 0
-        total_chunks_scanned = 0
+        if self.max_parallel_requests > 1:
+            chunks = self.fetch_chunks_in_parallel(start_block, end_block)
+        else:
+            chunks = self.fetch_chunks_serially(start_block, end_block)
 
-        # All processed entries we got on this scan cycle
-        all_processed = []
+        last_scan_duration = 0
+        start = time.time()
 
-        while current_block <= end_block:
+        for chunk_start, actual_end_block, events, block_timestamps in chunks:
+            fetch_duration = time.time() - start
 
-            self.state.start_chunk(current_block, chunk_size)
+            self.state.start_chunk(chunk_start, actual_end_block - chunk_start)
 
             # Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-            estimated_end_block = min(current_block + chunk_size, end_block)
             logger.info(
                 f"{'-' * 80}\n"
-                f"Scanning events for blocks: {current_block}-{estimated_end_block}\n"
-                f"chunk_size: {estimated_end_block - current_block}\n"
+                f"Scanning events for blocks: {chunk_start}-{actual_end_block}\n"
+                f"chunk_size: {actual_end_block - chunk_start}\n"
                 f"last_chunk_scan took: {round(last_scan_duration, 2)}"
-                # f"last logs found {last_logs_found}"
             )
 
-            start = time.time()
-            actual_end_block, end_block_timestamp, new_entries = self.scan_chunk(
-                current_block,
-                estimated_end_block
+            process_start = time.time()
+            _, end_block_timestamp, new_entries = self.process_chunk(
+                actual_end_block,
+                events,
+                block_timestamps
             )
+            self.record_block_hashes(chunk_start, actual_end_block)
+            self.state.end_chunk(actual_end_block)
 
-            # logger.info("Found the following entries...")
-            # for entry in new_entries:
-            #     logger.info(entry)
+            last_scan_duration = time.time() - start
+            summary = {
+                "start_block": chunk_start,
+                "end_block": actual_end_block,
+                "end_block_timestamp": end_block_timestamp,
+                "events": len(new_entries),
+                "fetch_duration": fetch_duration,
+                "process_duration": time.time() - process_start,
+            }
+            yield summary, new_entries
+            start = time.time()
 
-            # Where does our current chunk scan ends - are we out of chain yet?
-            current_end = actual_end_block
+    def scan_iter(self, start_block, end_block) -> Iterable[dict]:
+        """Perform the scan, yielding a summary of every chunk once it is committed to the state.
 
-            last_scan_duration = time.time() - start
-            all_processed += new_entries
+        Nothing is kept around between chunks, so memory use stays flat however long the range is.
 
-            # Try to guess how many blocks to fetch over `eth_getLogs` API next time
-            chunk_size = self.estimate_next_chunk_size(
-                chunk_size, len(new_entries))
+        :param start_block: The first block included in the scan
 
-            # Set where the next chunk starts
-            current_block = current_end + 1
+        :param end_block: The last block included in the scan
+
+        :return: Iterator of {start_block, end_block, end_block_timestamp, events, fetch_duration, process_duration}
+        """
+        for summary, _ in self._scan_chunks(start_block, end_block):
+            yield summary
+
+    def scan(self, start_block, end_block, progress_callback=Optional[Callable]) -> Tuple[
+            list, int]:
+        """Perform a token balances scan.
+
+        Assumes all balances in the database are valid before start_block (no forks sneaked in).
+
+        Keeps every processed event of the range in memory, use `scan_iter` for long ranges.
+
+        :param start_block: The first block included in the scan
+
+        :param end_block: The last block included in the scan
+
+        :param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
+
+        :param progress_callback: If this is an UI application, update the progress of the scan
+
+        :return: [All processed events, number of chunks used]
+        """
+
+        total_chunks_scanned = 0
+
+        # All processed entries we got on this scan cycle
+        all_processed = []
+
+        for _, new_entries in self._scan_chunks(start_block, end_block):
+            all_processed += new_entries
             total_chunks_scanned += 1
-            self.state.end_chunk(current_end)
 
         return all_processed, total_chunks_scanned
 
 
-def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
+def _retry_web3_call(func, start_block, end_block, retries, delay, on_failure: Optional[Callable] = None) -> Tuple[int, list]:
     """A custom retry loop to throttle down block range.
 
     If our JSON-RPC server cannot serve all incoming `eth_getLogs` in a single request,
@@ -473,6 +695,8 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
     :param end_block: The initial start block of the block range
     :param retries: How many times we retry
     :param delay: Time to sleep between retries
+    :param on_failure: Called as on_failure(block range, error) and returns the block range to retry with,
+        halves the range by default
     """
     for i in range(retries):
         try:
@@ -491,7 +715,10 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
                     e,
                     delay)
                 # Decrease the `eth_getBlocks` range
-                end_block = start_block + ((end_block - start_block) // 2)
+                if on_failure:
+                    end_block = start_block + on_failure(end_block - start_block, e)
+                else:
+                    end_block = start_block + ((end_block - start_block) // 2)
                 # Let the JSON-RPC to recover e.g. from restart
                 time.sleep(delay)
                 continue
@@ -500,6 +727,55 @@ def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int,
                 raise
 
 
+def _fetch_events_for_topics(
+        web3,
+        topics,
+        contract_mapping,
+        from_block: int,
+        to_block: int,
+        on_response: Optional[Callable] = None,
+        log_decoder: Optional[LogDecoder] = None) -> list:
+    """Get the events of all the topics with as few `eth_getLogs` calls as possible.
+
+    All the topics go out in a single call as a topic0 OR-list.
+    The topic set is only split in halves when the node rejects the response size,
+    if a single topic is still too large the error bubbles up to `_retry_web3_call`
+    which throttles down the block range.
+    """
+    try:
+        return _fetch_events_for_all_contracts(
+            web3,
+            topics,
+            contract_mapping,
+            from_block=from_block,
+            to_block=to_block,
+            on_response=on_response,
+            log_decoder=log_decoder
+        )
+    except Exception as e:
+        if len(topics) < 2 or not is_response_too_large(e):
+            raise
+
+    middle = len(topics) // 2
+    logger.info(
+        f"Splitting {len(topics)} topics for block range {from_block} - {to_block}"
+    )
+    events = [
+        *_fetch_events_for_topics(
+            web3, topics[:middle], contract_mapping, from_block, to_block, on_response, log_decoder
+        ),
+        *_fetch_events_for_topics(
+            web3, topics[middle:], contract_mapping, from_block, to_block, on_response, log_decoder
+        ),
+    ]
+
+    # Keep the chain order as if it was a single call
+    return sorted(
+        events,
+        key=lambda evt: (evt["blockNumber"], evt["logIndex"])
+    )
+
+
 def get_event_abi(contract_mapping, topic0, address):
     contract_instance = contract_mapping.get(
         address.lower()) or contract_mapping.get(address)
@@ -522,10 +798,12 @@ def decode_log(web3, contract_mapping, log):
 
 def _fetch_events_for_all_contracts(
         web3,
-        topic,
+        topics,
         contract_mapping,
         from_block: int,
-        to_block: int) -> Iterable:
+        to_block: int,
+        on_response: Optional[Callable] = None,
+        log_decoder: Optional[LogDecoder] = None) -> Iterable:
     """Get events using eth_getLogs API.
 
     This method is detached from any contract instance.
@@ -543,8 +821,12 @@ def _fetch_events_for_all_contracts(
         raise TypeError(
             "Missing mandatory keyword argument to getLogs: fromBlock")
 
+    if not topics:
+        raise ValueError("No topics to query, eth_getLogs would return every event of the contracts")
+
+    # A nested list in the topic0 position is OR-ed by the node
     event_filter_params = {
-        'topics': [topic],
+        'topics': [topics],
         'address': address_list,
         'fromBlock': from_block,
         'toBlock': to_block
@@ -553,14 +835,33 @@ def _fetch_events_for_all_contracts(
     logger.debug(
         "Querying eth_getLogs with the following parameters: %s", event_filter_params)
 
+    logs = web3.eth.get_logs(event_filter_params)
+    if on_response:
+        on_response(logs)
+
+    if log_decoder:
+        return list(logs | select(log_decoder.decode))
+
     all_events = list(
-        web3.eth.get_logs(event_filter_params)
+        logs
         | select(lambda log: decode_log(web3, contract_mapping, log))
     )
 
     return all_events
 
 
+# How many reference keys go in one `reference_key__in` query
+REFERENCE_KEY_BATCH_SIZE = 1000
+
+
+def _unreferenced_filter(model):
+    """Filter for the rows of `model` no other row refers to."""
+    return {
+        f"{relation.name}__isnull": True
+        for relation in model._meta.related_objects
+    }
+
+
 class DBState(EventScannerState):
     """
     Store the state of scanned blocks and all events.
@@ -569,11 +870,15 @@ class DBState(EventScannerState):
     Simple load/store massive JSON on start up.
     """
 
-    def __init__(self, contracts, index):
+    def __init__(self, contracts, index, loader="bulk"):
+        """
+        :param loader: How the events are written to the db, one of `loader_service.LOADERS`
+        """
         self.contracts = contracts
         self.environment = contracts[0].environment
         self.state = []
         self.index = index
+        self.loader = get_loader(loader, index)
 
         self.logs = None
         try:
@@ -588,6 +893,20 @@ class DBState(EventScannerState):
     def clear(self):
         self.state = []
 
+    def get_reference_key(self, _event):
+        return f"{self.environment}-{_event['block_number']}-{_event['transaction_index']}-{_event['log_index']}"
+
+    def get_saved_reference_keys(self, reference_keys) -> set:
+        """The reference keys that are already in the db, queried in batches to keep the `IN` lists small."""
+        saved_reference_keys = set()
+        for i in range(0, len(reference_keys), REFERENCE_KEY_BATCH_SIZE):
+            saved_reference_keys.update(
+                self.logs.objects
+                .filter(reference_key__in=reference_keys[i: i + REFERENCE_KEY_BATCH_SIZE])
+                .values_list("reference_key", flat=True)
+            )
+        return saved_reference_keys
+
     def save(self):
         """Save everything we have scanned so far to the db."""
 
@@ -598,27 +917,21 @@ class DBState(EventScannerState):
             )
         )
 
-        # Remove the pre-saved events
-        def get_reference_key(_event):
-            return f"{self.environment}-{_event['block_number']}-{_event['transaction_index']}-{_event['log_index']}"
-
-        reference_keys = list(
+        # Key every event once, this also drops the duplicates within the chunk
+        events_by_reference_key = dict(
             self.state
-            | select(get_reference_key)
+            | select(lambda _event: (self.get_reference_key(_event), _event))
         )
 
-        saved_reference_keys = list(
-            self.logs.objects
-            .filter(reference_key__in=reference_keys)
-            .values_list("reference_key", flat=True)
+        # Remove the pre-saved events
+        saved_reference_keys = self.get_saved_reference_keys(
+            list(events_by_reference_key.keys())
         )
 
         events_to_save = list(
-            self.state
-            | where(
-                lambda _event: get_reference_key(
-                    _event) not in saved_reference_keys
-            )
+            events_by_reference_key.items()
+            | where(lambda item: item[0] not in saved_reference_keys)
+            | select(lambda item: item[1])
             | sort(
                 key=lambda _event: (
                     _event['block_number'],
@@ -633,50 +946,167 @@ class DBState(EventScannerState):
             logger.info(f"Processing {len(events_to_save)} event...")
             log_table(events_to_save, ['event_name', 'block_number', 'transaction_index', 'log_index'])
 
-        for event in events_to_save:
-            contract_instance = contract_mapping.get(
-                event["address"].lower()
-            ) or contract_mapping.get(event["address"])
-            contract_instance.process_and_save(event)
+        if events_to_save:
+            self.loader.load(events_to_save, contract_mapping)
     #
     # EventScannerState methods implemented below
     #
 
     def get_last_scanned_block(self):
-        """The number of the last block we have stored."""
-        self.chain = CHAIN[self.contracts[0].environment]
+        """The last block scanned for all the contracts, from their checkpoints."""
+        checkpoints = dict(
+            ScanCheckpoint.objects
+            .filter(
+                index=self.index,
+                environment__environment=self.environment,
+                contract__address__in=list(
+                    self.contracts
+                    | select(lambda contract: contract.contract_address)
+                ),
+            )
+            .values_list("contract__address", "last_scanned_block")
+        )
+
+        unscanned_contracts = list(
+            self.contracts
+            | where(lambda contract: contract.contract_address not in checkpoints)
+        )
+        if unscanned_contracts:
+            last_scanned_block = self.get_legacy_last_scanned_block(unscanned_contracts)
+            for contract in unscanned_contracts:
+                checkpoints[contract.contract_address] = last_scanned_block
+
+        return min(checkpoints.values())
+
+    def get_legacy_last_scanned_block(self, contracts):
+        """Where to resume contracts that don't have a checkpoint yet.
+
+        The last block with a saved event is rescanned, it might have been saved
+        only partially. Without saved events, we start at `min_block_number`.
+        """
+        self.chain = CHAIN[self.environment]
+        min_block_number = self.chain.get('min_block_number') or 1
 
         end_block = self.logs.objects\
             .filter(
                 contract__address__in=list(
-                    self.contracts
+                    contracts
                     | select(lambda contract: contract.contract_address)
                 ),
-                txn__block__environment__environment=self.contracts[0].environment
+                txn__block__environment__environment=self.environment
             )\
             .aggregate(max_block_number=Max('txn__block__block_number'))\
             .pop('max_block_number')
 
         if end_block:
-            return max(end_block, self.chain['min_block_number'])
+            return max(end_block, min_block_number) - 1
 
-        if self.chain['min_block_number']:
-            return self.chain['min_block_number']
+        return min_block_number - 1
 
-        return 1
+    def save_checkpoint(self, block_number):
+        for contract in self.contracts:
+            ScanCheckpoint.objects.update_or_create(
+                index=self.index,
+                environment=contract.evironment_db_object,
+                contract=contract.contract_db_object,
+                defaults={"last_scanned_block": block_number},
+            )
+
+    def delete_data(self, since_block):
+        """Remove potentially reorganised blocks from the scan data.
 
-    # def delete_data(self, since_block):
-    #     """Remove potentially reorganised blocks from the scan data."""
-    #     for block_num in range(since_block, self.get_last_scanned_block()):
-    #         if block_num in self.state["blocks"]:
-    #             del self.state["blocks"][block_num]
+        The revert callbacks undo what was derived from the dropped events, then the events,
+        the txns and blocks nothing refers to anymore are deleted and the checkpoints
+        are moved back, all in one transaction.
+        """
+        contract_mapping = dict(
+            self.contracts
+            | select(lambda _contract: (_contract.contract_address, _contract))
+        )
+        logs = self.logs.objects.filter(
+            contract__address__in=list(contract_mapping),
+            txn__block__environment__environment=self.environment,
+            txn__block__block_number__gte=since_block,
+        )
+
+        with transaction.atomic():
+            dropped_events = list(
+                logs
+                .order_by(
+                    '-txn__block__block_number',
+                    '-txn__index',
+                    '-log_index',
+                )
+                .values(
+                    'data',
+                    'log_index',
+                    'contract__address',
+                    'event_name__event_name',
+                    'txn__hash',
+                    'txn__index',
+                    'txn__block__block_number',
+                    'txn__block__timestamp',
+                )
+                | select(
+                    lambda log: {
+                        "event_name": log['event_name__event_name'],
+                        "timestamp": log['txn__block__timestamp'],
+                        "log_index": log['log_index'],
+                        "transaction_index": log['txn__index'],
+                        "txhash": log['txn__hash'],
+                        "block_number": log['txn__block__block_number'],
+                        "address": log['contract__address'],
+                        "args": log['data'],
+                    }
+                )
+            )
+
+            events_by_contract = {}
+            for event in dropped_events:
+                events_by_contract\
+                    .setdefault((event["address"], event["event_name"]), [])\
+                    .append(event)
+            for (address, event_name), events in events_by_contract.items():
+                contract_mapping[address].execute_revert_callback(event_name, events)
+
+            logs.delete()
+
+            # Other indexes might still refer to the txns and blocks of the fork
+            blocks = Block.objects.filter(
+                environment__environment=self.environment,
+                block_number__gte=since_block,
+            )
+            Txn.objects\
+                .filter(block__in=blocks)\
+                .filter(**_unreferenced_filter(Txn))\
+                .delete()
+            blocks.filter(**_unreferenced_filter(Block)).delete()
+
+            ScanCheckpoint.objects.filter(
+                index=self.index,
+                environment__environment=self.environment,
+                contract__address__in=list(contract_mapping),
+                last_scanned_block__gte=since_block,
+            ).update(last_scanned_block=since_block - 1)
+            forget_block_hashes(self.index, self.environment, since_block)
+
+        logger.info(
+            f"Rolled back {len(dropped_events)} events of {self.index} on {self.environment} "
+            f"from block {since_block}"
+        )
 
     def start_chunk(self, block_number, chunk_size):
         self.clear()
 
     def end_chunk(self, block_number):
-        """Save at the end of each chunk, so we can resume in the case of a crash or CTRL+C"""
-        self.save()
+        """Save at the end of each chunk, so we can resume in the case of a crash or CTRL+C
+
+        The checkpoint moves in the same transaction as the events, so the chunks
+        without events are never scanned again either.
+        """
+        with transaction.atomic():
+            self.save()
+            self.save_checkpoint(block_number)
         self.clear()
 
     def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
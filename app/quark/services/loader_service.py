@@ -0,0 +1,354 @@
+"""Ways of writing the events of a chunk to the index tables.
+
+* `orm`: one event at a time through `Contract.process_and_save`, 5-8 queries per event.
+* `bulk`: the distinct blocks, txns and event names of the chunk are upserted with `bulk_create`,
+  their ids resolved in memory and the `TransactionLog` rows bulk-inserted, a few statements per chunk.
+* `copy`: the events are streamed into a staging table with `COPY FROM STDIN` and merged into
+  the tables with set-based SQL, for full reindexes.
+"""
+import csv
+import importlib
+import io
+import json
+import logging
+import time
+from collections import defaultdict
+
+import pytz
+from django.db import connection, transaction
+from pipe import select
+
+from common.exceptions import NotAcceptableError
+from .parse_service import parse
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT statement
+BULK_BATCH_SIZE = 1000
+
+
+def get_contract_for_event(contract_mapping, event):
+    return contract_mapping.get(event["address"].lower()) or contract_mapping.get(event["address"])
+
+
+def get_chain_position(event):
+    return event["block_number"], event["transaction_index"], event["log_index"]
+
+
+class ORMLoader:
+    """Saves every event with its own callback, in its own transaction.
+
+    The batch callbacks of the chunk run first. Their changes and the saves of their events
+    commit together, an event of theirs that can't be saved rolls the whole chunk back,
+    so the next scan doesn't apply the callbacks to it twice.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.index_models = importlib.import_module(f"{index}.models")
+        self.rows_loaded = 0
+        self.load_duration = 0.0
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows_loaded / self.load_duration, 2) if self.load_duration else 0
+
+    def load(self, events, contract_mapping):
+        """
+        :param events: The new events of a chunk, in chain order
+        :param contract_mapping: Contract address to `web3_service.Contract`
+        """
+        start = time.time()
+        self._load(events, contract_mapping)
+        self.rows_loaded += len(events)
+        self.load_duration += time.time() - start
+
+    def _load(self, events, contract_mapping):
+        contract_events = list(
+            events
+            | select(lambda event: (get_contract_for_event(contract_mapping, event), event))
+        )
+        if not any(contract_events | select(lambda item: item[0].batch_callbacks)):
+            for contract_instance, event in contract_events:
+                contract_instance.process_and_save(event)
+            return
+
+        with transaction.atomic():
+            contract_events = self.run_batch_callbacks(contract_events)
+            for contract_instance, event in contract_events:
+                if event["event_name"] in contract_instance.batch_callbacks:
+                    contract_instance.save_event(contract_instance.execute_callback(event))
+                else:
+                    contract_instance.process_and_save(event)
+
+    def run_batch_callbacks(self, contract_events):
+        """Run the batch callbacks, once per contract and event name of the chunk.
+
+        Each call runs in its own savepoint, the events of a call that fails
+        are logged and left out.
+
+        :return: List of (contract, event) to save, in chain order
+        """
+        batches = defaultdict(list)
+        result = []
+        for contract_instance, event in contract_events:
+            if event["event_name"] in contract_instance.batch_callbacks:
+                batches[(contract_instance, event["event_name"])].append(event)
+            else:
+                result.append((contract_instance, event))
+
+        if not batches:
+            return contract_events
+
+        for (contract_instance, event_name), events in batches.items():
+            try:
+                with transaction.atomic():
+                    events = contract_instance.execute_batch_callback(event_name, events)
+                result.extend(events | select(lambda event: (contract_instance, event)))
+            except Exception as e:
+                logger.exception(e)
+
+        return sorted(result, key=lambda item: get_chain_position(item[1]))
+
+
+class BulkLoader(ORMLoader):
+    """Saves all the events of a chunk in one transaction with a handful of statements."""
+
+    def _load(self, events, contract_mapping):
+        with transaction.atomic():
+            contract_events = self.run_callbacks(events, contract_mapping)
+            contract_events = self.run_batch_callbacks(contract_events)
+            if contract_events:
+                self.save(contract_events)
+
+    def run_callbacks(self, events, contract_mapping):
+        """Run the callbacks of every event in chain order.
+
+        Each callback runs in its own savepoint, an event whose callback fails
+        is logged and left out, same as with `Contract.process_and_save`.
+        Events without a callback don't open a savepoint.
+
+        :return: List of (contract, event) to save
+        """
+        contract_events = []
+        for event in events:
+            contract_instance = get_contract_for_event(contract_mapping, event)
+            if event["event_name"] not in contract_instance.callbacks:
+                contract_events.append((contract_instance, event))
+                continue
+            try:
+                with transaction.atomic():
+                    event = contract_instance.execute_callback(event)
+                contract_events.append((contract_instance, event))
+            except Exception as e:
+                logger.exception(e)
+        return contract_events
+
+    def save(self, contract_events):
+        models = self.index_models
+        contract_events = list(
+            contract_events
+            | select(lambda item: (item[0], parse(item[1])))
+        )
+        environment = contract_events[0][0].evironment_db_object
+
+        # Blocks
+        block_timestamps = {}
+        for _, event in contract_events:
+            block_timestamps[event["block_number"]] = event["timestamp"]
+
+        models.Block.objects.bulk_create(
+            [
+                models.Block(
+                    timestamp=pytz.utc.localize(timestamp),
+                    block_number=block_number,
+                    environment=environment,
+                )
+                for block_number, timestamp in block_timestamps.items()
+            ],
+            ignore_conflicts=True,
+            batch_size=BULK_BATCH_SIZE,
+        )
+        block_ids = dict(
+            models.Block.objects
+            .filter(environment=environment, block_number__in=list(block_timestamps))
+            .values_list("block_number", "id")
+        )
+
+        # Txns
+        txns = {}
+        for _, event in contract_events:
+            txns[(block_ids[event["block_number"]], event["txhash"])] = event["transaction_index"]
+
+        models.Txn.objects.bulk_create(
+            [
+                models.Txn(block_id=block_id, hash=txhash, index=transaction_index)
+                for (block_id, txhash), transaction_index in txns.items()
+            ],
+            ignore_conflicts=True,
+            batch_size=BULK_BATCH_SIZE,
+        )
+        txn_ids = {
+            (block_id, txhash): txn_id
+            for txn_id, block_id, txhash in models.Txn.objects
+            .filter(
+                block_id__in=list(set(block_ids.values())),
+                hash__in=list(set(txns | select(lambda key: key[1]))),
+            )
+            .values_list("id", "block_id", "hash")
+        }
+
+        # Event names
+        event_names = set(contract_events | select(lambda item: item[1]["event_name"]))
+        models.EventName.objects.bulk_create(
+            list(event_names | select(lambda event_name: models.EventName(event_name=event_name))),
+            ignore_conflicts=True,
+        )
+        event_name_ids = dict(
+            models.EventName.objects
+            .filter(event_name__in=list(event_names))
+            .values_list("event_name", "id")
+        )
+
+        # Logs, the ones already saved are skipped by the (txn, contract, log_index) constraint
+        models.TransactionLog.objects.bulk_create(
+            [
+                models.TransactionLog(
+                    txn_id=txn_ids[(block_ids[event["block_number"]], event["txhash"])],
+                    contract=contract_instance.contract_db_object,
+                    event_name_id=event_name_ids[event["event_name"]],
+                    log_index=event["log_index"],
+                    data=event["args"],
+                    reference_key=f"{environment.environment}-{event['block_number']}-{event['transaction_index']}-{event['log_index']}",
+                )
+                for contract_instance, event in contract_events
+            ],
+            ignore_conflicts=True,
+            batch_size=BULK_BATCH_SIZE,
+        )
+
+
+class CopyLoader(BulkLoader):
+    """Streams the events of a chunk into a staging table with `COPY` and merges them with plain SQL."""
+
+    STAGING_TABLE = "quark_event_staging"
+    STAGING_COLUMNS = [
+        "block_number",
+        "timestamp",
+        "txhash",
+        "transaction_index",
+        "event_name",
+        "contract_id",
+        "log_index",
+        "data",
+        "reference_key",
+    ]
+
+    def save(self, contract_events):
+        models = self.index_models
+        start = time.time()
+        environment = contract_events[0][0].evironment_db_object
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for contract_instance, event in contract_events:
+            event = parse(event)
+            writer.writerow([
+                event["block_number"],
+                pytz.utc.localize(event["timestamp"]).isoformat(),
+                event["txhash"],
+                event["transaction_index"],
+                event["event_name"],
+                contract_instance.contract_db_object.id,
+                event["log_index"],
+                json.dumps(event["args"]),
+                f"{environment.environment}-{event['block_number']}-{event['transaction_index']}-{event['log_index']}",
+            ])
+        buffer.seek(0)
+
+        tables = {
+            "staging": self.STAGING_TABLE,
+            "block": models.Block._meta.db_table,
+            "txn": models.Txn._meta.db_table,
+            "event_name": models.EventName._meta.db_table,
+            "log": models.TransactionLog._meta.db_table,
+        }
+
+        with connection.cursor() as cursor:
+            # Dropped with the chunk's transaction
+            cursor.execute(f"""
+                CREATE TEMP TABLE {tables['staging']} (
+                    block_number integer,
+                    timestamp timestamptz,
+                    txhash varchar(255),
+                    transaction_index integer,
+                    event_name varchar(255),
+                    contract_id integer,
+                    log_index integer,
+                    data jsonb,
+                    reference_key varchar(500)
+                ) ON COMMIT DROP
+            """)
+            cursor.copy_expert(
+                f"COPY {tables['staging']} ({', '.join(self.STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+
+            cursor.execute(f"""
+                INSERT INTO {tables['block']} (timestamp, block_number, environment_id)
+                SELECT DISTINCT ON (block_number) timestamp, block_number, %(environment_id)s
+                FROM {tables['staging']}
+                ORDER BY block_number
+                ON CONFLICT DO NOTHING
+            """, {"environment_id": environment.id})
+
+            cursor.execute(f"""
+                INSERT INTO {tables['event_name']} (event_name)
+                SELECT DISTINCT event_name FROM {tables['staging']}
+                ON CONFLICT DO NOTHING
+            """)
+
+            cursor.execute(f"""
+                INSERT INTO {tables['txn']} (block_id, hash, "index")
+                SELECT DISTINCT ON (b.id, s.txhash) b.id, s.txhash, s.transaction_index
+                FROM {tables['staging']} s
+                JOIN {tables['block']} b
+                    ON b.environment_id = %(environment_id)s AND b.block_number = s.block_number
+                ON CONFLICT DO NOTHING
+            """, {"environment_id": environment.id})
+
+            # The ones already saved are skipped by the (txn, contract, log_index) constraint
+            cursor.execute(f"""
+                INSERT INTO {tables['log']} (txn_id, contract_id, data, event_name_id, log_index, reference_key)
+                SELECT t.id, s.contract_id, s.data, e.id, s.log_index, s.reference_key
+                FROM {tables['staging']} s
+                JOIN {tables['block']} b
+                    ON b.environment_id = %(environment_id)s AND b.block_number = s.block_number
+                JOIN {tables['txn']} t
+                    ON t.block_id = b.id AND t.hash = s.txhash
+                JOIN {tables['event_name']} e
+                    ON e.event_name = s.event_name
+                ON CONFLICT DO NOTHING
+            """, {"environment_id": environment.id})
+
+        duration = time.time() - start
+        logger.info(
+            f"Copied {len(contract_events)} events in {round(duration, 2)} seconds "
+            f"({round(len(contract_events) / duration, 2) if duration else 0} rows/s)"
+        )
+
+
+LOADERS = {
+    "orm": ORMLoader,
+    "bulk": BulkLoader,
+    "copy": CopyLoader,
+}
+
+
+def get_loader(loader, index):
+    try:
+        return LOADERS[loader](index)
+    except KeyError:
+        raise NotAcceptableError(
+            f"{loader} is not a valid loader, use one of {', '.join(LOADERS)}"
+        )
@@ -1,7 +1,14 @@
 """
 Support for MakerDAO MultiCall contract
+
+Large call lists are split into batches of `MULTICALL_BATCH_SIZE` calls, sent in parallel
+and merged back in input order. The deployed contracts only have `aggregate`, which reverts
+as a whole if one call reverts, `try_aggregate` gets per call success flags by splitting the
+batches that revert until the calls that revert are on their own.
 """
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, List, Optional, Sequence, Tuple
 
@@ -9,15 +16,42 @@ from eth_abi.exceptions import DecodingError
 from eth_account.signers.local import LocalAccount
 from eth_typing import BlockIdentifier, BlockNumber, ChecksumAddress
 from hexbytes import HexBytes
+from pipe import select
 from web3 import Web3
 from web3._utils.abi import map_abi_data
 from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
 from web3.contract import ContractFunction
 from .web3_service import Contract
+from .chunk_size_service import is_response_too_large
 from ..config import Environment
 
 logger = logging.getLogger(__name__)
 
+# Calls per `aggregate`, keeps a batch under the gas and response size limits of the nodes
+MULTICALL_BATCH_SIZE = 100
+
+# How many `aggregate` calls are in-flight at the same time
+MAX_PARALLEL_BATCHES = 4
+
+# Errors of an `aggregate` that was too large, rather than one of its calls reverting
+TOO_LARGE_ERRORS = [
+    "out of gas",
+    "gas required exceeds",
+    "exceeds block gas limit",
+]
+
+
+def is_revert(error) -> bool:
+    return "revert" in str(error).lower()
+
+
+def is_too_large(error) -> bool:
+    message = str(error).lower()
+    return is_response_too_large(error) or any(
+        TOO_LARGE_ERRORS
+        | select(lambda known_error: known_error in message)
+    )
+
 
 @dataclass
 class MulticallResult:
@@ -31,6 +65,12 @@ class MulticallDecodedResult:
     return_data_decoded: Optional[Any]
 
 
+@dataclass
+class MulticallCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+
 class Multicall:
     ADDRESSES = {
         Environment.mainnet:	"0x41263cba59eb80dc200f3e2544eda4ed6a90e76c",
@@ -45,7 +85,9 @@ class Multicall:
     }
 
     def __init__(self, environment: Environment = Environment.mainnet) -> None:
+        # Not part of any index, it is only read
         self.contract = Contract(
+            index=None,
             contract_address=self.ADDRESSES[environment],
             environment=environment,
             abi_path='MultiCallGnosis.json'
@@ -108,28 +150,125 @@ class Multicall:
         aggregate_parameter = [
             {"target": target, "callData": data} for target, data in targets_with_data
         ]
-        return self.contract.read("aggregate", aggregate_parameter)
+        return self.contract.read(
+            "aggregate", aggregate_parameter, default_block=block_identifier or "latest"
+        )
+
+    def _aggregate_batch(
+        self,
+        targets_with_data: Sequence[Tuple[ChecksumAddress, bytes]],
+        block_identifier: Optional[BlockIdentifier],
+        require_success: bool,
+    ) -> List[MulticallResult]:
+        """`aggregate` a batch, splitting it in halves when it is too large or, without
+        `require_success`, when one of its calls reverts."""
+        try:
+            _, results = self._aggregate(targets_with_data, block_identifier=block_identifier)
+            return [MulticallResult(success=True, return_data=data) for data in results]
+        except Exception as e:
+            revert = is_revert(e)
+            if not (is_too_large(e) or (revert and not require_success)):
+                raise
+            if len(targets_with_data) == 1:
+                if revert:
+                    return [MulticallResult(success=False, return_data=None)]
+                raise
+
+        middle = len(targets_with_data) // 2
+        logger.info(f"Splitting a multicall of {len(targets_with_data)} calls")
+        return [
+            *self._aggregate_batch(targets_with_data[:middle], block_identifier, require_success),
+            *self._aggregate_batch(targets_with_data[middle:], block_identifier, require_success),
+        ]
+
+    def _aggregate_in_batches(
+        self,
+        targets_with_data: Sequence[Tuple[ChecksumAddress, bytes]],
+        block_identifier: Optional[BlockIdentifier],
+        require_success: bool,
+        batch_size: int,
+    ) -> List[MulticallResult]:
+        batches = [
+            targets_with_data[i: i + batch_size]
+            for i in range(0, len(targets_with_data), batch_size)
+        ]
+        if len(batches) == 1:
+            return self._aggregate_batch(batches[0], block_identifier, require_success)
+
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_BATCHES, len(batches))) as executor:
+            batch_results = executor.map(
+                lambda batch: self._aggregate_batch(batch, block_identifier, require_success),
+                batches
+            )
+            # executor.map keeps the order of the batches
+            return [result for results in batch_results for result in results]
 
     def aggregate(
         self,
         contract_functions: Sequence[ContractFunction],
         block_identifier: Optional[BlockIdentifier] = "latest",
-    ) -> Tuple[BlockNumber, List[Optional[Any]]]:
+        batch_size: int = MULTICALL_BATCH_SIZE,
+    ) -> List[Optional[Any]]:
         """
-        Calls ``aggregate`` on MakerDAO's Multicall contract. If a function called raises an error execution is stopped
+        Calls ``aggregate`` on MakerDAO's Multicall contract, `batch_size` calls at a time.
+        If a function called raises an error execution is stopped
         :param contract_functions:
         :param block_identifier:
-        :return: A tuple with the ``blockNumber`` and a list with the decoded return values
-        :raises: BatchCallFunctionFailed
+        :return: A list with the decoded return values, in the order of `contract_functions`
+        :raises: The error of the call that reverted
         """
+        if not contract_functions:
+            return []
+
         targets_with_data, output_types = self._build_payload(
             contract_functions)
-        block_number, results = self._aggregate(
-            targets_with_data, block_identifier=block_identifier
+        results = self._aggregate_in_batches(
+            targets_with_data, block_identifier, require_success=True, batch_size=batch_size
         )
         decoded_results = [
-            self._decode_data(output_type, data)
-            for output_type, data in zip(output_types, results)
+            self._decode_data(output_type, result.return_data)
+            for output_type, result in zip(output_types, results)
         ]
 
         return decoded_results
+
+    def try_aggregate(
+        self,
+        contract_functions: Sequence[ContractFunction],
+        block_identifier: Optional[BlockIdentifier] = "latest",
+        batch_size: int = MULTICALL_BATCH_SIZE,
+    ) -> List[MulticallDecodedResult]:
+        """
+        Like ``tryAggregate`` of Multicall2, a function that reverts doesn't stop the others
+        :return: A `MulticallDecodedResult` per function, in the order of `contract_functions`
+        """
+        if not contract_functions:
+            return []
+
+        targets_with_data, output_types = self._build_payload(
+            contract_functions)
+        results = self._aggregate_in_batches(
+            targets_with_data, block_identifier, require_success=False, batch_size=batch_size
+        )
+        return [
+            MulticallDecodedResult(
+                success=result.success,
+                return_data_decoded=(
+                    self._decode_data(output_type, result.return_data)
+                    if result.success else None
+                ),
+            )
+            for output_type, result in zip(output_types, results)
+        ]
+
+_multicalls = {}
+_multicalls_lock = threading.Lock()
+
+
+def get_multicall(environment) -> Multicall:
+    """The Multicall of the environment, built once per process."""
+    if environment not in _multicalls:
+        with _multicalls_lock:
+            if environment not in _multicalls:
+                _multicalls[environment] = Multicall(environment=environment)
+    return _multicalls[environment]
@@ -0,0 +1,201 @@
+"""Health of the JSON-RPC providers, shared by all the workers of a host through diskcache.
+
+Every tracked call updates the provider's EWMA latency and error rate and the window of its
+recent latencies. After `FAILURE_THRESHOLD` failures in a row the provider's circuit opens:
+it goes to the back of the list for `OPEN_SECONDS`, then one call is let through to probe it.
+
+Latency-sensitive calls can be hedged: when the best provider hasn't answered after its p95
+latency, the same call goes to the next provider and the first good answer wins.
+"""
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional, Tuple
+
+import diskcache as dc
+from pipe import select, where
+from web3.exceptions import BadFunctionCallOutput, ContractLogicError
+
+logger = logging.getLogger(__name__)
+cache = dc.Cache('tmp')
+
+# Weight of the latest call in the moving averages
+EWMA_ALPHA = 0.2
+
+# Latencies kept to work out the p95 of a provider
+LATENCY_WINDOW = 100
+
+# Failures in a row that open the circuit of a provider
+FAILURE_THRESHOLD = 5
+
+# How long an open circuit keeps a provider at the back of the list
+OPEN_SECONDS = 30
+
+# Hedge delay while we don't have `MIN_HEDGE_SAMPLES` latencies of the provider
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_SAMPLES = 20
+MIN_HEDGE_DELAY = 0.05
+
+# Provider health is forgotten after a day without calls
+HEALTH_EXPIRE = 60 * 60 * 24
+
+# The provider answered, the call itself failed, eg. a revert
+ANSWERED_ERRORS = (ContractLogicError, BadFunctionCallOutput)
+
+# Calls in-flight for hedged calls at the same time, per process
+HEDGE_WORKERS = 16
+
+_hedge_executors = {}
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    """The threads of a pool can't be used from a forked process, eg. a Celery worker child."""
+    pid = os.getpid()
+    if pid not in _hedge_executors:
+        _hedge_executors[pid] = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedged-call")
+    return _hedge_executors[pid]
+
+
+def _get_health_key(environment, provider) -> str:
+    return f"{environment}-{provider}-health"
+
+
+def _new_health() -> dict:
+    return {
+        "latency": None,
+        "error_rate": 0.0,
+        "latencies": [],
+        "consecutive_failures": 0,
+        "open_until": 0.0,
+    }
+
+
+def get_health(environment, provider) -> dict:
+    return cache.get(_get_health_key(environment, provider)) or _new_health()
+
+
+def _update_health(environment, provider, update: Callable[[dict], None]):
+    key = _get_health_key(environment, provider)
+    with cache.transact():
+        health = cache.get(key) or _new_health()
+        update(health)
+        cache.set(key, health, expire=HEALTH_EXPIRE)
+
+
+def record_success(environment, provider, latency: float):
+    def update(health):
+        health["latency"] = latency if health["latency"] is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * health["latency"]
+        )
+        health["error_rate"] *= 1 - EWMA_ALPHA
+        health["latencies"] = [*health["latencies"], latency][-LATENCY_WINDOW:]
+        health["consecutive_failures"] = 0
+        health["open_until"] = 0.0
+
+    _update_health(environment, provider, update)
+
+
+def record_failure(environment, provider):
+    def update(health):
+        health["error_rate"] = EWMA_ALPHA + (1 - EWMA_ALPHA) * health["error_rate"]
+        health["consecutive_failures"] += 1
+        if health["consecutive_failures"] >= FAILURE_THRESHOLD:
+            if not is_open(health):
+                logger.warning(
+                    f"{provider} failed {health['consecutive_failures']} times in a row, "
+                    f"skipping it for {OPEN_SECONDS} seconds"
+                )
+            health["open_until"] = time.time() + OPEN_SECONDS
+
+    _update_health(environment, provider, update)
+
+
+def is_open(health: dict) -> bool:
+    return health["open_until"] > time.time()
+
+
+def get_score(health: dict, default_latency: float = 0.0) -> float:
+    """Lower is better, a provider that never answered is scored at `default_latency`."""
+    latency = default_latency if health["latency"] is None else health["latency"]
+    return latency * (1 + 10 * health["error_rate"])
+
+
+def rank_providers(environment, providers: List[str]) -> List[str]:
+    """The providers without duplicates, the healthiest first and the open circuits last.
+
+    A provider we have no latency of yet is scored at the median latency of the others,
+    so it gets tried before the ones that are failing. Ties keep the order of `providers`.
+    """
+    providers = list(dict.fromkeys(providers))
+    healths = {provider: get_health(environment, provider) for provider in providers}
+    latencies = sorted(
+        healths.values()
+        | select(lambda health: health["latency"])
+        | where(lambda latency: latency is not None)
+    )
+    default_latency = latencies[len(latencies) // 2] if latencies else 0.0
+    return sorted(
+        providers,
+        key=lambda provider: (is_open(healths[provider]), get_score(healths[provider], default_latency))
+    )
+
+
+def get_hedge_delay(environment, provider) -> float:
+    """How long to wait for a provider before sending the same call to the next one, its p95 latency."""
+    latencies = sorted(get_health(environment, provider)["latencies"])
+    if len(latencies) < MIN_HEDGE_SAMPLES:
+        return DEFAULT_HEDGE_DELAY
+    return max(latencies[int(len(latencies) * 0.95) - 1], MIN_HEDGE_DELAY)
+
+
+def tracked_call(environment, provider, request: Callable[[str], object]):
+    """`request(provider)`, recording its latency or failure in the provider's health."""
+    start = time.time()
+    try:
+        result = request(provider)
+    except ANSWERED_ERRORS:
+        record_success(environment, provider, time.time() - start)
+        raise
+    except Exception:
+        record_failure(environment, provider)
+        raise
+    record_success(environment, provider, time.time() - start)
+    return result
+
+
+def hedged_call(environment, providers: List[str], request: Callable[[str], object]) -> Tuple[object, str]:
+    """Race `request` on the two best providers, the second one only starts after the p95 latency of the first.
+
+    A revert is an answer, it is raised right away.
+
+    :param providers: Ranked providers, eg. from `rank_providers`
+    :return: tuple(result, provider that answered)
+    :raises: The error of the last provider when both failed
+    """
+    providers = providers[:2]
+    futures = {}
+    pending = set()
+    error: Optional[Exception] = None
+
+    for position, provider in enumerate(providers):
+        future = _get_hedge_executor().submit(tracked_call, environment, provider, request)
+        futures[future] = provider
+        pending.add(future)
+
+        # Wait for the first provider up to its p95, for the last one until it answers
+        timeout = get_hedge_delay(environment, provider) if position < len(providers) - 1 else None
+        while pending:
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                logger.info(f"{provider} is slow, hedging the call to {providers[position + 1]}")
+                break
+            for future in done:
+                try:
+                    return future.result(), futures[future]
+                except ANSWERED_ERRORS:
+                    raise
+                except Exception as e:
+                    error = e
+
+    raise error
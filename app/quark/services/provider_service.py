@@ -0,0 +1,140 @@
+"""Pooled keep-alive HTTP sessions and Web3 instances, one per (chain, provider URL) per process.
+
+Everything that talks to a JSON-RPC node goes through here: the scanner, the reads,
+multicall, the writes and the plain JSON-RPC batches. The TLS handshake and the
+Web3/provider objects are then paid for once per provider, not once per call.
+"""
+import logging
+import os
+import threading
+from typing import Optional
+
+import requests
+from pipe import select
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.middleware import geth_poa_middleware
+from web3.providers.rpc import HTTPProvider
+
+from ..config import CHAIN
+from .rate_limit_service import acquire
+
+logger = logging.getLogger(__name__)
+
+# Connections kept alive per provider, `http_pool_size` in CHAIN overrides it
+DEFAULT_HTTP_POOL_SIZE = 10
+
+# Seconds Web3 waits on a request, same as the default of web3.py
+WEB3_REQUEST_TIMEOUT = 10
+
+_sessions = {}
+_web3_instances = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def get_environment_for_provider(provider: str) -> Optional[str]:
+    """The chain a provider URL is configured for."""
+    provider = provider.strip()
+    for environment, chain in CHAIN.items():
+        providers = [chain["provider"], *chain.get("backup_providers", [])]
+        if provider in list(providers | select(str.strip)):
+            return environment
+    return None
+
+
+def get_pool_size(environment) -> int:
+    if environment not in CHAIN:
+        return DEFAULT_HTTP_POOL_SIZE
+    return CHAIN[environment].get("http_pool_size", DEFAULT_HTTP_POOL_SIZE)
+
+
+def _check_pid():
+    """Connections can't be shared with a forked process, eg. a Celery worker child."""
+    global _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _sessions.clear()
+                _web3_instances.clear()
+                _pid = os.getpid()
+
+
+def get_session(provider: str, environment: Optional[str] = None) -> requests.Session:
+    """The keep-alive session of a provider.
+
+    :param environment: The chain of the provider, looked up from CHAIN when not given
+    """
+    _check_pid()
+    provider = provider.strip()
+    if environment is None:
+        environment = get_environment_for_provider(provider)
+
+    key = (environment, provider)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                pool_size = get_pool_size(environment)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _sessions[key] = session
+                logger.debug(f"New HTTP session for {provider} with {pool_size} connections")
+    return session
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """`HTTPProvider` posting through our session, within the rate limit of the provider.
+
+    web3.py keeps its own sessions in an LRU of 8 that closes the evicted ones,
+    with all the backup providers we would keep losing the pool.
+    """
+
+    def __init__(
+        self,
+        endpoint_uri: str,
+        session: requests.Session,
+        environment: Optional[str] = None,
+        request_kwargs: Optional[dict] = None,
+    ):
+        super().__init__(endpoint_uri, request_kwargs={"timeout": WEB3_REQUEST_TIMEOUT, **(request_kwargs or {})})
+        self.session = session
+        self.environment = environment
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        acquire(self.environment, self.endpoint_uri)
+        response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+
+def get_web3(environment, provider: Optional[str] = None, retry: bool = True) -> Web3:
+    """The shared Web3 instance of a chain provider.
+
+    Shared between threads, so don't change its state, eg. pass `block_identifier`
+    to the calls instead of setting `web3.eth.defaultBlock`.
+
+    :param provider: Provider URL, the main provider of the chain by default
+    :param retry: False drops the JSON-RPC retry middleware, the scanner throttles down the block range itself
+    """
+    _check_pid()
+    provider = (provider or CHAIN[environment]["provider"]).strip()
+
+    key = (environment, provider, retry)
+    web3 = _web3_instances.get(key)
+    if web3 is None:
+        with _lock:
+            web3 = _web3_instances.get(key)
+        if web3 is None:
+            http_provider = PooledHTTPProvider(provider, get_session(provider, environment), environment)
+            if not retry:
+                http_provider.middlewares = ()
+            web3 = Web3(http_provider)
+            web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+            with _lock:
+                web3 = _web3_instances.setdefault(key, web3)
+    return web3
@@ -0,0 +1,170 @@
+"""Token bucket rate limiting of the JSON-RPC requests, per (chain, provider) across the whole cluster.
+
+The Celery workers, the API workers and the notebooks all share the public endpoints, so the buckets
+live in Redis and every process takes its tokens from the same bucket. When Redis can't be reached
+each process falls back to a bucket of its own, the limit is then per process.
+
+A chain is limited by its `rate_limit` entry in CHAIN, eg. {"requests_per_second": 25, "burst": 50},
+every provider of the chain gets a bucket of that size. One HTTP request takes one token,
+a JSON-RPC batch included.
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+import redis
+from django.conf import settings
+from pipe import select
+
+from ..config import CHAIN
+
+logger = logging.getLogger(__name__)
+
+# How long we stay on the in-process buckets after Redis failed
+REDIS_RETRY_SECONDS = 30
+
+# Error messages of the providers throttling us
+RATE_LIMIT_ERRORS = [
+    "too many requests",
+    "rate limit",
+    "exceeded the rate",
+]
+
+# Takes `requested` tokens from the bucket, the tokens can go below zero. Returns how many seconds
+# the caller has to wait for its tokens, so the callers queue up instead of polling the bucket.
+# The clock is Redis', the hosts taking tokens don't have to agree on the time.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+-- Writing after reading the clock needs this before Redis 5, it is a no-op or gone since
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate) - requested
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class TokenBucket:
+    """In-process twin of `TOKEN_BUCKET_SCRIPT`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, requested: float = 1) -> float:
+        """Take the tokens, returns how many seconds to wait for them."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated_at) * self.rate) - requested
+            self.updated_at = max(now, self.updated_at)
+            return max(0.0, -self.tokens / self.rate)
+
+
+_local_buckets = {}
+_local_buckets_lock = threading.Lock()
+_redis = None
+_redis_script = None
+_redis_failed_at = 0.0
+
+
+def get_rate_limit(environment) -> Optional[Tuple[float, float]]:
+    """tuple(requests per second, burst) of a chain, None when it isn't limited."""
+    if environment not in CHAIN:
+        return None
+    rate_limit = CHAIN[environment].get("rate_limit")
+    if not rate_limit:
+        return None
+    rate = rate_limit["requests_per_second"]
+    return rate, rate_limit.get("burst", rate)
+
+
+def _get_redis_script():
+    global _redis, _redis_script
+    if _redis_script is None:
+        _redis = redis.Redis.from_url(
+            settings.CELERY_BROKER_URL, socket_timeout=1, socket_connect_timeout=1
+        )
+        _redis_script = _redis.register_script(TOKEN_BUCKET_SCRIPT)
+    return _redis_script
+
+
+def _take_local(key, rate, burst, requested) -> float:
+    bucket = _local_buckets.get(key)
+    if bucket is None:
+        with _local_buckets_lock:
+            bucket = _local_buckets.setdefault(key, TokenBucket(rate, burst))
+    return bucket.take(requested)
+
+
+def reserve(environment, provider: str, requested: float = 1) -> float:
+    """Take tokens from the bucket of the provider.
+
+    :return: Seconds to wait before sending the request
+    """
+    global _redis_failed_at
+    rate_limit = get_rate_limit(environment)
+    if rate_limit is None:
+        return 0.0
+    rate, burst = rate_limit
+    key = f"rate_limit:{environment}:{provider.strip()}"
+
+    if time.time() - _redis_failed_at > REDIS_RETRY_SECONDS:
+        try:
+            return float(_get_redis_script()(keys=[key], args=[rate, burst, requested]))
+        except Exception as e:
+            logger.warning(f"Rate limiting in-process, Redis failed with {e}")
+            _redis_failed_at = time.time()
+
+    return _take_local(key, rate, burst, requested)
+
+
+def acquire(environment, provider: str, requested: float = 1):
+    """Wait for the provider's bucket to let a request through."""
+    wait = reserve(environment, provider, requested)
+    if wait > 0:
+        logger.debug(f"Rate limited on {provider}, waiting {round(wait, 3)} seconds")
+        time.sleep(wait)
+
+
+async def acquire_async(environment, provider: str, requested: float = 1):
+    """`acquire` for the event loop, the Redis round trip runs in the loop's default executor."""
+    if get_rate_limit(environment) is None:
+        return
+    wait = await asyncio.get_running_loop().run_in_executor(None, reserve, environment, provider, requested)
+    if wait > 0:
+        logger.debug(f"Rate limited on {provider}, waiting {round(wait, 3)} seconds")
+        await asyncio.sleep(wait)
+
+
+def is_rate_limited(error) -> bool:
+    """Did the provider reject the call because we are sending too many."""
+    # requests' HTTPError has the response, aiohttp's ClientResponseError the status
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429 or getattr(error, "status", None) == 429:
+        return True
+    message = str(error).lower()
+    return any(
+        RATE_LIMIT_ERRORS
+        | select(lambda known_error: known_error in message)
+    )
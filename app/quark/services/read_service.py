@@ -1,18 +1,48 @@
+import os
 from itertools import cycle
+from typing import List, NamedTuple, Optional
 from web3 import Web3
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.exceptions import BadFunctionCallOutput, ContractLogicError
+from eth_abi.exceptions import DecodingError
+from hexbytes import HexBytes
 from .. import config
-from web3.middleware import geth_poa_middleware
-from requests import HTTPError
+from requests import RequestException
 import logging
 import diskcache as dc
+from pipe import select
 from common.utils.encryption_utils import hash_password
 from common.exceptions import NotAcceptableError
 from common.timeit import timeit
+from .provider_health_service import hedged_call, rank_providers, tracked_call
+from .provider_service import get_web3
+from .rpc_service import JSONRPCError, batch_call
 
 logger = logging.getLogger(__name__)
 cache = dc.Cache('tmp')
 READ_CACHE_TIME = 7
 
+# eth_calls per JSON-RPC batch, most public nodes reject larger batches
+READ_BATCH_SIZE = 100
+
+# Cache hits are told apart from cached None results with this
+_MISSING = object()
+
+# Reads at a block the chain won't reorganise anymore never change, they are kept without
+# an expiry in their own cache. The oldest stored ones are evicted past the size limit.
+PINNED_READ_CACHE_SIZE_LIMIT = int(os.environ.get("PINNED_READ_CACHE_SIZE_LIMIT", 2 ** 30))
+pinned_cache = dc.Cache(
+    os.path.join('tmp', 'pinned_reads'),
+    size_limit=PINNED_READ_CACHE_SIZE_LIMIT,
+)
+
+# How long the head block number of a chain is trusted
+HEAD_BLOCK_CACHE_TIME = 7
+
+# Environment to the last block known to be finalized, it only ever grows
+_finalized_blocks = {}
+
 
 def get_read_balance_cache_key(*args, **kwargs):
     signature = f"{kwargs}{args}"
@@ -34,11 +64,6 @@ def read_balance(contract_address, environment, abi):
 
     contract_address = Web3.toChecksumAddress(contract_address)
 
-    def get_web3_instance(provider):
-        web3 = Web3(Web3.HTTPProvider(provider))
-        web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        return web3
-
     logger.info(f"fetching balance: {contract_address}")
     max_retries = 15
     try_count = 0
@@ -49,8 +74,11 @@ def read_balance(contract_address, environment, abi):
         try:
             try_count += 1
             logger.info(f"provider: {provider}")
-            result = get_web3_instance(
-                provider).eth.getBalance(contract_address)
+            result = tracked_call(
+                environment,
+                provider,
+                lambda provider: get_web3(environment, provider).eth.getBalance(contract_address)
+            )
             logger.info(f"balance: {contract_address}, result: {result}")
 
             # Save the result in a permanent cache and then if all the retries are over then return the permanent cached result
@@ -62,11 +90,8 @@ def read_balance(contract_address, environment, abi):
                 "getWeb3Balance"
             )
 
-            # Note down this provider and try this as the first provider in the next call
-            set_working_provider(environment, provider)
-
             return result
-        except HTTPError as e:
+        except RequestException as e:
             if try_count >= max_retries:
                 return get_permanent_cache(contract_address, environment, abi, "getWeb3Balance")
             print(
@@ -77,25 +102,97 @@ def read_balance(contract_address, environment, abi):
 read_balance.__cache_key__ = get_read_balance_cache_key
 
 
-@cache.memoize(expire=READ_CACHE_TIME)
-@timeit
-def read(contract_address, environment, abi, function_name, default_block, *args):
+@cache.memoize(expire=HEAD_BLOCK_CACHE_TIME)
+def get_head_block_number(environment) -> Optional[int]:
+    for provider in get_all_providers(environment):
+        try:
+            return tracked_call(
+                environment, provider, lambda provider: get_web3(environment, provider).eth.block_number
+            )
+        except (RequestException, ValueError) as e:
+            logger.warning(f"Couldn't get the head block of {environment} from {provider}: {e}")
+    return None
+
+
+def is_finalized(environment, default_block) -> bool:
+    """Is `default_block` a block number at least `confirmation_blocks` behind the head of the chain."""
+    if not isinstance(default_block, int) or isinstance(default_block, bool):
+        return False
+    if default_block <= _finalized_blocks.get(environment, -1):
+        return True
+
+    head_block_number = get_head_block_number(environment)
+    if head_block_number is None:
+        return False
+    _finalized_blocks[environment] = head_block_number - config.get_confirmation_blocks(environment)
+    return default_block <= _finalized_blocks[environment]
+
+
+def read(contract_address, environment, abi, function_name, default_block, *args, hedge=False):
+    """Call a view function of a contract at `default_block`.
+
+    Reads at a finalized block number are cached in `pinned_cache` for good,
+    the others for `READ_CACHE_TIME` seconds. When every provider fails the last
+    result read at the same block is returned, it isn't pinned.
+
+    :param hedge: Also send the call to the second best provider when the best one is slower than its p95
+    """
+    if not is_finalized(environment, default_block):
+        return read_latest(contract_address, environment, abi, function_name, default_block, *args, hedge=hedge)
 
     contract_address = Web3.toChecksumAddress(contract_address)
+    key = get_read_key(contract_address, environment, abi, function_name, default_block, *args)
+    result = pinned_cache.get(key, default=_MISSING)
+    if result is not _MISSING:
+        return result
+
+    try:
+        result = _call(contract_address, environment, abi, function_name, default_block, *args, hedge=hedge)
+    except NotAcceptableError:
+        # Not pinned, only a result the providers sent back is kept for good
+        return get_permanent_cache(contract_address, environment, abi, function_name, *args, default_block=default_block)
+    pin_result(key, result)
+    return result
+
+
+def pin_result(key, result):
+    """Keep the result of a read at a finalized block for good, None is never pinned."""
+    if result is not None:
+        pinned_cache.set(key, result)
+
 
-    def get_web3(provider):
-        web3 = Web3(Web3.HTTPProvider(provider))
-        web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        return web3
+@timeit
+def _read(contract_address, environment, abi, function_name, default_block, *args, hedge=False):
+    """`_call`, the last result the providers sent back when they all failed."""
+    try:
+        return _call(contract_address, environment, abi, function_name, default_block, *args, hedge=hedge)
+    except NotAcceptableError:
+        return get_permanent_cache(
+            Web3.toChecksumAddress(contract_address), environment, abi, function_name, *args,
+            default_block=default_block
+        )
+
+
+def _call(contract_address, environment, abi, function_name, default_block, *args, hedge=False):
+    """Call the function on the providers until one answers.
 
-    def get_contract_instance(provider, default_block):
-        web3 = get_web3(provider)
-        web3.eth.defaultBlock = default_block;
-        return web3.eth.contract(
+    :raises: NotAcceptableError when every retry failed
+    """
+    contract_address = Web3.toChecksumAddress(contract_address)
+
+    def get_contract_instance(provider):
+        # The Web3 instance is shared, the block goes with the call
+        return get_web3(environment, provider).eth.contract(
             address=contract_address,
             abi=abi
         )
 
+    def call(provider):
+        return getattr(
+            get_contract_instance(provider).functions,
+            function_name
+        )(*args).call(block_identifier=default_block)
+
     log_dump = f"Read Call: {contract_address}, {environment}, {default_block}, {function_name}, {args}"
     logger.info(
         log_dump if len(log_dump) < 200 else f"{log_dump[:200]}..." 
@@ -110,10 +207,10 @@ def read(contract_address, environment, abi, function_name, default_block, *args
         try:
             try_count += 1
             # logger.info(f"provider: {provider}")
-            result = getattr(
-                get_contract_instance(provider, default_block).functions,
-                function_name
-            )(*args).call()
+            if hedge and try_count == 1:
+                result, _ = hedged_call(environment, all_providers, call)
+            else:
+                result = tracked_call(environment, provider, call)
 
             # logger.info(
             #     f"function_name: {function_name}, args: {args}, result: {result}"
@@ -130,19 +227,179 @@ def read(contract_address, environment, abi, function_name, default_block, *args
                 default_block=default_block
             )
 
-            # Note down this provider and try this as the first provider in the next call
-            set_working_provider(environment, provider)
-
             return result
-        except HTTPError as e:
+        except RequestException as e:
             if try_count >= max_retries:
-                return get_permanent_cache(contract_address, environment, abi, function_name, *args)
+                raise NotAcceptableError(
+                    'Providers are not working at the moment, failing...')
             print(
                 f'Trying again, retry number: {try_count}, switching providers'
             )
 
 
-read.__cache_key__ = get_read_cache_key
+read_latest = cache.memoize(expire=READ_CACHE_TIME)(_read)
+read_latest.__cache_key__ = get_read_cache_key
+
+
+def get_read_key(contract_address, environment, abi, function_name, default_block, *args):
+    """The key `read` caches its result under."""
+    return get_read_cache_key(contract_address, environment, abi, function_name, default_block, *args)
+
+
+class ReadCall(NamedTuple):
+    contract_address: str
+    abi: list
+    function_name: str
+    args: tuple = ()
+    default_block: object = "latest"
+
+
+def _to_block_param(default_block):
+    return hex(default_block) if isinstance(default_block, int) else default_block
+
+
+def _is_revert(error) -> bool:
+    return "revert" in str(error).lower()
+
+
+def _decode_call_result(web3, fn_abi, return_data):
+    output_types = get_abi_output_types(fn_abi)
+    try:
+        output_data = web3.codec.decode_abi(output_types, HexBytes(return_data))
+    except DecodingError as e:
+        raise BadFunctionCallOutput(
+            f"Could not decode contract function call to {fn_abi['name']} with "
+            f"return data: {return_data}, output_types: {output_types}"
+        ) from e
+    normalized_data = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, output_data)
+    if len(normalized_data) == 1:
+        return normalized_data[0]
+    return normalized_data
+
+
+def read_many(environment, calls: List[ReadCall], max_retries: Optional[int] = None) -> list:
+    """Many `read`s sent as JSON-RPC batches of `eth_call`.
+
+    The results are read from and saved to the same caches as `read`. The calls that fail
+    on a provider are retried on the next one, the others are not sent again.
+
+    :param calls: `ReadCall`s or tuples of (contract_address, abi, function_name, args, default_block)
+    :return: The decoded results in the order of `calls`
+    :raises: ContractLogicError when a call reverts, NotAcceptableError when a call
+        failed on every provider and was never read before
+    """
+    calls = list(calls | select(lambda call: ReadCall(*call)))
+    results = [_MISSING] * len(calls)
+    keys = [
+        get_read_key(
+            Web3.toChecksumAddress(call.contract_address),
+            environment,
+            call.abi,
+            call.function_name,
+            call.default_block,
+            *call.args
+        )
+        for call in calls
+    ]
+
+    caches = [
+        pinned_cache if is_finalized(environment, call.default_block) else cache
+        for call in calls
+    ]
+
+    for position, key in enumerate(keys):
+        results[position] = caches[position].get(key, default=_MISSING)
+
+    pending = [position for position, result in enumerate(results) if result is _MISSING]
+    if not pending:
+        return results
+
+    logger.info(f"Batch read: {len(pending)} calls, {len(calls) - len(pending)} from the cache")
+
+    all_providers = get_all_providers(environment)
+    max_retries = max_retries or len(all_providers)
+
+    for try_count, provider in enumerate(cycle(all_providers), start=1):
+        web3 = get_web3(environment, provider)
+        functions = {}
+        for position in pending:
+            call = calls[position]
+            contract = web3.eth.contract(
+                address=Web3.toChecksumAddress(call.contract_address), abi=call.abi
+            )
+            functions[position] = getattr(contract.functions, call.function_name)(*call.args)
+
+        failed = []
+        for i in range(0, len(pending), READ_BATCH_SIZE):
+            batch = pending[i: i + READ_BATCH_SIZE]
+            try:
+                responses = tracked_call(environment, provider, lambda provider: batch_call(
+                    provider,
+                    [
+                        (
+                            "eth_call",
+                            [
+                                {
+                                    "to": functions[position].address,
+                                    "data": functions[position]._encode_transaction_data(),
+                                },
+                                _to_block_param(calls[position].default_block),
+                            ],
+                        )
+                        for position in batch
+                    ]
+                ))
+            except (RequestException, JSONRPCError, ValueError) as e:
+                logger.warning(f"Batch read failed on {provider}: {e}")
+                failed.extend(batch)
+                continue
+
+            for position, response in zip(batch, responses):
+                if isinstance(response, JSONRPCError):
+                    if _is_revert(response):
+                        raise ContractLogicError(str(response))
+                    failed.append(position)
+                    continue
+
+                call = calls[position]
+                result = _decode_call_result(web3, functions[position].abi, response)
+                results[position] = result
+                if caches[position] is pinned_cache:
+                    pin_result(keys[position], result)
+                    continue
+
+                cache.set(keys[position], result, expire=READ_CACHE_TIME)
+                set_permanent_cache(
+                    result,
+                    Web3.toChecksumAddress(call.contract_address),
+                    environment,
+                    call.abi,
+                    call.function_name,
+                    *call.args,
+                    default_block=call.default_block
+                )
+
+        pending = failed
+        if not pending:
+            return results
+
+        if try_count >= max_retries:
+            break
+        logger.info(
+            f"Trying {len(pending)} calls again, retry number: {try_count}, switching providers"
+        )
+
+    for position in pending:
+        call = calls[position]
+        results[position] = get_permanent_cache(
+            Web3.toChecksumAddress(call.contract_address),
+            environment,
+            call.abi,
+            call.function_name,
+            *call.args,
+            default_block=call.default_block
+        )
+    return results
 
 
 def set_permanent_cache(result, *args, **kwargs):
@@ -162,35 +419,33 @@ def get_permanent_cache(*args, **kwargs):
 
 
 def get_all_providers(environment):
+    """The providers of the chain, the healthiest first, see `rank_providers`."""
     chain = config.CHAIN[environment]
-    working_provider = get_working_provider(environment)
-    working_providers = [working_provider, ] if working_provider else []
-    return [
-        *working_providers, chain['provider'], *chain['backup_providers']
-    ]
+    return rank_providers(environment, [chain['provider'], *chain['backup_providers']])
 
 
-def _get_working_provider_key(environment):
-    return f'{environment}-working_provider'
-
-
-def get_working_provider(environment):
-    return cache.get(
-        _get_working_provider_key(environment),
-        None
-    )
-
+def get_result_from_cache(contract_address, environment, abi, function_name, *args, default_block="latest"):
+    """The result `read` or `save_result_in_cache` cached for these arguments.
 
-def set_working_provider(environment, provider):
-    cache.set(
-        _get_working_provider_key(environment),
-        provider
+    :return: tuple(found, result)
+    """
+    key = get_read_key(
+        Web3.toChecksumAddress(contract_address), environment, abi, function_name, default_block, *args
     )
+    result_cache = pinned_cache if is_finalized(environment, default_block) else cache
+    result = result_cache.get(key, default=_MISSING)
+    if result is _MISSING:
+        return False, None
+    return True, result
 
 
-def save_result_in_cache(result, contract_address, environment, abi, function_name, *args, **kwargs):
-    key = get_read_cache_key(
-        contract_address, environment, abi, function_name, *args, **kwargs
+def save_result_in_cache(result, contract_address, environment, abi, function_name, *args, default_block="latest"):
+    # Same key as `read`, so its next call is a cache hit
+    key = get_read_key(
+        Web3.toChecksumAddress(contract_address), environment, abi, function_name, default_block, *args
     )
     # logger.info(f"Saving result in cache: {key}")
-    cache.set(key, result, expire=READ_CACHE_TIME)
+    if is_finalized(environment, default_block):
+        pin_result(key, result)
+    else:
+        cache.set(key, result, expire=READ_CACHE_TIME)
@@ -0,0 +1,118 @@
+"""Chain reorganisation detection.
+
+While a scan fetches the last `confirmation_blocks` blocks of the chain, the block hashes
+are fetched before and after their logs. When the chain changed in between the chunk is
+rejected, otherwise the hashes the logs were checked against are kept with the chunk.
+Before the next scan they are compared with what the node has now, the first block
+that doesn't match is where the fork starts.
+"""
+import logging
+from typing import Dict, Optional
+
+from django.db import transaction
+from django.db.models import Q
+from hexbytes import HexBytes
+
+from ..config import get_confirmation_blocks
+from ..models import BlockHash, Environment
+from .block_service import get_block_headers
+
+logger = logging.getLogger(__name__)
+
+
+class ChainReorganisedError(Exception):
+    """The chain changed while the logs of a chunk were fetched."""
+    pass
+
+
+def get_hash_window_start(environment, end_block) -> Optional[int]:
+    """First block of a scan ending at `end_block` we keep the hash of, None when we keep none."""
+    confirmation_blocks = get_confirmation_blocks(environment)
+    if confirmation_blocks <= 0:
+        return None
+    return max(end_block - confirmation_blocks + 1, 0)
+
+
+def check_block_hashes(hashes_before: Dict[int, str], hashes_after: Dict[int, str], events):
+    """Check that a chunk's logs all come from the chain its block hashes were fetched from.
+
+    :param hashes_before: Block hashes fetched before the logs
+    :param hashes_after: Block hashes fetched after the logs
+    :raises: ChainReorganisedError when a block changed in between or a log is from another block
+    """
+    for block_number, block_hash in hashes_after.items():
+        if hashes_before.get(block_number) != block_hash:
+            raise ChainReorganisedError(
+                f"Block {block_number} changed from {hashes_before.get(block_number)} to {block_hash}"
+            )
+
+    for evt in events:
+        block_hash = hashes_after.get(evt["blockNumber"])
+        if block_hash is not None and HexBytes(evt["blockHash"]) != HexBytes(block_hash):
+            raise ChainReorganisedError(
+                f"Log of block {evt['blockNumber']} is from {HexBytes(evt['blockHash']).hex()}, "
+                f"the block is {block_hash}"
+            )
+
+
+def find_fork_block(index, environment, provider) -> Optional[int]:
+    """The first block of the window that the node doesn't have anymore, None without a fork."""
+    saved_hashes = dict(
+        BlockHash.objects
+        .filter(index=index, environment__environment=environment)
+        .values_list("block_number", "hash")
+    )
+    if not saved_hashes:
+        return None
+
+    headers = get_block_headers(provider, saved_hashes.keys())
+    for block_number in sorted(saved_hashes):
+        header = headers.get(block_number)
+        if header and header["hash"] == saved_hashes[block_number]:
+            continue
+
+        if block_number == min(saved_hashes):
+            logger.warning(
+                f"{index} on {environment}: the fork is deeper than the {len(saved_hashes)} blocks "
+                f"we kept, rolling back from block {block_number} only"
+            )
+        return block_number
+    return None
+
+
+def record_block_hashes(index, environment, block_hashes: Dict[int, str]):
+    """Keep the hashes of a scanned chunk, the ones out of the `confirmation_blocks` window are dropped.
+
+    :param block_hashes: Block number to the hash its logs were checked against
+    """
+    if not block_hashes:
+        return
+
+    window_start = get_hash_window_start(environment, max(block_hashes))
+    if window_start is None:
+        return
+    environment_db_object, _ = Environment.objects.get_or_create(environment=environment)
+
+    with transaction.atomic():
+        BlockHash.objects\
+            .filter(index=index, environment=environment_db_object)\
+            .filter(Q(block_number__lt=window_start) | Q(block_number__in=list(block_hashes)))\
+            .delete()
+        BlockHash.objects.bulk_create([
+            BlockHash(
+                index=index,
+                environment=environment_db_object,
+                block_number=block_number,
+                hash=block_hash,
+            )
+            for block_number, block_hash in block_hashes.items()
+            if block_number >= window_start
+        ])
+
+
+def forget_block_hashes(index, environment, since_block):
+    BlockHash.objects.filter(
+        index=index,
+        environment__environment=environment,
+        block_number__gte=since_block,
+    ).delete()
@@ -0,0 +1,64 @@
+"""Plain JSON-RPC calls, for what Web3 can't do on its own like batch requests."""
+import itertools
+import logging
+from typing import List, Tuple
+
+from .provider_service import get_environment_for_provider, get_session
+from .rate_limit_service import acquire
+
+logger = logging.getLogger(__name__)
+
+# Seconds we wait on a single JSON-RPC request
+REQUEST_TIMEOUT = 60
+
+_ids = itertools.count()
+
+
+class JSONRPCError(Exception):
+    pass
+
+
+def _build_request(method: str, params: list) -> dict:
+    return {
+        "jsonrpc": "2.0",
+        "id": next(_ids),
+        "method": method,
+        "params": params,
+    }
+
+
+def batch_call(provider: str, calls: List[Tuple[str, list]]) -> list:
+    """Send many JSON-RPC calls as one batch array.
+
+    :param provider: JSON-RPC provider URL
+    :param calls: List of (method, params)
+    :return: The results in the order of `calls`, a failed call has a `JSONRPCError` in its place
+    :raises: requests.HTTPError, JSONRPCError if the node rejected the whole batch
+    """
+    if not calls:
+        return []
+
+    payload = [_build_request(method, params) for method, params in calls]
+
+    acquire(get_environment_for_provider(provider.strip()), provider)
+    response = get_session(provider).post(provider.strip(), json=payload, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+
+    # Nodes that don't support batches answer with a single error object
+    if isinstance(data, dict):
+        raise JSONRPCError(data.get("error", data))
+
+    # Responses of a batch can come back in any order
+    responses = {item.get("id"): item for item in data}
+
+    results = []
+    for request in payload:
+        item = responses.get(request["id"])
+        if item is None:
+            results.append(JSONRPCError(f"No response for {request['method']}"))
+        elif "error" in item:
+            results.append(JSONRPCError(item["error"]))
+        else:
+            results.append(item["result"])
+    return results
@@ -0,0 +1,119 @@
+"""Historical samples of a contract view function, eg. `totalSupply()` every N blocks over months.
+
+A multicall runs at one block, so it can't carry the samples of many blocks. Instead the samples
+go out as JSON-RPC batches of `eth_call`s, each pinned to its own block, through `read_service.read_many`,
+with `MAX_PARALLEL_BATCHES` batches in-flight at the same time.
+
+Samples at finalized blocks are kept in the pinned read cache, so a run that was interrupted,
+or a wider range sampled later on, only sends the blocks that were never read.
+"""
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, NamedTuple, Optional
+
+from pipe import select, where
+from web3.exceptions import BadFunctionCallOutput, ContractLogicError
+
+from common.exceptions import NotAcceptableError
+from ..config import CHAIN
+from .block_service import BLOCK_BATCH_SIZE, get_block_timestamps
+from .block_timestamp_service import get_block_timestamp_store
+from .read_service import READ_BATCH_SIZE, ReadCall, read_many
+
+logger = logging.getLogger(__name__)
+
+# How many batches of samples are in-flight at the same time
+MAX_PARALLEL_BATCHES = 4
+
+
+class Samples(NamedTuple):
+    """One column per field, the n-th sample is (block_numbers[n], timestamps[n], values[n])."""
+    block_numbers: List[int]
+    timestamps: List[Optional[datetime.datetime]]
+    values: List[Any]
+
+
+def _read_batch(environment, calls: List[ReadCall]) -> list:
+    """The values of a batch, None for the blocks the call reverts at, eg. before the contract was deployed."""
+    try:
+        return read_many(environment, calls)
+    except (ContractLogicError, BadFunctionCallOutput):
+        pass
+
+    values = []
+    for call in calls:
+        try:
+            values.append(read_many(environment, [call])[0])
+        except (ContractLogicError, BadFunctionCallOutput) as e:
+            logger.debug(f"No sample at block {call.default_block}: {e}")
+            values.append(None)
+    return values
+
+
+def get_timestamps(environment, block_numbers: List[int]) -> dict:
+    """Time of the blocks, from the block timestamp store or fetched and added to it."""
+    store = get_block_timestamp_store(environment)
+    block_timestamps = store.get_timestamps(block_numbers)
+    missing_block_numbers = list(
+        block_numbers
+        | where(lambda block_number: block_number not in block_timestamps)
+    )
+    if missing_block_numbers:
+        fetched = get_block_timestamps(
+            CHAIN[environment]["provider"],
+            missing_block_numbers,
+            batch_size=CHAIN[environment].get("block_batch_size", BLOCK_BATCH_SIZE)
+        )
+        store.set_timestamps(fetched)
+        block_timestamps.update(fetched)
+    return block_timestamps
+
+
+def sample(
+    environment,
+    contract_address: str,
+    abi: list,
+    function_name: str,
+    args: tuple,
+    start_block: int,
+    end_block: int,
+    step: int = 1,
+    batch_size: int = READ_BATCH_SIZE,
+    max_workers: int = MAX_PARALLEL_BATCHES,
+) -> Samples:
+    """Call `function_name(*args)` at every `step` blocks from `start_block` to `end_block`, both included.
+
+    :return: `Samples`, a None value for the blocks the call reverts at
+    :raises: NotAcceptableError for an empty range, the error of a batch that failed on every provider
+    """
+    if step < 1 or start_block > end_block:
+        raise NotAcceptableError(
+            f"Can't sample from block {start_block} to {end_block} every {step} blocks"
+        )
+
+    block_numbers = list(range(start_block, end_block + 1, step))
+    batches = [
+        list(
+            block_numbers[i: i + batch_size]
+            | select(lambda block_number: ReadCall(contract_address, abi, function_name, tuple(args), block_number))
+        )
+        for i in range(0, len(block_numbers), batch_size)
+    ]
+    logger.info(
+        f"Sampling {function_name} of {contract_address} on {environment} at {len(block_numbers)} blocks"
+    )
+
+    values = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+        # executor.map keeps the order of the batches
+        for batch_values in executor.map(lambda calls: _read_batch(environment, calls), batches):
+            values.extend(batch_values)
+            logger.info(f"Sampled {len(values)}/{len(block_numbers)} blocks")
+
+    block_timestamps = get_timestamps(environment, block_numbers)
+    return Samples(
+        block_numbers=block_numbers,
+        timestamps=list(block_numbers | select(block_timestamps.get)),
+        values=values,
+    )
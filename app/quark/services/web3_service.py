@@ -4,8 +4,8 @@ import importlib
 from web3 import Web3
 from .. import config
 
-from web3.middleware import geth_poa_middleware
-from typing import Optional
+from types import MappingProxyType
+from typing import List, Mapping, NamedTuple, Optional, Tuple
 import time
 from common.exceptions import NotAcceptableError
 import logging
@@ -13,9 +13,10 @@ import diskcache as dc
 from django.db.models.functions import Concat
 from django.db.models import F, CharField
 from hexbytes import HexBytes
-from .read_service import read, read_balance
+from .read_service import ReadCall, read, read_balance
 from .parse_service import parse
 from .abi_service import get_abi
+from .provider_service import get_web3
 from pipe import select, where
 from django.db import IntegrityError, transaction
 
@@ -23,6 +24,63 @@ logger = logging.getLogger(__name__)
 cache = dc.Cache("tmp")
 
 
+def get_event_topic(event_abi):
+    message = f"{event_abi['name']}({','.join(list(map(lambda x: x['type'], event_abi['inputs'])))})"
+
+    k = sha3.keccak_256()
+    k.update(message.encode("utf-8"))
+    return f"0x{k.hexdigest()}"
+
+
+class EventTable(NamedTuple):
+    """The events of a contract ABI, worked out once when the contract is built."""
+    by_name: Mapping[str, dict]
+    by_topic: Mapping[str, dict]
+    topic_to_name: Mapping[str, str]
+    name_to_topic: Mapping[str, str]
+    # The events the scanner asks the node for
+    selected: Tuple[str, ...]
+
+    @property
+    def selected_topics(self) -> Tuple[str, ...]:
+        return tuple(self.selected | select(lambda event_name: self.name_to_topic[event_name]))
+
+
+def build_event_table(abi, events_to_scan: Optional[List[str]] = None) -> EventTable:
+    """
+    :param events_to_scan: Names of the events to scan, all the events of the ABI by default
+    """
+    event_abis = list(
+        abi
+        | where(lambda x: x["type"] == "event" and not x.get("anonymous"))
+    )
+
+    by_name = {}
+    by_topic = {}
+    topic_to_name = {}
+    name_to_topic = {}
+    for event_abi in event_abis:
+        topic = get_event_topic(event_abi)
+        by_topic[topic] = event_abi
+        topic_to_name[topic] = event_abi["name"]
+        # Like the ABI lookups by name, the first of the overloaded events wins
+        by_name.setdefault(event_abi["name"], event_abi)
+        name_to_topic.setdefault(event_abi["name"], topic)
+
+    selected = tuple(events_to_scan or by_name)
+    unknown_events = list(selected | where(lambda event_name: event_name not in by_name))
+    if unknown_events:
+        raise NotAcceptableError(f"Invalid Event Name: {', '.join(unknown_events)}")
+
+    return EventTable(
+        by_name=MappingProxyType(by_name),
+        by_topic=MappingProxyType(by_topic),
+        topic_to_name=MappingProxyType(topic_to_name),
+        name_to_topic=MappingProxyType(name_to_topic),
+        selected=selected,
+    )
+
+
 class Contract(object):
     def __init__(
         self,
@@ -30,19 +88,21 @@ class Contract(object):
         contract_address: str,
         environment: str = "testnet",
         abi_path: Optional[str] = None,
+        events_to_scan: Optional[List[str]] = None,
     ):
         self.contract_address = self.get_checksum_address(contract_address)
         self.environment = environment
-        self.web3 = Web3(Web3.HTTPProvider(self.chain["provider"]))
-        self.web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        self.web3 = get_web3(environment)
         self.abi_path = abi_path
         self.abi = get_abi(contract_address, environment, abi_path)
         # logger.info(self.abi)
         self.contract_instance = self.web3.eth.contract(
             address=self.contract_address, abi=self.abi
         )
+        self.event_table = build_event_table(self.abi, events_to_scan)
         self.callbacks = {}
-        self.events_to_scan = None
+        self.batch_callbacks = {}
+        self.revert_callbacks = {}
         self.index = index
 
     def get_checksum_address(self, address):
@@ -104,7 +164,10 @@ class Contract(object):
 
         return txn_hash
 
-    def read(self, function_name: str, *args, default_block="latest"):
+    def read(self, function_name: str, *args, default_block="latest", hedge=False):
+        """
+        :param hedge: Race a second provider when the first is slow, for latency-sensitive reads
+        """
         return read(
             self.contract_address,
             self.environment,
@@ -112,8 +175,13 @@ class Contract(object):
             function_name,
             default_block,
             *args,
+            hedge=hedge,
         )
 
+    def read_call(self, function_name: str, *args, default_block="latest") -> ReadCall:
+        """A `read` to send with others through `read_service.read_many`."""
+        return ReadCall(self.contract_address, self.abi, function_name, args, default_block)
+
     def add_callbacks(self, callbacks={}):
         if callbacks and isinstance(callbacks, dict):
             self.callbacks = callbacks
@@ -123,6 +191,39 @@ class Contract(object):
             event = self.callbacks[event["event_name"]](event, self)
         return event
 
+    def add_batch_callbacks(self, batch_callbacks={}):
+        """
+        eg. batch_callbacks = {"Transfer": on_token_transfers}
+
+        A batch callback gets all the events of that name the contract emitted in a chunk,
+        in chain order, and the contract: `on_token_transfers(events, contract_instance)`.
+        It returns the events to save, returning None keeps them as they are.
+        """
+        if batch_callbacks and isinstance(batch_callbacks, dict):
+            self.batch_callbacks = batch_callbacks
+
+    def execute_batch_callback(self, event_name, events):
+        if event_name in self.batch_callbacks:
+            result = self.batch_callbacks[event_name](events, self)
+            if result is not None:
+                events = result
+        return events
+
+    def add_revert_callbacks(self, revert_callbacks={}):
+        """
+        eg. revert_callbacks = {"Transfer": on_token_transfers_reverted}
+
+        Called as `on_token_transfers_reverted(events, contract_instance)` with the saved events
+        of that name that a chain reorganisation dropped, latest first, to undo what the
+        callbacks derived from them.
+        """
+        if revert_callbacks and isinstance(revert_callbacks, dict):
+            self.revert_callbacks = revert_callbacks
+
+    def execute_revert_callback(self, event_name, events):
+        if event_name in self.revert_callbacks:
+            self.revert_callbacks[event_name](events, self)
+
     def process_and_save(self, event):
         """
         eg. event = {
@@ -188,23 +289,14 @@ class Contract(object):
             reference_key=f"{block.environment.environment}-{block.block_number}-{txn.index}-{event['log_index']}",
         )
 
+    @property
+    def events_to_scan(self):
+        return list(self.event_table.selected)
+
     def get_abi_for_topic(self, topic0):
         if isinstance(topic0, HexBytes):
             topic0 = topic0.hex()
-        if hasattr(self, "topic_to_abi_mapping"):
-            return self.topic_to_abi_mapping[topic0]
-        self.topic_to_abi_mapping = dict(
-            list(
-                self.get_all_event_names()
-                | select(
-                    lambda event_name: (
-                        self.get_topic(event_name),
-                        self.get_event_abi(event_name),
-                    )
-                )
-            )
-        )
-        return self.topic_to_abi_mapping[topic0]
+        return self.event_table.by_topic[topic0]
 
     def get_unsaved_events(self, events):
         def _get_composite_key(event):
@@ -235,29 +327,19 @@ class Contract(object):
         )
 
     def get_all_event_names(self):
-        return list(
-            self.contract_instance.abi
-            | where(lambda x: x["type"] == "event")
-            | select(lambda x: x["name"])
-        )
+        return list(self.event_table.by_name)
 
     def get_event_abi(self, event_name):
-        data = list(
-            filter(lambda x: x.get("name") == event_name, self.contract_instance.abi)
-        )
-        if data:
-            data = data[0]
-        else:
+        try:
+            return self.event_table.by_name[event_name]
+        except KeyError:
             raise NotAcceptableError("Invalid Event Name")
-        return data
 
     def get_topic(self, event_name):
-        data = self.get_event_abi(event_name)
-        message = f"{data['name']}({','.join(list(map(lambda x: x['type'], data['inputs'])))})"
-
-        k = sha3.keccak_256()
-        k.update(message.encode("utf-8"))
-        return f"0x{k.hexdigest()}"
+        try:
+            return self.event_table.name_to_topic[event_name]
+        except KeyError:
+            raise NotAcceptableError("Invalid Event Name")
 
     @property
     def logs(self):
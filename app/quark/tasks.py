@@ -4,7 +4,7 @@ from celery import shared_task
 from app.celery import app
 import logging
 from . import config
-from .indexer import run_indexer
+from .indexer import run_indexer, run_index, get_indexed_environments, INDEXERS_TO_SCAN
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +22,18 @@ def update_all_events(self, environment):
     run_indexer(environment)
 
 
+@app.task(bind=True)
+@close_db_connection()
+def update_index_events(self, index, environment, loader="bulk"):
+    # loader="copy" for full reindexes
+    run_index(index, environment, loader)
+
+
 @shared_task
 @close_db_connection()
 def periodic_5_update_all_events():  # 5 mins
-    for environment in config.Environment:
-        update_all_events(environment)
+    # One task per (index, environment) so the chains are scanned concurrently
+    # and a failing RPC only affects its own chain
+    for index in INDEXERS_TO_SCAN:
+        for environment in get_indexed_environments(index):
+            update_index_events.delay(index, environment)
@@ -0,0 +1,55 @@
+import datetime
+import random
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from quark.services.block_timestamp_service import BlockTimestampStore
+
+START = datetime.datetime(2022, 1, 1)
+
+
+class BlockTimestampStoreTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = BlockTimestampStore("polygon-mainnet", directory=directory.name)
+
+    def test_set_and_get_timestamps(self):
+        self.store.set_timestamps({10: START, 11: None, 2500000: START + datetime.timedelta(seconds=2)})
+
+        self.assertEqual(self.store.get(10), int(START.replace(tzinfo=datetime.timezone.utc).timestamp()))
+        self.assertIsNone(self.store.get(11))
+        self.assertIsNone(self.store.get(10 ** 9))
+        self.assertEqual(
+            self.store.get_timestamps([10, 11, 2500000]),
+            {10: START, 2500000: START + datetime.timedelta(seconds=2)}
+        )
+
+    def test_forget(self):
+        self.store.set_timestamps({10: START, 20: START + datetime.timedelta(seconds=20)})
+        self.store.forget(15)
+
+        self.assertEqual(self.store.get_timestamps([10, 20]), {10: START})
+
+    @mock.patch("quark.services.block_timestamp_service.SEARCH_WINDOW", 50000)
+    def test_search_matches_a_linear_scan(self):
+        random.seed(0)
+        # Sparse known blocks, a timestamp every 2 blocks with a few blocks in the same second
+        known = {
+            block_number: START + datetime.timedelta(seconds=block_number // 2)
+            for block_number in sorted(random.sample(range(1, 400), 60))
+        }
+        self.store.set_timestamps(known)
+
+        for seconds in range(-5, 210):
+            when = START + datetime.timedelta(seconds=seconds)
+            after = [block_number for block_number, timestamp in known.items() if timestamp >= when]
+            before = [block_number for block_number, timestamp in known.items() if timestamp <= when]
+
+            self.assertEqual(self.store.block_at_or_after(when), min(after, default=None))
+            self.assertEqual(self.store.block_at_or_before(when), max(before, default=None))
+
+    def test_empty_store(self):
+        self.assertEqual(self.store.get_block_range(START, START + datetime.timedelta(days=1)), (None, None))
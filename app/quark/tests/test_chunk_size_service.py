@@ -0,0 +1,145 @@
+import tempfile
+import threading
+from unittest import mock
+
+import diskcache as dc
+from django.test import SimpleTestCase
+from requests.exceptions import Timeout
+
+from quark.services import chunk_size_service
+from quark.services.chunk_size_service import (
+    CEILING_PROBE_AFTER,
+    ChunkSizeController,
+    _get_learned_ceiling_key,
+)
+
+PROVIDER = "https://rpc.example.org"
+
+
+class ChunkSizeControllerTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = dc.Cache(directory.name)
+        self.addCleanup(self.cache.close)
+        patcher = mock.patch.object(chunk_size_service, "cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_controller(self, **kwargs):
+        return ChunkSizeController(PROVIDER, max_chunk_size=1000, min_chunk_size=10, **kwargs)
+
+    def succeed(self, controller, block_range, log_count=1):
+        return controller.on_success(block_range, log_count=log_count, payload_bytes=100, latency=0.1)
+
+    def test_additive_increase_up_to_the_ceiling(self):
+        controller = self.get_controller(additive_increase=100)
+        controller.chunk_size = 500
+
+        self.assertEqual(self.succeed(controller, 500), 600)
+        controller.chunk_size = 950
+        self.assertEqual(self.succeed(controller, 950), 1000)
+
+    def test_multiplicative_decrease_over_target(self):
+        controller = self.get_controller(max_logs_per_request=100)
+
+        self.assertEqual(self.succeed(controller, 1000, log_count=101), 500)
+        self.assertEqual(controller.ceiling, 1000)
+
+    def test_size_error_lowers_the_ceiling_but_never_raises_it(self):
+        controller = self.get_controller()
+
+        self.assertEqual(controller.on_failure(400, ValueError("query returned more than 10000 results")), 200)
+        self.assertEqual(controller.ceiling, 200)
+        controller.on_failure(1000, ValueError("block range is too wide"))
+        self.assertEqual(controller.ceiling, 200)
+
+    def test_throttling_keeps_the_range(self):
+        controller = self.get_controller()
+
+        self.assertEqual(controller.on_failure(1000, ValueError({"code": -32005, "message": "rate limit exceeded"})), 1000)
+        self.assertEqual(controller.ceiling, 1000)
+
+    def test_size_errors_are_not_throttling(self):
+        controller = self.get_controller()
+
+        self.assertEqual(controller.on_failure(1000, ValueError("logs matched by query exceeds limit of 10000")), 500)
+        self.assertEqual(controller.ceiling, 500)
+
+    def test_a_single_timeout_keeps_the_ceiling(self):
+        controller = self.get_controller()
+
+        self.assertEqual(controller.on_failure(1000, Timeout()), 500)
+        self.assertEqual(controller.ceiling, 1000)
+        self.assertIsNone(self.cache.get(_get_learned_ceiling_key(PROVIDER)))
+
+    def test_a_timeout_repeated_at_the_range_lowers_the_ceiling(self):
+        controller = self.get_controller()
+
+        controller.on_failure(1000, Timeout())
+        controller.on_failure(1000, Timeout())
+        self.assertEqual(controller.ceiling, 500)
+
+    def test_a_good_response_at_the_range_clears_the_timeout(self):
+        controller = self.get_controller()
+
+        controller.on_failure(1000, Timeout())
+        self.succeed(controller, 1000)
+        controller.on_failure(1000, Timeout())
+        self.assertEqual(controller.ceiling, 1000)
+
+    def test_good_responses_dont_extend_the_learned_ceiling(self):
+        controller = self.get_controller()
+        controller.on_failure(400, ValueError("response size exceeded"))
+        _, ceiling_expire_time = self.cache.get(_get_learned_ceiling_key(PROVIDER), expire_time=True)
+
+        with mock.patch("time.time", return_value=ceiling_expire_time - 1):
+            self.succeed(controller, 200)
+        _, expire_time = self.cache.get(_get_learned_ceiling_key(PROVIDER), expire_time=True)
+        self.assertEqual(expire_time, ceiling_expire_time)
+
+    def test_learned_ceiling_is_shared_and_forgotten(self):
+        controller = self.get_controller()
+        controller.on_failure(400, ValueError("response size exceeded"))
+
+        self.assertEqual(self.get_controller().ceiling, 200)
+        self.cache.delete(_get_learned_ceiling_key(PROVIDER))
+        self.assertEqual(self.get_controller().ceiling, 1000)
+
+    def test_ceiling_is_probed_after_good_responses_at_the_ceiling(self):
+        controller = self.get_controller(additive_increase=100)
+        controller.on_failure(400, ValueError("response size exceeded"))
+
+        for _ in range(CEILING_PROBE_AFTER - 1):
+            self.succeed(controller, 200)
+        self.assertEqual(controller.ceiling, 200)
+        self.succeed(controller, 200)
+        self.assertEqual(controller.ceiling, 300)
+
+    def test_updates_from_fetch_threads_are_serialised(self):
+        controller = self.get_controller()
+        controller._lock.acquire()
+        thread = threading.Thread(target=controller.on_failure, args=(400, ValueError("response size exceeded")))
+        thread.start()
+        thread.join(0.1)
+        # Blocked until the other update is done
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(controller.ceiling, 1000)
+
+        controller._lock.release()
+        thread.join()
+        self.assertEqual(controller.ceiling, 200)
+
+    def test_concurrent_failures_keep_the_lowest_ceiling(self):
+        controller = self.get_controller()
+        threads = [
+            threading.Thread(target=controller.on_failure, args=(block_range, ValueError("response size exceeded")))
+            for block_range in range(900, 20, -20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(controller.ceiling, 20)
+        self.assertEqual(self.get_controller().ceiling, 20)
@@ -0,0 +1,167 @@
+import random
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+from eth_abi import encode_abi
+from eth_abi.exceptions import DecodingError
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.events import get_event_data
+from web3.datastructures import AttributeDict
+from web3.exceptions import LogTopicError
+
+from quark.services.decoder_service import EventDecoder, LogDecoder
+
+TRANSFER_ABI = {
+    "anonymous": False,
+    "name": "Transfer",
+    "type": "event",
+    "inputs": [
+        {"indexed": True, "name": "from", "type": "address"},
+        {"indexed": True, "name": "to", "type": "address"},
+        {"indexed": False, "name": "value", "type": "uint256"},
+    ],
+}
+
+SWAP_ABI = {
+    "anonymous": False,
+    "name": "Swap",
+    "type": "event",
+    "inputs": [
+        {"indexed": True, "name": "sender", "type": "address"},
+        {"indexed": False, "name": "amount", "type": "int256"},
+        {"indexed": False, "name": "recipients", "type": "address[]"},
+        {"indexed": True, "name": "memo", "type": "string"},
+        {"indexed": False, "name": "note", "type": "string"},
+        {"indexed": False, "name": "fee", "type": "uint8"},
+        {"indexed": False, "name": "salt", "type": "bytes32"},
+    ],
+}
+
+CONTRACT_ADDRESS = Web3.toChecksumAddress("0x2791bca1f2de4661ed88a30c99a7a9449aa84174")
+
+
+def random_bytes(length: int) -> bytes:
+    return random.getrandbits(8 * length).to_bytes(length, "big")
+
+
+def random_address() -> bytes:
+    return random_bytes(20)
+
+
+def address_topic(address: bytes) -> HexBytes:
+    return HexBytes(bytes(12) + address)
+
+
+def make_log(abi, topics, data: bytes, address=CONTRACT_ADDRESS) -> AttributeDict:
+    return AttributeDict({
+        "address": address,
+        "topics": [HexBytes(event_abi_to_log_topic(abi)), *topics],
+        "data": "0x" + data.hex(),
+        "logIndex": 3,
+        "transactionIndex": 7,
+        "transactionHash": HexBytes(random_bytes(32)),
+        "blockHash": HexBytes(random_bytes(32)),
+        "blockNumber": 25000000,
+    })
+
+
+def make_transfer_log(address=CONTRACT_ADDRESS) -> AttributeDict:
+    return make_log(
+        TRANSFER_ABI,
+        [address_topic(random_address()), address_topic(random_address())],
+        encode_abi(["uint256"], [random.getrandbits(256)]),
+        address=address,
+    )
+
+
+def make_swap_log() -> AttributeDict:
+    return make_log(
+        SWAP_ABI,
+        [address_topic(random_address()), HexBytes(random_bytes(32))],
+        encode_abi(
+            ["int256", "address[]", "string", "uint8", "bytes32"],
+            [
+                random.randint(-2 ** 255, 2 ** 255 - 1),
+                ["0x" + random_address().hex() for _ in range(random.randint(0, 3))],
+                "swap",
+                random.getrandbits(8),
+                random_bytes(32),
+            ]
+        ),
+    )
+
+
+class EventDecoderTest(SimpleTestCase):
+    """The decoders have to make exactly the records of `web3._utils.events.get_event_data`."""
+
+    def setUp(self):
+        random.seed(0)
+        self.codec = Web3().codec
+
+    def test_transfer_matches_web3(self):
+        decoder = EventDecoder(self.codec, TRANSFER_ABI)
+        for _ in range(100):
+            log = make_transfer_log()
+            self.assertEqual(decoder(log), get_event_data(self.codec, TRANSFER_ABI, log))
+
+    def test_complex_event_matches_web3(self):
+        decoder = EventDecoder(self.codec, SWAP_ABI)
+        for _ in range(100):
+            log = make_swap_log()
+            self.assertEqual(decoder(log), get_event_data(self.codec, SWAP_ABI, log))
+
+    def test_hex_string_topics_match_web3(self):
+        decoder = EventDecoder(self.codec, TRANSFER_ABI)
+        log = make_transfer_log()
+        hex_log = AttributeDict({**log, "topics": [topic.hex() for topic in log["topics"]]})
+        self.assertEqual(decoder(hex_log), get_event_data(self.codec, TRANSFER_ABI, log))
+
+    def test_dirty_address_padding_fails_like_web3(self):
+        decoder = EventDecoder(self.codec, TRANSFER_ABI)
+        log = make_transfer_log()
+        log = AttributeDict({**log, "topics": [log["topics"][0], HexBytes(b"\x01" * 32), log["topics"][2]]})
+
+        with self.assertRaises(DecodingError):
+            get_event_data(self.codec, TRANSFER_ABI, log)
+        with self.assertRaises(DecodingError):
+            decoder(log)
+
+    def test_wrong_number_of_topics(self):
+        decoder = EventDecoder(self.codec, TRANSFER_ABI)
+        log = make_transfer_log()
+        log = AttributeDict({**log, "topics": log["topics"][:2]})
+
+        with self.assertRaises(LogTopicError):
+            decoder(log)
+
+
+class LogDecoderTest(SimpleTestCase):
+    def setUp(self):
+        random.seed(0)
+        self.codec = Web3().codec
+        contract = SimpleNamespace(
+            contract_address=CONTRACT_ADDRESS,
+            event_table=SimpleNamespace(by_topic={
+                event_abi_to_log_topic(abi): abi
+                for abi in [TRANSFER_ABI, SWAP_ABI]
+            }),
+        )
+        self.decoder = LogDecoder(self.codec, [contract])
+
+    def test_picks_the_event_of_the_log(self):
+        transfer_log = make_transfer_log()
+        swap_log = make_swap_log()
+
+        self.assertEqual(self.decoder.decode(transfer_log), get_event_data(self.codec, TRANSFER_ABI, transfer_log))
+        self.assertEqual(self.decoder.decode(swap_log), get_event_data(self.codec, SWAP_ABI, swap_log))
+
+    def test_lowercase_contract_address(self):
+        log = make_transfer_log(address=CONTRACT_ADDRESS.lower())
+        self.assertEqual(self.decoder.decode(log), get_event_data(self.codec, TRANSFER_ABI, log))
+
+    def test_unknown_contract(self):
+        log = make_transfer_log(address=Web3.toChecksumAddress("0x" + random_address().hex()))
+        with self.assertRaises(KeyError):
+            self.decoder.decode(log)
@@ -0,0 +1,56 @@
+import datetime
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from quark.services import event_scanner
+from quark.services.event_scanner import EventScanner, _fetch_events_for_all_contracts
+
+CONTRACT_ADDRESS = "0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174"
+
+
+class NoTopicsTest(SimpleTestCase):
+    """Without topics `eth_getLogs` would match every log of the contracts."""
+
+    def setUp(self):
+        self.web3 = mock.Mock()
+        self.scanner = EventScanner.__new__(EventScanner)
+        self.scanner.web3 = self.web3
+        self.scanner.topics = []
+        self.scanner.contract_mapping = {CONTRACT_ADDRESS: mock.Mock(contract_address=CONTRACT_ADDRESS)}
+        self.scanner.log_decoder = None
+        self.scanner.chunk_size_controller = mock.Mock(chunk_size=100)
+        self.scanner.block_timestamp_store = mock.Mock()
+        self.scanner.block_timestamp_store.get_timestamps.side_effect = lambda block_numbers: {
+            block_number: datetime.datetime(2022, 1, 1) for block_number in block_numbers
+        }
+        self.scanner.hash_window_start = None
+        self.scanner.block_hashes = {}
+        self.scanner.block_hashes_lock = threading.Lock()
+
+    def test_no_topic_groups(self):
+        for batch_topics in [True, False]:
+            self.scanner.batch_topics = batch_topics
+            self.assertEqual(self.scanner.get_topic_groups(), [])
+
+        self.scanner.topics = [b"transfer", b"approval"]
+        self.assertEqual(self.scanner.get_topic_groups(), [[b"transfer"], [b"approval"]])
+        self.scanner.batch_topics = True
+        self.assertEqual(self.scanner.get_topic_groups(), [[b"transfer", b"approval"]])
+
+    def test_chunk_is_fetched_without_get_logs(self):
+        self.scanner.batch_topics = True
+        with mock.patch.object(event_scanner, "_fetch_events_for_topics") as fetch_events:
+            end_block, events, block_timestamps = self.scanner.fetch_chunk(100, 200)
+
+        fetch_events.assert_not_called()
+        self.web3.eth.get_logs.assert_not_called()
+        self.assertEqual((end_block, events), (200, []))
+        self.assertEqual(list(block_timestamps), [200])
+
+    def test_empty_topic_list_is_never_sent(self):
+        with self.assertRaises(ValueError):
+            _fetch_events_for_all_contracts(self.web3, [], self.scanner.contract_mapping, from_block=100, to_block=200)
+
+        self.web3.eth.get_logs.assert_not_called()
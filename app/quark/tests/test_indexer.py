@@ -0,0 +1,124 @@
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase
+from web3 import Web3
+
+from index_v1.config import TOKEN_CONTRACT
+from index_v1.services.update_token_holders_service import on_token_transfers, on_token_transfers_reverted
+from quark.config import Environment
+from quark.indexer import SCAN_LOCK_TIMEOUT, _get_scan_lock_key, get_contracts_in_index, run_index, run_indexer_async
+
+
+class GetContractsInIndexTest(SimpleTestCase):
+    def test_builds_the_index_v1_registry(self):
+        environment = Environment.polygon_mainnet
+        contracts = get_contracts_in_index("index_v1", environment)
+
+        self.assertEqual(len(contracts), 1)
+        contract_instance = contracts[0]
+        self.assertEqual(contract_instance.index, "index_v1")
+        self.assertEqual(contract_instance.environment, environment)
+        self.assertEqual(
+            contract_instance.contract_address,
+            Web3.toChecksumAddress(TOKEN_CONTRACT[environment]["address"])
+        )
+        self.assertEqual(contract_instance.batch_callbacks, {"Transfer": on_token_transfers})
+        self.assertEqual(contract_instance.revert_callbacks, {"Transfer": on_token_transfers_reverted})
+
+    def test_environment_without_contracts(self):
+        self.assertEqual(get_contracts_in_index("index_v1", Environment.ropsten), [])
+
+
+class RunIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.lock = mock.Mock(name="lock")
+        redis_client = mock.Mock()
+        redis_client.lock.return_value = self.lock
+        patcher = mock.patch("quark.indexer._get_redis", return_value=redis_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis_client = redis_client
+
+    @mock.patch("quark.indexer._run")
+    def test_scans_and_releases_the_lock(self, run):
+        self.lock.acquire.return_value = True
+
+        run_index("index_v1", Environment.polygon_mainnet)
+
+        self.redis_client.lock.assert_called_once_with(
+            _get_scan_lock_key("index_v1", Environment.polygon_mainnet), timeout=SCAN_LOCK_TIMEOUT
+        )
+        run.assert_called_once_with("index_v1", Environment.polygon_mainnet, "bulk")
+        self.lock.release.assert_called_once_with()
+
+    @mock.patch("quark.indexer._run", side_effect=ValueError("scan failed"))
+    def test_releases_the_lock_when_the_scan_fails(self, run):
+        self.lock.acquire.return_value = True
+
+        with self.assertRaises(ValueError):
+            run_index("index_v1", Environment.polygon_mainnet)
+
+        self.lock.release.assert_called_once_with()
+
+    @mock.patch("quark.indexer._run")
+    def test_skips_a_pair_that_is_being_scanned(self, run):
+        self.lock.acquire.return_value = False
+
+        run_index("index_v1", Environment.polygon_mainnet)
+
+        run.assert_not_called()
+        self.lock.release.assert_not_called()
+
+    @mock.patch("quark.indexer.SCAN_LOCK_REFRESH_SECONDS", 0.01)
+    def test_refreshes_the_lock_while_scanning(self):
+        self.lock.acquire.return_value = True
+        refreshed = threading.Event()
+        self.lock.reacquire.side_effect = lambda: refreshed.set()
+
+        with mock.patch("quark.indexer._run", side_effect=lambda *args: refreshed.wait(5)):
+            run_index("index_v1", Environment.polygon_mainnet)
+
+        self.assertTrue(refreshed.is_set())
+
+
+class RunIndexerAsyncTest(SimpleTestCase):
+    def setUp(self):
+        self.locks = {}
+
+        def get_lock(name, timeout):
+            lock = mock.Mock(name=name)
+            lock.name = name
+            # Polygon is being scanned by a Celery task
+            lock.acquire.return_value = "polygon" not in name
+            self.locks[name] = lock
+            return lock
+
+        redis_client = mock.Mock()
+        redis_client.lock.side_effect = get_lock
+        for patcher in [
+            mock.patch("quark.indexer._get_redis", return_value=redis_client),
+            mock.patch("quark.indexer.contract.register_all_contracts"),
+            mock.patch("quark.indexer.get_contracts_in_index", side_effect=lambda index, environment: [environment]),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch("quark.indexer.run_update_events_async")
+    def test_skips_the_pairs_that_are_being_scanned(self, run_update_events_async):
+        run_update_events_async.side_effect = lambda groups: self.assertFalse(
+            any(lock.release.called for lock in self.locks.values())
+        )
+
+        run_indexer_async([Environment.polygon_mainnet, Environment.avalanche_mainnet])
+
+        run_update_events_async.assert_called_once_with([([Environment.avalanche_mainnet], "index_v1")])
+        avalanche_lock = self.locks[_get_scan_lock_key("index_v1", Environment.avalanche_mainnet)]
+        avalanche_lock.release.assert_called_once_with()
+        self.locks[_get_scan_lock_key("index_v1", Environment.polygon_mainnet)].release.assert_not_called()
+
+    def test_same_lock_as_the_celery_tasks(self):
+        self.assertEqual(
+            _get_scan_lock_key("index_v1", Environment.polygon_mainnet),
+            _get_scan_lock_key("index_v1", "polygon-mainnet"),
+        )
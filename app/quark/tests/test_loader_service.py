@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from quark.services import loader_service
+from quark.services.loader_service import BulkLoader
+
+
+def get_contract(callbacks):
+    contract_instance = SimpleNamespace(callbacks=callbacks)
+    contract_instance.execute_callback = lambda event: callbacks[event["event_name"]](event, contract_instance)
+    return contract_instance
+
+
+def get_event(event_name, log_index):
+    return {"address": "0xabc", "event_name": event_name, "log_index": log_index}
+
+
+class BulkLoaderRunCallbacksTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(loader_service.transaction, "atomic")
+        self.atomic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_savepoints_only_for_events_with_a_callback(self):
+        contract_instance = get_contract({"Approval": lambda event, contract: {**event, "seen": True}})
+        events = [get_event("Transfer", 0), get_event("Approval", 1), get_event("Transfer", 2)]
+
+        contract_events = BulkLoader("index_v1").run_callbacks(events, {"0xabc": contract_instance})
+
+        self.assertEqual(self.atomic.call_count, 1)
+        self.assertEqual(
+            [event for _, event in contract_events],
+            [events[0], {**events[1], "seen": True}, events[2]]
+        )
+
+    def test_events_whose_callback_fails_are_left_out(self):
+        def fail(event, contract):
+            raise ValueError("callback failed")
+
+        contract_instance = get_contract({"Approval": fail})
+        events = [get_event("Transfer", 0), get_event("Approval", 1)]
+
+        with self.assertLogs(loader_service.logger, "ERROR"):
+            contract_events = BulkLoader("index_v1").run_callbacks(events, {"0xabc": contract_instance})
+
+        self.assertEqual([event for _, event in contract_events], [events[0]])
+
+
+class ORMLoaderTest(SimpleTestCase):
+    def setUp(self):
+        self.calls = mock.Mock()
+        atomic = mock.MagicMock()
+        atomic.return_value.__enter__.side_effect = lambda: self.calls.begin()
+
+        def exit_atomic(exc_type, exc_value, traceback):
+            self.calls.end(exc_type)
+            return False
+
+        atomic.return_value.__exit__.side_effect = exit_atomic
+        patcher = mock.patch.object(loader_service.transaction, "atomic", atomic)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(loader_service.importlib, "import_module")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_contract(self, save_event):
+        contract_instance = mock.Mock(callbacks={}, batch_callbacks={"Transfer": None})
+        contract_instance.execute_callback.side_effect = lambda event: event
+
+        def execute_batch_callback(event_name, events):
+            self.calls.apply_deltas([event["log_index"] for event in events])
+            return events
+
+        contract_instance.execute_batch_callback.side_effect = execute_batch_callback
+        contract_instance.save_event.side_effect = save_event
+        contract_instance.process_and_save.side_effect = lambda event: self.calls.process_and_save(event["log_index"])
+        return contract_instance
+
+    def get_events(self):
+        return [
+            {**get_event("Transfer", 0), "block_number": 1, "transaction_index": 0},
+            {**get_event("Approval", 1), "block_number": 1, "transaction_index": 0},
+            {**get_event("Transfer", 2), "block_number": 1, "transaction_index": 0},
+        ]
+
+    def test_batch_callbacks_and_saves_commit_together(self):
+        contract_instance = self.get_contract(lambda event: self.calls.save_event(event["log_index"]))
+
+        loader_service.ORMLoader("index_v1").load(self.get_events(), {"0xabc": contract_instance})
+
+        self.assertEqual(self.calls.mock_calls, [
+            mock.call.begin(),
+            # The savepoint of the batch callback
+            mock.call.begin(),
+            mock.call.apply_deltas([0, 2]),
+            mock.call.end(None),
+            mock.call.save_event(0),
+            mock.call.process_and_save(1),
+            mock.call.save_event(2),
+            mock.call.end(None),
+        ])
+
+    def test_failing_save_rolls_the_batch_callbacks_back(self):
+        def save_event(event):
+            if event["log_index"] == 2:
+                raise ValueError("can't save")
+
+        contract_instance = self.get_contract(save_event)
+
+        with self.assertRaises(ValueError):
+            loader_service.ORMLoader("index_v1").load(self.get_events(), {"0xabc": contract_instance})
+
+        # The transaction of the callbacks is left with the error, it rolls back
+        self.assertEqual(self.calls.mock_calls[-1], mock.call.end(ValueError))
+        self.assertEqual(self.calls.mock_calls[0], mock.call.begin())
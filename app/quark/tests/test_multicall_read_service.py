@@ -0,0 +1,80 @@
+import threading
+
+from django.test import SimpleTestCase
+from web3.exceptions import ContractLogicError
+
+from quark.services.multicall_read_service import Multicall, MulticallResult
+
+
+class FakeMulticall(Multicall):
+    """`aggregate` echoes the call data back, reverts on `reverting` and fails over `max_calls` calls."""
+
+    def __init__(self, reverting=(), max_calls=None):
+        self.reverting = set(reverting)
+        self.max_calls = max_calls
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+
+    def _aggregate(self, targets_with_data, block_identifier="latest"):
+        with self._lock:
+            self.batch_sizes.append(len(targets_with_data))
+        if self.max_calls is not None and len(targets_with_data) > self.max_calls:
+            raise ValueError("out of gas")
+        if any(data in self.reverting for _, data in targets_with_data):
+            raise ContractLogicError("execution reverted")
+        return 1, [data for _, data in targets_with_data]
+
+
+def make_calls(count):
+    return [("0x0000000000000000000000000000000000000001", i.to_bytes(4, "big")) for i in range(count)]
+
+
+class AggregateInBatchesTest(SimpleTestCase):
+    def test_batches_are_merged_in_order(self):
+        multicall = FakeMulticall()
+        calls = make_calls(250)
+
+        results = multicall._aggregate_in_batches(calls, "latest", require_success=True, batch_size=100)
+
+        self.assertEqual(sorted(multicall.batch_sizes), [50, 100, 100])
+        self.assertEqual(results, [MulticallResult(success=True, return_data=data) for _, data in calls])
+
+    def test_too_large_batches_are_split(self):
+        multicall = FakeMulticall(max_calls=30)
+        calls = make_calls(100)
+
+        results = multicall._aggregate_in_batches(calls, "latest", require_success=True, batch_size=100)
+
+        self.assertEqual(results, [MulticallResult(success=True, return_data=data) for _, data in calls])
+        # 100 -> 50 -> 25, every call went out in one of the 4 batches that were small enough
+        self.assertEqual(sum(size for size in multicall.batch_sizes if size <= 30), 100)
+
+    def test_revert_stops_aggregate(self):
+        calls = make_calls(10)
+        multicall = FakeMulticall(reverting=[calls[3][1]])
+
+        with self.assertRaises(ContractLogicError):
+            multicall._aggregate_in_batches(calls, "latest", require_success=True, batch_size=100)
+        self.assertEqual(multicall.batch_sizes, [10])
+
+    def test_try_aggregate_isolates_the_reverts(self):
+        calls = make_calls(20)
+        reverting = {calls[3][1], calls[17][1]}
+        multicall = FakeMulticall(reverting=reverting)
+
+        results = multicall._aggregate_in_batches(calls, "latest", require_success=False, batch_size=8)
+
+        self.assertEqual(
+            results,
+            [
+                MulticallResult(success=False, return_data=None) if data in reverting
+                else MulticallResult(success=True, return_data=data)
+                for _, data in calls
+            ]
+        )
+
+    def test_a_single_call_too_large_is_raised(self):
+        multicall = FakeMulticall(max_calls=0)
+
+        with self.assertRaises(ValueError):
+            multicall._aggregate_in_batches(make_calls(2), "latest", require_success=False, batch_size=100)
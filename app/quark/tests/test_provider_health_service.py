@@ -0,0 +1,48 @@
+import tempfile
+from unittest import mock
+
+import diskcache as dc
+from django.test import SimpleTestCase
+
+from quark.services import provider_health_service
+from quark.services.provider_health_service import FAILURE_THRESHOLD, rank_providers, record_failure, record_success
+
+ENVIRONMENT = "polygon-mainnet"
+
+
+class RankProvidersTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(provider_health_service, "cache", dc.Cache(directory.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keeps_the_order_without_samples(self):
+        self.assertEqual(rank_providers(ENVIRONMENT, ["a", "b", "a", "c"]), ["a", "b", "c"])
+
+    def test_fastest_first(self):
+        record_success(ENVIRONMENT, "a", 0.5)
+        record_success(ENVIRONMENT, "b", 0.1)
+        self.assertEqual(rank_providers(ENVIRONMENT, ["a", "b"]), ["b", "a"])
+
+    def test_unsampled_provider_is_tried_before_a_failing_one(self):
+        record_success(ENVIRONMENT, "fast", 0.1)
+        record_success(ENVIRONMENT, "failing", 0.1)
+        for _ in range(FAILURE_THRESHOLD - 1):
+            record_failure(ENVIRONMENT, "failing")
+
+        self.assertEqual(rank_providers(ENVIRONMENT, ["failing", "fast", "new"]), ["fast", "new", "failing"])
+
+    def test_unsampled_provider_is_scored_at_the_median_latency(self):
+        for provider, latency in [("a", 0.1), ("b", 0.2), ("c", 0.9)]:
+            record_success(ENVIRONMENT, provider, latency)
+
+        self.assertEqual(rank_providers(ENVIRONMENT, ["c", "b", "new", "a"]), ["a", "b", "new", "c"])
+
+    def test_open_circuits_last(self):
+        for _ in range(FAILURE_THRESHOLD):
+            record_failure(ENVIRONMENT, "down")
+        record_success(ENVIRONMENT, "slow", 5.0)
+
+        self.assertEqual(rank_providers(ENVIRONMENT, ["down", "slow", "new"]), ["slow", "new", "down"])
@@ -0,0 +1,18 @@
+from django.test import SimpleTestCase
+
+from quark.config import CHAIN, Environment
+from quark.services.provider_service import get_environment_for_provider
+
+
+class GetEnvironmentForProviderTest(SimpleTestCase):
+    def test_main_and_backup_providers(self):
+        chain = CHAIN[Environment.mainnet]
+        self.assertEqual(get_environment_for_provider(chain["provider"]), Environment.mainnet)
+        self.assertEqual(get_environment_for_provider(chain["backup_providers"][0]), Environment.mainnet)
+
+    def test_whitespace_around_the_url(self):
+        provider = CHAIN[Environment.aurora_mainnet]["provider"]
+        self.assertEqual(get_environment_for_provider(f" {provider} "), Environment.aurora_mainnet)
+
+    def test_unknown_provider(self):
+        self.assertIsNone(get_environment_for_provider("https://rpc.example.org"))
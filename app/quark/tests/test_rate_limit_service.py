@@ -0,0 +1,74 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+from requests import HTTPError, Response
+
+from quark.services import rate_limit_service
+from quark.services.rate_limit_service import TokenBucket, is_rate_limited, reserve
+
+
+class TokenBucketTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("quark.services.rate_limit_service.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_queue(self):
+        bucket = TokenBucket(rate=10, burst=3)
+
+        waits = [bucket.take() for _ in range(6)]
+
+        self.assertEqual(waits[:3], [0.0, 0.0, 0.0])
+        for expected, wait in zip([0.1, 0.2, 0.3], waits[3:]):
+            self.assertAlmostEqual(wait, expected)
+
+    def test_refills_at_the_rate_up_to_the_burst(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        for _ in range(3):
+            bucket.take()
+
+        self.now += 0.2
+        self.assertEqual([bucket.take(), bucket.take()], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.take(), 0.1)
+
+        self.now += 60
+        self.assertEqual([bucket.take() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertGreater(bucket.take(), 0)
+
+    def test_clock_going_back_doesnt_add_tokens(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.take()
+
+        self.now -= 5
+        self.assertAlmostEqual(bucket.take(), 0.1)
+
+
+class ReserveTest(SimpleTestCase):
+    @mock.patch.dict(rate_limit_service.CHAIN, {"test-chain": {"rate_limit": {"requests_per_second": 10, "burst": 2}}})
+    @mock.patch("quark.services.rate_limit_service._get_redis_script", side_effect=ConnectionError("no redis"))
+    @mock.patch("quark.services.rate_limit_service._local_buckets", {})
+    @mock.patch("quark.services.rate_limit_service._redis_failed_at", 0.0)
+    def test_falls_back_to_a_local_bucket_without_redis(self, get_redis_script):
+        with self.assertLogs("quark.services.rate_limit_service", level="WARNING"):
+            waits = [reserve("test-chain", " https://rpc.test/ ") for _ in range(3)]
+
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertGreater(waits[2], 0)
+        # Redis isn't asked again until REDIS_RETRY_SECONDS went by
+        get_redis_script.assert_called_once()
+        self.assertIn("rate_limit:test-chain:https://rpc.test/", rate_limit_service._local_buckets)
+
+    def test_unlimited_chain(self):
+        self.assertEqual(reserve("unknown-chain", "https://rpc.test/"), 0.0)
+
+
+class IsRateLimitedTest(SimpleTestCase):
+    def test_http_429(self):
+        response = Response()
+        response.status_code = 429
+        self.assertTrue(is_rate_limited(HTTPError(response=response)))
+
+    def test_messages(self):
+        self.assertTrue(is_rate_limited(ValueError({"code": -32005, "message": "Too Many Requests"})))
+        self.assertFalse(is_rate_limited(ValueError({"code": -32005, "message": "query returned more than 10000 results"})))
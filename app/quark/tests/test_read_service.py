@@ -0,0 +1,71 @@
+import tempfile
+from unittest import mock
+
+import diskcache as dc
+from django.test import SimpleTestCase
+from requests import RequestException
+
+from common.exceptions import NotAcceptableError
+from quark.services import read_service
+from quark.services.read_service import get_read_key, read, save_result_in_cache, set_permanent_cache
+
+ENVIRONMENT = "polygon-mainnet"
+CONTRACT_ADDRESS = "0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174"
+BLOCK = 100
+
+
+class PinnedReadTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = dc.Cache(f"{directory.name}/cache")
+        self.pinned_cache = dc.Cache(f"{directory.name}/pinned")
+        for patcher in [
+            mock.patch.object(read_service, "cache", self.cache),
+            mock.patch.object(read_service, "pinned_cache", self.pinned_cache),
+            mock.patch.object(read_service, "is_finalized", return_value=True),
+            mock.patch.object(read_service, "get_all_providers", return_value=["https://rpc.test/"]),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.key = get_read_key(CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply", BLOCK)
+
+    def read(self):
+        return read(CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply", BLOCK)
+
+    @mock.patch.object(read_service, "tracked_call", return_value=42)
+    def test_pins_the_result_of_the_providers(self, tracked_call):
+        self.assertEqual(self.read(), 42)
+        self.assertEqual(self.pinned_cache.get(self.key), 42)
+
+        self.assertEqual(self.read(), 42)
+        tracked_call.assert_called_once()
+
+    @mock.patch.object(read_service, "tracked_call", side_effect=RequestException("down"))
+    def test_falls_back_to_the_same_block_without_pinning(self, tracked_call):
+        set_permanent_cache(1, CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply")
+        set_permanent_cache(2, CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply", default_block=BLOCK)
+
+        self.assertEqual(self.read(), 2)
+        self.assertNotIn(self.key, self.pinned_cache)
+
+    @mock.patch.object(read_service, "tracked_call", side_effect=RequestException("down"))
+    def test_never_read_block_fails(self, tracked_call):
+        # The latest value is not an answer for a historical block
+        set_permanent_cache(1, CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply")
+
+        with self.assertRaises(NotAcceptableError):
+            self.read()
+        self.assertNotIn(self.key, self.pinned_cache)
+
+    @mock.patch.object(read_service, "tracked_call", return_value=None)
+    def test_none_is_not_pinned(self, tracked_call):
+        self.assertIsNone(self.read())
+        self.assertNotIn(self.key, self.pinned_cache)
+
+    def test_save_result_in_cache_doesnt_pin_none(self):
+        save_result_in_cache(None, CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply", default_block=BLOCK)
+        self.assertNotIn(self.key, self.pinned_cache)
+
+        save_result_in_cache(7, CONTRACT_ADDRESS, ENVIRONMENT, [], "totalSupply", default_block=BLOCK)
+        self.assertEqual(self.pinned_cache.get(self.key), 7)
@@ -0,0 +1,192 @@
+import datetime
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from quark.services import event_scanner, reorg_service
+from quark.services.event_scanner import DBState, EventScanner
+from quark.services.reorg_service import ChainReorganisedError, check_block_hashes, find_fork_block
+
+ENVIRONMENT = "polygon-mainnet"
+CONTRACT_ADDRESS = "0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174"
+
+
+def block_hash(block_number, fork=0) -> str:
+    return "0x" + f"{fork:02x}{block_number:062x}"
+
+
+def headers(block_numbers, fork=0, fork_from=None) -> dict:
+    return {
+        block_number: {"hash": block_hash(block_number, fork if fork_from is not None and block_number >= fork_from else 0)}
+        for block_number in block_numbers
+    }
+
+
+def make_log(block_number, fork=0) -> AttributeDict:
+    return AttributeDict({
+        "blockNumber": block_number,
+        "blockHash": HexBytes(block_hash(block_number, fork)),
+        "logIndex": 0,
+        "transactionIndex": 0,
+    })
+
+
+class CheckBlockHashesTest(SimpleTestCase):
+    def test_logs_of_the_fetched_chain(self):
+        hashes = {block_number: block_hash(block_number) for block_number in range(10, 15)}
+        check_block_hashes(hashes, dict(hashes), [make_log(11), make_log(14), make_log(3)])
+
+    def test_log_of_another_chain(self):
+        hashes = {block_number: block_hash(block_number) for block_number in range(10, 15)}
+        with self.assertRaises(ChainReorganisedError):
+            check_block_hashes(hashes, dict(hashes), [make_log(11), make_log(12, fork=1)])
+
+    def test_block_changed_while_fetching(self):
+        hashes_before = {block_number: block_hash(block_number) for block_number in range(10, 15)}
+        hashes_after = {**hashes_before, 13: block_hash(13, fork=1)}
+        # A block without logs still tells the logs might be from either chain
+        with self.assertRaises(ChainReorganisedError):
+            check_block_hashes(hashes_before, hashes_after, [make_log(11)])
+
+
+class FetchChunkBlockHashesTest(SimpleTestCase):
+    def setUp(self):
+        self.scanner = EventScanner.__new__(EventScanner)
+        self.scanner.provider = "https://rpc.test/"
+        self.scanner.chain = {}
+        self.scanner.contracts = [mock.Mock(environment=ENVIRONMENT)]
+        self.scanner.batch_topics = True
+        self.scanner.topics = [b"topic"]
+        self.scanner.web3 = None
+        self.scanner.contract_mapping = {}
+        self.scanner.log_decoder = None
+        self.scanner.max_parallel_requests = 1
+        self.scanner.max_request_retries = 1
+        self.scanner.request_retry_seconds = 0
+        self.scanner.chunk_size_controller = mock.Mock(chunk_size=100)
+        self.scanner.block_timestamp_store = mock.Mock()
+        self.scanner.block_timestamp_store.get_timestamps.side_effect = lambda block_numbers: {
+            block_number: datetime.datetime(2022, 1, 1) for block_number in block_numbers
+        }
+        self.scanner.state = mock.Mock(index="index_v1", environment=ENVIRONMENT)
+        self.scanner.hash_window_start = None
+        self.scanner.block_hashes = {}
+        self.scanner.block_hashes_lock = threading.Lock()
+
+    @mock.patch.object(event_scanner, "get_hash_window_start", return_value=195)
+    @mock.patch.object(event_scanner, "_fetch_events_for_topics", return_value=[make_log(150), make_log(197)])
+    @mock.patch.object(event_scanner, "get_block_headers", side_effect=lambda provider, block_numbers, **kwargs: headers(block_numbers))
+    def test_records_the_hashes_the_logs_were_checked_against(self, get_block_headers, *mocks):
+        calls = mock.Mock()
+        self.scanner.state.end_chunk = calls.end_chunk
+        with mock.patch.object(event_scanner, "record_block_hashes", calls.record_block_hashes):
+            list(self.scanner.scan_iter(100, 200))
+
+        # Only the blocks of the hash window, fetched before and after the logs
+        self.assertEqual(
+            [list(call.args[1]) for call in get_block_headers.call_args_list],
+            [list(range(195, 201)), list(range(195, 201))]
+        )
+        self.assertEqual(calls.mock_calls, [
+            mock.call.record_block_hashes(
+                "index_v1", ENVIRONMENT, {block_number: block_hash(block_number) for block_number in range(195, 201)}
+            ),
+            mock.call.end_chunk(200),
+        ])
+        self.assertEqual(self.scanner.block_hashes, {})
+
+    @mock.patch.object(event_scanner, "get_hash_window_start", return_value=195)
+    @mock.patch.object(event_scanner, "_fetch_events_for_topics", return_value=[make_log(197)])
+    def test_rejects_a_chunk_the_chain_changed_under(self, *mocks):
+        responses = iter([headers(range(195, 201)), headers(range(195, 201), fork=1, fork_from=199)])
+        with mock.patch.object(event_scanner, "get_block_headers", side_effect=lambda *args, **kwargs: next(responses)), \
+                mock.patch.object(event_scanner, "record_block_hashes") as record_block_hashes:
+            with self.assertRaises(ChainReorganisedError):
+                list(self.scanner.scan_iter(100, 200))
+
+        record_block_hashes.assert_not_called()
+        self.scanner.state.end_chunk.assert_not_called()
+
+
+class ForkRollbackTest(SimpleTestCase):
+    def setUp(self):
+        self.contract = mock.Mock(contract_address=CONTRACT_ADDRESS)
+        self.state = DBState.__new__(DBState)
+        self.state.contracts = [self.contract]
+        self.state.environment = ENVIRONMENT
+        self.state.index = "index_v1"
+        self.state.logs = mock.Mock()
+        self.dropped_logs = self.state.logs.objects.filter.return_value
+        self.dropped_logs.order_by.return_value.values.return_value = [
+            {
+                "data": {"value": 5},
+                "log_index": 0,
+                "contract__address": CONTRACT_ADDRESS,
+                "event_name__event_name": "Transfer",
+                "txn__hash": "0xtxn",
+                "txn__index": 0,
+                "txn__block__block_number": 103,
+                "txn__block__timestamp": datetime.datetime(2022, 1, 1),
+            },
+        ]
+
+        self.scanner = EventScanner.__new__(EventScanner)
+        self.scanner.state = self.state
+        self.scanner.provider = "https://rpc.test/"
+        self.scanner.block_timestamp_store = mock.Mock()
+
+        models = mock.MagicMock()
+        models.Txn._meta.related_objects = []
+        models.Block._meta.related_objects = []
+        for name in ["Block", "Txn", "ScanCheckpoint", "transaction", "forget_block_hashes"]:
+            patcher = mock.patch.object(event_scanner, name, getattr(models, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.models = models
+
+        saved_hashes = mock.patch.object(reorg_service, "BlockHash")
+        self.block_hash_model = saved_hashes.start()
+        self.addCleanup(saved_hashes.stop)
+        self.block_hash_model.objects.filter.return_value.values_list.return_value = [
+            (block_number, block_hash(block_number)) for block_number in range(100, 106)
+        ]
+
+    def test_no_fork(self):
+        with mock.patch.object(reorg_service, "get_block_headers", return_value=headers(range(100, 106))):
+            self.assertIsNone(self.scanner.delete_potentially_forked_block_data())
+
+        self.contract.execute_revert_callback.assert_not_called()
+        self.dropped_logs.delete.assert_not_called()
+
+    def test_fork_is_rolled_back(self):
+        with mock.patch.object(
+            reorg_service, "get_block_headers", return_value=headers(range(100, 106), fork=1, fork_from=103)
+        ):
+            self.assertEqual(self.scanner.delete_potentially_forked_block_data(), 103)
+
+        self.state.logs.objects.filter.assert_called_once_with(
+            contract__address__in=[CONTRACT_ADDRESS],
+            txn__block__environment__environment=ENVIRONMENT,
+            txn__block__block_number__gte=103,
+        )
+        self.contract.execute_revert_callback.assert_called_once_with("Transfer", [{
+            "event_name": "Transfer",
+            "timestamp": datetime.datetime(2022, 1, 1),
+            "log_index": 0,
+            "transaction_index": 0,
+            "txhash": "0xtxn",
+            "block_number": 103,
+            "address": CONTRACT_ADDRESS,
+            "args": {"value": 5},
+        }])
+        self.dropped_logs.delete.assert_called_once_with()
+        self.models.forget_block_hashes.assert_called_once_with("index_v1", ENVIRONMENT, 103)
+        self.scanner.block_timestamp_store.forget.assert_called_once_with(103)
+
+    def test_missing_block_is_a_fork(self):
+        node_headers = {**headers(range(100, 106)), 105: None}
+        with mock.patch.object(reorg_service, "get_block_headers", return_value=node_headers):
+            self.assertEqual(find_fork_block("index_v1", ENVIRONMENT, "https://rpc.test/"), 105)
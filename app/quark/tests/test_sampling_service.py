@@ -0,0 +1,52 @@
+import datetime
+from unittest import mock
+
+from django.test import SimpleTestCase
+from web3.exceptions import ContractLogicError
+
+from common.exceptions import NotAcceptableError
+from quark.services import sampling_service
+from quark.services.sampling_service import Samples, sample
+
+CONTRACT_ADDRESS = "0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174"
+DEPLOY_BLOCK = 105
+START = datetime.datetime(2022, 1, 1)
+
+
+def fake_read_many(environment, calls):
+    """totalSupply is the block number, the calls revert before the contract was deployed."""
+    if any(call.default_block < DEPLOY_BLOCK for call in calls):
+        raise ContractLogicError("execution reverted")
+    return [call.default_block for call in calls]
+
+
+def fake_get_timestamps(environment, block_numbers):
+    return {block_number: START + datetime.timedelta(seconds=block_number) for block_number in block_numbers}
+
+
+@mock.patch.object(sampling_service, "get_timestamps", side_effect=fake_get_timestamps)
+@mock.patch.object(sampling_service, "read_many", side_effect=fake_read_many)
+class SampleTest(SimpleTestCase):
+    def test_samples_in_block_order(self, read_many, get_timestamps):
+        samples = sample("polygon-mainnet", CONTRACT_ADDRESS, [], "totalSupply", (), 110, 200, step=10, batch_size=3)
+
+        block_numbers = list(range(110, 201, 10))
+        self.assertEqual(samples, Samples(
+            block_numbers=block_numbers,
+            timestamps=[START + datetime.timedelta(seconds=block_number) for block_number in block_numbers],
+            values=block_numbers,
+        ))
+        # 10 samples in batches of 3
+        self.assertEqual(read_many.call_count, 4)
+
+    def test_blocks_before_the_deployment_are_none(self, read_many, get_timestamps):
+        samples = sample("polygon-mainnet", CONTRACT_ADDRESS, [], "totalSupply", (), 100, 110, batch_size=4)
+
+        self.assertEqual(samples.values, [None] * 5 + list(range(105, 111)))
+
+    def test_empty_range(self, read_many, get_timestamps):
+        with self.assertRaises(NotAcceptableError):
+            sample("polygon-mainnet", CONTRACT_ADDRESS, [], "totalSupply", (), 200, 100)
+        with self.assertRaises(NotAcceptableError):
+            sample("polygon-mainnet", CONTRACT_ADDRESS, [], "totalSupply", (), 100, 200, step=0)
+        read_many.assert_not_called()
@@ -3,6 +3,7 @@ from datetime import datetime
 from .contract import get_checksum_address
 from . import config
 from web3 import Web3
+from .services.provider_service import get_web3
 from typing import Optional
 from pipe import select,  where
 
@@ -41,12 +42,9 @@ def _price(x):
 
 
 def bnb_balance(address, environment=config.Environment.mainnet):
-    chain = config.CHAIN[environment]
     address = Web3.toChecksumAddress(address)
     return round(
-        Web3(
-            Web3.HTTPProvider(chain['provider'])
-        ).eth.getBalance(address)/1e18, 2
+        get_web3(environment).eth.getBalance(address)/1e18, 2
     )
 
 